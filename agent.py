@@ -4,111 +4,640 @@ LangGraph ReAct Agent with MCP Tools - Autonomous Agentic AI
 
 模型建議：
 - ✅ gpt-oss-20b (OpenAI) - 原生支援 function calling
-- ⚠️ gemma-3n (Google) - 不支援原生 function calling，僅輸出 JSON 文字
+- ⚠️ gemma-3n (Google) - 不支援原生 function calling，僅輸出 JSON 文字（由 tool_call_repair 解析為工具呼叫）
 - ✅ qwen2.5 (Alibaba) - 支援 function calling
 - ✅ mistral (Mistral AI) - 支援 function calling
 - ✅ llama-3.1/3.2 (Meta) - 支援 function calling
 """
 
 import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager, nullcontext
 from langchain_openai import ChatOpenAI
-from langchain_mcp_adapters.tools import load_mcp_tools
 from langgraph.prebuilt import create_react_agent
-from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from typing import Any, Coroutine, Dict, Optional
 import os
 
+from model_router import ModelRouter
+from tool_selector import SelectiveToolModel
+from workspace_pool import WorkspacePool
+from thread_store import ThreadStore
+from profiling import RunProfiler
+from resilience import PING_TAG, AdaptiveTimeout, ResilientBackend, ResilientModel, guard_tools
+from agent_profiles import AgentProfile, UnknownProfile
+from loop_detection import LoopGuardModel, LoopStats, guard_repeats
+from run_context import RETRY_TAG, RunContext, run_scope
+from token_accounting import MeteredModel, TokenLedger
+from long_term_memory import LongTermMemory, make_embedder
+from tool_call_repair import ToolCallRepairModel, ToolCallRepairStats, may_be_text_tool_call, parse_text_tool_calls
+
+
+# 唯讀工具（失敗時可安全重試）
+READ_ONLY_TOOLS = frozenset({
+    "read_file", "read_text_file", "read_media_file", "read_multiple_files",
+    "list_directory", "list_directory_with_sizes", "directory_tree",
+    "search_files", "get_file_info", "list_allowed_directories",
+})
+
+
+SYSTEM_PROMPT = """你是一個自主執行的 AI 助理，類似 Claude Code。
+
+重要行為準則：
+1. 當使用者給你一個意圖或任務時，你要**自主規劃並執行所有必要步驟**
+2. **不要問使用者細節**，直接根據上下文做出最佳判斷
+3. 自動使用可用的工具（檔案系統、bash 等）來完成任務
+4. 持續執行工具直到任務完成
+5. 給出完整的最終結果，而不是中途停下來問問題
+
+可用工具包括：
+- 檔案讀取/寫入/列表
+- 目錄操作
+
+範例：
+使用者: "分析當前目錄的 Python 檔案"
+你應該: 自動列目錄 → 找到 .py 檔 → 讀取內容 → 分析 → 給出報告
+而不是: "請問您要分析哪個檔案？"
+"""
+
+# 預熱用的代表性請求：經過工具子集選擇時綁定一般檔案操作會用到的工具
+WARMUP_MESSAGE = "列出目前目錄的檔案"
+
+
+class AgentDraining(RuntimeError):
+    """Agent 正在關閉（或已被熱重載取代），不再接受新的執行"""
+
+
+def _no_measure(category: str):
+    """未啟用 profiler 時的計時替代"""
+    return nullcontext()
+
+
+class _TokenFilter:
+    """
+    串流時暫緩看起來像文字形式工具呼叫的輸出
+
+    模型以 JSON 文字輸出的工具呼叫會由 tool_call_repair 轉成真正的工具呼叫，
+    這些文字不應該以 token 送給 client；確定不是工具呼叫時才補送
+    """
+
+    def __init__(self, tool_names: list):
+        self.tool_names = tool_names
+        self._held: Dict[str, str] = {}
+        self._live = set()
+
+    def feed(self, run_id: str, content: str) -> str:
+        """回傳可以立即送出的內容（暫緩時回傳空字串）"""
+        if run_id in self._live:
+            return content
+        text = self._held.pop(run_id, "") + content
+        if may_be_text_tool_call(text):
+            self._held[run_id] = text
+            return ""
+        self._live.add(run_id)
+        return text
+
+    def finish(self, run_id: str) -> str:
+        """LLM 呼叫結束：暫緩的內容不是工具呼叫時補送"""
+        self._live.discard(run_id)
+        text = self._held.pop(run_id, "")
+        if text and not parse_text_tool_calls(text, self.tool_names):
+            return text
+        return ""
+
 
 class AgenticChatBot:
     """自主執行的 Agentic AI Chatbot"""
 
-    def __init__(self, base_url: str = "http://localhost:1234/v1", model: str = "gpt-oss-20b-mlx"):
+    def __init__(
+        self,
+        base_url: str = "http://localhost:1234/v1",
+        model: str = "gpt-oss-20b-mlx",
+        fast_model: Optional[str] = None,
+        escalate_after_steps: int = 6,
+        synthesize_with_strong: bool = True,
+        tool_top_k: int = 6,
+        allowed_workspaces: Optional[list] = None,
+        workspace_pool_size: int = 4,
+        workspace_idle_seconds: float = 600.0,
+        thread_idle_seconds: float = 900.0,
+        llm_timeout: float = 120.0,
+        tool_timeout: float = 30.0,
+        profiles: Optional[Dict[str, AgentProfile]] = None,
+        max_stalled_steps: int = 2,
+        request_token_budget: int = 0,
+        thread_token_budget: int = 0,
+        memory_top_k: int = 0,
+        memory_path: Optional[str] = None,
+        embedding_model: Optional[str] = None,
+        history_window: int = 0,
+        repair_tool_calls: bool = True,
+    ):
         """
         初始化 ReAct Agent (同步版本，用於非 async 環境)
 
         Args:
             base_url: LM Studio API endpoint
-            model: 模型名稱
+            model: 模型名稱（升級時與未設定 fast_model 時使用）
+            fast_model: 一般步驟使用的小模型（None 表示全部使用 model）
+            escalate_after_steps: 同一輪執行超過幾步後全部改用 model
+            synthesize_with_strong: 最終回答一律由 model 生成（False 表示直接採用 fast_model 的最終回答）
+            tool_top_k: 每次 LLM 呼叫最多綁定幾個相關工具（0 表示每次都綁定全部工具）
+            allowed_workspaces: 允許請求指定的 workspace 根目錄（預設只允許目前目錄）
+            workspace_pool_size: 最多同時保留幾個 workspace 的常駐工具後端
+            workspace_idle_seconds: workspace 後端閒置超過幾秒會被關閉
+            thread_idle_seconds: 對話執行緒閒置超過幾秒會被壓縮封存
+            llm_timeout: 單次 LLM 呼叫的逾時上限（秒），實際逾時依觀察到的延遲自動調整
+            tool_timeout: 單次工具呼叫的逾時上限（秒）
+            profiles: 可由請求選擇的具名 Agent 設定（見 agent_profiles.py）
+            max_stalled_steps: 連續幾步只是重複先前的工具呼叫就強制最終回答（0 表示停用迴圈偵測）
+            request_token_budget: 單次請求的 token 上限，用完時執行會以說明訊息結束（0 表示不限制）
+            thread_token_budget: 單一執行緒累計的 token 上限（0 表示不限制）
+            memory_top_k: 每次請求從長期記憶取出幾則相關內容放進 prompt（0 表示停用長期記憶）
+            memory_path: 長期記憶索引的存放目錄（None 表示只存在記憶體中）
+            embedding_model: 長期記憶使用的 sentence-transformers 模型（None 表示使用 hashing 嵌入）
+            history_window: 每次請求只重播最近幾輪對話（0 表示重播完整歷史）
+            repair_tool_calls: 解析模型以文字輸出的工具呼叫，並修正拼錯的工具與參數名稱
         """
         self.base_url = base_url
         self.model = model
+        self.fast_model = fast_model
+        self.escalate_after_steps = escalate_after_steps
+        self.synthesize_with_strong = synthesize_with_strong
+        self.tool_top_k = tool_top_k
+        self.default_workspace = os.getcwd()
+        self.allowed_workspaces = allowed_workspaces or [self.default_workspace]
+        self.workspace_pool_size = workspace_pool_size
+        self.workspace_idle_seconds = workspace_idle_seconds
         self.llm = None
+        self.router = None
+        self.tool_selection = None
         self.tools = None
-        self.agent = None
+        self.workspaces = None
+        self._model_runnable = None
+        self._archiver: Optional[asyncio.Task] = None
+
+        # ReAct 迴圈偵測（重複的工具呼叫直接回傳先前結果，沒有進展時強制最終回答）
+        self.max_stalled_steps = max_stalled_steps
+        self.loop_stats = LoopStats()
+
+        # 解析以 JSON 文字輸出的工具呼叫，並依工具 schema 修正名稱與參數
+        self.tool_call_repair = ToolCallRepairStats() if repair_tool_calls else None
+
+        # 每個請求、執行緒與租戶的 token 用量與預算
+        self.usage = TokenLedger(request_budget=request_token_budget, thread_budget=thread_token_budget)
+
+        # 具名 Agent 設定：模型只建立一次，graph 依 (profile, workspace) 編譯一次後快取
+        self.profiles = profiles or {}
+        self._profile_models: Dict[str, Any] = {}
+        self._profile_llms: Dict[str, Any] = {}
+
+        # 各後端（LLM、每個 workspace 的 MCP server）的熔斷器與自適應逾時
+        self.tool_timeout = tool_timeout
+        self.llm_backend = ResilientBackend(
+            "llm", timeout=AdaptiveTimeout(initial=llm_timeout, minimum=10.0, maximum=llm_timeout)
+        )
+        self.tool_backends = {}
+        self.profile_llm_backends = {}
+
+        # 各執行緒的對話歷史（精簡表示，閒置時壓縮封存）
+        self.threads = ThreadStore(idle_seconds=thread_idle_seconds)
+        self.history_window = history_window
+
+        # 長期記憶：只取出與問題相關的過去內容，不必重播完整歷史（在初始化時建立）
+        self.memory_top_k = memory_top_k
+        self.memory_path = memory_path
+        self.embedding_model = embedding_model
+        self.memory = None
+
         self._initialized = False
+        self._init_lock = asyncio.Lock()
+        self.warmed = False
+
+        # 執行中的對話數；drain() 後不再接受新的執行
+        self.in_flight = 0
+        self.draining = False
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+        # 同步 API 使用的常駐 event loop（在背景執行緒中執行，擁有所有 async 資源）
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[threading.Thread] = None
+        self._loop_lock = threading.Lock()
 
     async def async_init(self):
         """異步初始化 (用於 async 環境如 FastAPI)"""
-        if self._initialized:
-            return
+        async with self._init_lock:
+            if not self._initialized:
+                await self._async_init()
 
+    async def _async_init(self):
+        """實際的初始化流程（由 async_init 加鎖呼叫）"""
         print("🤖 初始化 Agentic AI...")
 
+        if self.memory_top_k and self.memory is None:
+            # 只記住唯讀工具的結果（寫入、移動等工具的輸出只是操作回報）
+            self.memory = LongTermMemory(
+                self.memory_path, make_embedder(self.embedding_model), top_k=self.memory_top_k,
+                remember_tools=sorted(READ_ONLY_TOOLS)
+            )
+
         # 設定 LLM (連接本地 LM Studio)
-        self.llm = ChatOpenAI(
-            base_url=self.base_url,
-            api_key="lmstudio",  # LM Studio 不需要真實 API key
-            model=self.model,
-            temperature=0.7,
-            streaming=True
+        self.llm = self._make_llm(self.model)
+
+        # 兩階段模型路由：一般步驟用小模型，最終回答、長的執行、工具失敗後與格式錯誤的工具呼叫改用大模型
+        if self.fast_model:
+            self.router = ModelRouter(
+                fast_llm=self._make_llm(self.fast_model),
+                strong_llm=self.llm,
+                fast_model=self.fast_model,
+                strong_model=self.model,
+                escalate_after_steps=self.escalate_after_steps,
+                synthesize_with_strong=self.synthesize_with_strong,
+            )
+            final = self.model if self.synthesize_with_strong else self.fast_model
+            print(f"🔀 模型路由: {self.fast_model} (一般步驟) → {self.model} (升級)，最終回答: {final}")
+
+        # 每次 LLM 呼叫只綁定相關的工具子集
+        self._model_runnable = self.router or self.llm
+        if self.tool_top_k:
+            self.tool_selection = SelectiveToolModel(self._model_runnable, top_k=self.tool_top_k)
+            self._model_runnable = self.tool_selection
+        self._model_runnable = self._guard_loops(self._model_runnable)
+
+        # 常駐工具後端：目前目錄與其他 workspace 都由 WorkspacePool 管理（第一次使用時才啟動），
+        # 目前目錄的後端不會因閒置被關閉，MCP session 中斷時自動重新啟動
+        self.workspaces = WorkspacePool(
+            allowed_roots=self.allowed_workspaces,
+            connection_factory=self._mcp_connection,
+            prepare=self._prepare_workspace,
+            max_size=self.workspace_pool_size,
+            idle_seconds=self.workspace_idle_seconds,
+            pinned_roots=[self.default_workspace]
         )
 
         # 設定 MCP Filesystem Server
         print("🔧 載入 MCP 工具...")
 
-        # 載入 MCP 工具
+        # 載入 MCP 工具（同時建立 ReAct Agent 與 profile 的 graph）
         self.tools = await self._load_tools()
 
         print(f"✅ 已載入 {len(self.tools)} 個工具")
+        if self.profiles:
+            print(f"🧩 已編譯 profile: {', '.join(self.profiles)}")
 
-        # 建立 ReAct Agent (核心！)
-        self.agent = create_react_agent(
-            self.llm,
-            self.tools,
-            prompt="""你是一個自主執行的 AI 助理，類似 Claude Code。
+        self._archiver = asyncio.create_task(self._archive_idle_threads())
 
-重要行為準則：
-1. 當使用者給你一個意圖或任務時，你要**自主規劃並執行所有必要步驟**
-2. **不要問使用者細節**，直接根據上下文做出最佳判斷
-3. 自動使用可用的工具（檔案系統、bash 等）來完成任務
-4. 持續執行工具直到任務完成
-5. 給出完整的最終結果，而不是中途停下來問問題
+        self._initialized = True
+        print("🚀 Agent 已就緒！\n")
 
-可用工具包括：
-- 檔案讀取/寫入/列表
-- 目錄操作
+    async def warmup(self):
+        """
+        預熱 LLM 後端：以實際請求相同的系統提示與工具綁定方式只生成 1 個 token
 
-範例：
-使用者: "分析當前目錄的 Python 檔案"
-你應該: 自動列目錄 → 找到 .py 檔 → 讀取內容 → 分析 → 給出報告
-而不是: "請問您要分析哪個檔案？"
-"""
+        讓 LM Studio 先載入模型並快取 prompt 前綴（KV cache），
+        第一個真正的請求就不必等模型載入。
+        預熱預設模型、路由的小模型與每個 profile 的模型；預熱呼叫不計入熔斷器與延遲統計
+        """
+        if not self._initialized:
+            raise RuntimeError("Agent not initialized. Call sync_init() or async_init() first.")
+
+        for name, model, prompt, _ in self._warmup_targets():
+            # 依序送出，避免多個模型同時載入搶記憶體
+            await self._ping(name, model, prompt)
+        self.warmed = True
+
+    async def keep_alive(self, interval: float) -> float:
+        """
+        對閒置超過 interval 秒的 LLM 後端送出 keep-alive，避免模型閒置時被卸載
+
+        後端最近有實際請求時不送出（實際請求已經讓模型保持載入）
+
+        Returns:
+            距離下一次需要 keep-alive 還有幾秒
+        """
+        due_in = interval
+        for name, model, prompt, backend in self._warmup_targets():
+            idle = backend.idle_seconds()
+            if idle < interval:
+                due_in = min(due_in, interval - idle)
+                continue
+            await self._ping(name, model, prompt)
+        return due_in
+
+    async def _ping(self, name: str, model, prompt: str):
+        """以 PING_TAG 送出只生成 1 個 token 的呼叫（不經過熔斷器、不計入延遲樣本）"""
+        started = time.perf_counter()
+        messages = [SystemMessage(content=prompt), HumanMessage(content=WARMUP_MESSAGE)]
+        await model.bind(max_tokens=1).ainvoke(messages, config={"tags": [PING_TAG]})
+        print(f"🔥 已預熱模型 {name}（{time.perf_counter() - started:.2f}s）")
+
+    def _warmup_targets(self) -> list:
+        """
+        列出要預熱的 (模型名稱, 已綁定工具的模型, 系統提示, LLM 後端的熔斷器)
+
+        工具綁定與實際請求相同（有設定 tool_top_k 時經過工具子集選擇），
+        同一個 endpoint 上的同一模型與系統提示只預熱一次
+        """
+        targets = {}
+
+        def add(name: str, base_url: Optional[str], prompt: str, make_llm, tools: list):
+            key = (name, base_url or self.base_url, prompt)
+            if key not in targets:
+                llm = make_llm()
+                if self.tool_top_k:
+                    # 獨立的統計，預熱不計入 /metrics 的工具選擇統計
+                    llm = SelectiveToolModel(llm, top_k=self.tool_top_k)
+                targets[key] = (name, llm.bind_tools(tools), prompt, self._llm_backend(key[1]))
+
+        if self.router is not None:
+            add(self.fast_model, None, SYSTEM_PROMPT, lambda: self.router.fast_llm, self.tools)
+        add(self.model, None, SYSTEM_PROMPT, lambda: self.llm, self.tools)
+        for profile in self.profiles.values():
+            add(
+                profile.model or self.model,
+                profile.base_url,
+                profile.system_prompt or SYSTEM_PROMPT,
+                lambda profile=profile: self._profile_llm(profile),
+                profile.select_tools(self.tools),
+            )
+        return list(targets.values())
+
+    def _build_agent(self, tools: list, profile: Optional[AgentProfile] = None):
+        """以共用的模型與系統提示（或 profile 的設定）編譯 ReAct Agent"""
+        if profile is None:
+            return create_react_agent(
+                self._model_runnable,
+                tools,
+                prompt=SYSTEM_PROMPT
+            )
+        return create_react_agent(
+            self._profile_model(profile),
+            profile.select_tools(tools),
+            prompt=profile.system_prompt or SYSTEM_PROMPT
         )
 
-        self._initialized = True
-        print("🚀 Agent 已就緒！\n")
+    def _profile_model(self, profile: AgentProfile):
+        """取得 profile 的模型（同一個 profile 的所有 workspace 共用）"""
+        if profile.name not in self._profile_models:
+            model = self._profile_llm(profile)
+            if self.tool_top_k:
+                model = SelectiveToolModel(model, top_k=self.tool_top_k, stats=self.tool_selection.stats)
+            self._profile_models[profile.name] = self._guard_loops(model)
+        return self._profile_models[profile.name]
+
+    def _profile_llm(self, profile: AgentProfile):
+        """取得 profile 的 chat model 本身（未加工具選擇與迴圈偵測，預熱也使用同一個）"""
+        if profile.name not in self._profile_llms:
+            self._profile_llms[profile.name] = self._make_llm(
+                profile.model or self.model, profile.base_url, **profile.sampling()
+            )
+        return self._profile_llms[profile.name]
+
+    def get_profile(self, name: Optional[str]) -> Optional[AgentProfile]:
+        """
+        取得具名 Agent 設定（None 或未另外定義的 "default" 表示預設設定）
+
+        Raises:
+            UnknownProfile: profile 不存在
+        """
+        if name is None or (name == "default" and name not in self.profiles):
+            return None
+        if name not in self.profiles:
+            raise UnknownProfile(f"Unknown profile: {name}")
+        return self.profiles[name]
+
+    def _prepare_workspace(self, root: str, tools: list) -> tuple:
+        """修正 workspace 後端的工具 schema 並編譯專屬的 Agent"""
+        tools = self._guard_tools(self._fix_tool_schemas(tools), root)
+        return tools, self._build_agent(tools)
+
+    def _guard_tools(self, tools: list, root: str) -> list:
+        """為工具加上熔斷、逾時與重複呼叫偵測"""
+        tools = guard_tools(tools, self._tool_backend(root), READ_ONLY_TOOLS)
+        if self.max_stalled_steps:
+            tools = guard_repeats(tools, READ_ONLY_TOOLS, self.loop_stats)
+        return tools
+
+    def _guard_loops(self, model):
+        """為模型加上迴圈偵測（停用時原樣回傳）"""
+        if not self.max_stalled_steps:
+            return model
+        return LoopGuardModel(model, self.max_stalled_steps, stats=self.loop_stats)
+
+    def _tool_backend(self, root: str) -> ResilientBackend:
+        """取得 workspace 的 MCP server 熔斷器（依 root 保留統計）"""
+        if root not in self.tool_backends:
+            self.tool_backends[root] = ResilientBackend(
+                f"mcp:{root}",
+                timeout=AdaptiveTimeout(initial=self.tool_timeout, minimum=5.0, maximum=self.tool_timeout)
+            )
+        return self.tool_backends[root]
+
+    def _make_llm(self, model: str, base_url: Optional[str] = None, **sampling):
+        """建立連接本地 LM Studio 的 chat model（以熔斷器與自適應逾時保護，記錄 token 用量並修正工具呼叫）"""
+        base_url = base_url or self.base_url
+        llm = ChatOpenAI(
+            base_url=base_url,
+            api_key="lmstudio",  # LM Studio 不需要真實 API key
+            model=model,
+            streaming=True,
+            stream_usage=True,  # 串流結束時回傳 token 用量
+            max_retries=0,  # 重試由 ResilientBackend 處理
+            **{"temperature": 0.7, **sampling}
+        )
+        return self._repair_tool_calls(MeteredModel(ResilientModel(llm, self._llm_backend(base_url)), self.usage))
+
+    def _repair_tool_calls(self, model):
+        """為模型加上工具呼叫的解析與修正（停用時原樣回傳）"""
+        if self.tool_call_repair is None:
+            return model
+        return ToolCallRepairModel(model, stats=self.tool_call_repair)
+
+    def llm_backend_for(self, profile: Optional[AgentProfile]) -> ResilientBackend:
+        """取得請求使用的 LLM endpoint 的熔斷器（None 表示預設設定）"""
+        return self._llm_backend((profile.base_url if profile else None) or self.base_url)
+
+    def _llm_backend(self, base_url: str) -> ResilientBackend:
+        """取得 LLM endpoint 的熔斷器（profile 可以指定其他 endpoint）"""
+        if base_url == self.base_url:
+            return self.llm_backend
+        if base_url not in self.profile_llm_backends:
+            self.profile_llm_backends[base_url] = ResilientBackend(
+                f"llm:{base_url}", timeout=AdaptiveTimeout(
+                    initial=self.llm_backend.timeout.maximum, minimum=10.0, maximum=self.llm_backend.timeout.maximum
+                )
+            )
+        return self.profile_llm_backends[base_url]
+
+    def get_metrics(self) -> dict:
+        """取得執行統計（模型路由步數、工具子集選擇、workspace 後端、熔斷器）"""
+        metrics = {}
+        if self.router is None:
+            metrics["model_routing"] = {"enabled": False, "model": self.model}
+        else:
+            metrics["model_routing"] = {"enabled": True, **self.router.stats.snapshot()}
+
+        if self.tool_selection is None:
+            metrics["tool_selection"] = {"enabled": False}
+        else:
+            metrics["tool_selection"] = {
+                "enabled": True,
+                "top_k": self.tool_top_k,
+                **self.tool_selection.stats.snapshot()
+            }
+
+        if self.workspaces is not None:
+            metrics["workspaces"] = self.workspaces.stats()
+        metrics["tool_call_repair"] = {"enabled": False} if self.tool_call_repair is None else {
+            "enabled": True,
+            **self.tool_call_repair.snapshot()
+        }
+        metrics["loop_detection"] = {
+            "enabled": bool(self.max_stalled_steps),
+            "max_stalled_steps": self.max_stalled_steps,
+            **self.loop_stats.snapshot()
+        }
+        metrics["threads"] = self.threads.stats()
+        metrics["tokens"] = self.usage.stats()
+        metrics["memory"] = {"enabled": False} if self.memory is None else {
+            "enabled": True,
+            "history_window": self.history_window,
+            **self.memory.stats()
+        }
+        metrics["backends"] = {
+            backend.name: backend.stats()
+            for backend in [self.llm_backend, *self.profile_llm_backends.values(), *self.tool_backends.values()]
+        }
+        return metrics
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        """取得（必要時啟動）同步 API 使用的常駐 event loop"""
+        with self._loop_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="agent-event-loop", daemon=True)
+                thread.start()
+                self._loop, self._loop_thread = loop, thread
+            return self._loop
+
+    def _run_sync(self, coro: Coroutine[Any, Any, Any]) -> Any:
+        """
+        把 coroutine 交給常駐 event loop 執行並等待結果
+
+        可同時從多個執行緒呼叫；呼叫端被中斷時會一併取消該 coroutine
+        """
+        loop = self._ensure_loop()
+        if threading.current_thread() is self._loop_thread:
+            coro.close()
+            raise RuntimeError("Cannot call the sync API from the agent event loop; use the async API instead.")
+
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
 
     def sync_init(self):
-        """同步初始化 (用於同步環境如 CLI)"""
-        asyncio.run(self.async_init())
+        """同步初始化 (用於同步環境如 CLI)，async 資源建立在常駐 event loop 上"""
+        self._run_sync(self.async_init())
 
-    async def _load_tools(self):
-        """非同步載入 MCP 工具"""
-        connection = {
+    def adopt(self, other: "AgenticChatBot"):
+        """
+        沿用另一個 Agent 的執行期狀態（熱重載時使用，需在 async_init 之前呼叫）
+
+        對話歷史、token 用量、長期記憶、統計與後端熔斷器狀態都與 other 共用，
+        交接期間在舊 Agent 上結束的對話也會記錄到同一份資料中
+        """
+        if self._initialized:
+            raise RuntimeError("adopt() must be called before async_init()")
+        self.threads = other.threads
+        self.usage = other.usage
+        self.memory = other.memory
+        self.loop_stats = other.loop_stats
+        if self.tool_call_repair is not None and other.tool_call_repair is not None:
+            self.tool_call_repair = other.tool_call_repair
+        self.llm_backend = other.llm_backend
+        self.tool_backends = other.tool_backends
+        self.profile_llm_backends = other.profile_llm_backends
+
+    @contextmanager
+    def _track_run(self):
+        """記錄執行中的對話數（drain() 開始後拒絕新的執行）"""
+        if self.draining:
+            raise AgentDraining("Agent is shutting down and not accepting new runs")
+        self.in_flight += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self._idle.set()
+
+    async def drain(self, timeout: float) -> int:
+        """
+        停止接受新的執行，等待執行中的對話結束
+
+        Args:
+            timeout: 最多等待幾秒
+
+        Returns:
+            等待結束時仍在執行的對話數
+        """
+        self.draining = True
+        if self.in_flight:
+            print(f"⏳ 等待 {self.in_flight} 個執行中的對話結束（最多 {timeout:.0f} 秒）...")
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.in_flight
+
+    async def aclose(self):
+        """停止背景封存並關閉所有 workspace 後端（MCP 子程序）"""
+        if self._archiver is not None:
+            self._archiver.cancel()
+            await asyncio.gather(self._archiver, return_exceptions=True)
+            self._archiver = None
+        if self.workspaces is not None:
+            await self.workspaces.close()
+
+    async def _archive_idle_threads(self):
+        """定期封存閒置的對話歷史（server 沒有新對話時也會執行）"""
+        while True:
+            await asyncio.sleep(self.threads.sweep_interval)
+            self.threads.archive_idle()
+
+    def close(self):
+        """關閉 workspace 後端並停止同步 API 使用的常駐 event loop"""
+        if self._loop is not None:
+            self._run_sync(self.aclose())
+        with self._loop_lock:
+            loop, thread = self._loop, self._loop_thread
+            self._loop, self._loop_thread = None, None
+        if loop is None:
+            return
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    def _mcp_connection(self, root: str) -> dict:
+        """以 root 為根目錄的 MCP Filesystem Server 連線設定"""
+        return {
             "transport": "stdio",
             "command": "npx",
-            "args": ["-y", "@modelcontextprotocol/server-filesystem", os.getcwd()],
+            "args": ["-y", "@modelcontextprotocol/server-filesystem", root],
         }
 
-        tools = await load_mcp_tools(
-            session=None,
-            connection=connection,
-            server_name="filesystem"
-        )
-
-        # 修正工具 schema 以符合 OpenAI/LM Studio 格式
-        tools = self._fix_tool_schemas(tools)
-
-        return tools
+    async def _load_tools(self):
+        """啟動目前目錄的常駐 MCP 工具後端並預先編譯各 profile 的 graph，回傳修正後的工具"""
+        async with self.workspaces.acquire(self.default_workspace) as backend:
+            for profile in self.profiles.values():
+                self._variant(backend.variants, profile, backend.tools)
+            return backend.tools
 
     def _fix_tool_schemas(self, tools):
         """
@@ -267,7 +796,63 @@ class AgenticChatBot:
 
         return tools
 
-    async def achat(self, user_message: str, thread_id: str = "default") -> str:
+    @asynccontextmanager
+    async def _agent_for(self, workspace: Optional[str], profile: Optional[str] = None):
+        """取得指定 workspace 與 profile 的 Agent（None 表示預設的目前目錄與預設設定）"""
+        variant = self.get_profile(profile)
+        async with self.workspaces.acquire(workspace or self.default_workspace) as backend:
+            yield backend.agent if variant is None else self._variant(backend.variants, variant, backend.tools)
+
+    def _variant(self, cache: dict, profile: AgentProfile, tools: list):
+        """取得（必要時編譯）profile 在某組工具上的 graph"""
+        if profile.name not in cache:
+            cache[profile.name] = self._build_agent(tools, profile)
+        return cache[profile.name]
+
+    async def _prepare_input(self, user_message: str, thread_id: str, workspace: Optional[str],
+                             tenant: Optional[str], measure):
+        """取得要重播的對話歷史，以及附上相關長期記憶的使用者訊息"""
+        with measure("serialization"):
+            history = self.threads.to_messages(thread_id, last_turns=self.history_window)
+        if self.memory is None:
+            return history, HumanMessage(content=user_message)
+
+        with measure("memory"):
+            memories = await asyncio.to_thread(self.memory.recall, user_message, self._memory_scope(workspace, tenant))
+        if not memories:
+            return history, HumanMessage(content=user_message)
+        recalled = "\n".join(f"- {text}" for text in memories)
+        return history, HumanMessage(
+            content=f"相關的長期記憶（供參考，記錄後檔案內容可能已變更，需要時請重新讀取）：\n{recalled}\n\n使用者訊息：{user_message}"
+        )
+
+    async def _finish_turn(self, user_message: str, thread_id: str, workspace: Optional[str],
+                           tenant: Optional[str], new_messages: list, measure):
+        """保存這一輪對話（歷史中只保留原始的使用者訊息），並加入長期記憶"""
+        if new_messages and isinstance(new_messages[0], HumanMessage):
+            new_messages = [HumanMessage(content=user_message), *new_messages[1:]]
+        with measure("serialization"):
+            self.threads.append(thread_id, new_messages, tenant=tenant)
+        if self.memory is not None:
+            with measure("memory"):
+                await asyncio.to_thread(
+                    self.memory.remember_turn, thread_id, self._memory_scope(workspace, tenant), user_message, new_messages
+                )
+        return new_messages
+
+    def _memory_scope(self, workspace: Optional[str], tenant: Optional[str]) -> str:
+        """長期記憶的範圍（同一個租戶在同一個 workspace 的執行緒共用記憶）"""
+        return f"{tenant or 'default'}:{os.path.realpath(workspace or self.default_workspace)}"
+
+    async def achat(
+        self,
+        user_message: str,
+        thread_id: str = "default",
+        workspace: Optional[str] = None,
+        profiler: Optional[RunProfiler] = None,
+        profile: Optional[str] = None,
+        run: Optional[RunContext] = None
+    ) -> str:
         """
         與 Agent 對話（異步版本，支援多輪對話和記憶）
 
@@ -276,6 +861,10 @@ class AgenticChatBot:
         Args:
             user_message: 使用者訊息/意圖
             thread_id: 對話執行緒 ID（用於保持對話記憶）
+            workspace: 工具操作的 workspace 根目錄（需在允許清單中，None 表示目前目錄）
+            profiler: 記錄 LLM / 工具 / 序列化耗時的 RunProfiler（None 表示不記錄）
+            profile: 使用的具名 Agent 設定（None 表示預設設定）
+            run: 此次執行的 RunContext（呼叫端可在執行後讀取 token 用量等資訊，None 表示自動建立）
 
         Returns:
             Agent 的最終回應
@@ -283,22 +872,124 @@ class AgenticChatBot:
         if not self._initialized:
             raise RuntimeError("Agent not initialized. Call sync_init() or async_init() first.")
 
-        print(f"\n{'='*60}")
-        print(f"👤 使用者: {user_message}")
-        print(f"{'='*60}\n")
-        print("🤖 Agent 思考並執行中...\n")
+        with self._track_run():
+            print(f"\n{'='*60}")
+            print(f"👤 使用者: {user_message}")
+            print(f"{'='*60}\n")
+            print("🤖 Agent 思考並執行中...\n")
 
-        # 執行 ReAct 循環（異步）
-        config = {"configurable": {"thread_id": thread_id}}
+            # 執行 ReAct 循環（異步），帶入此執行緒先前的對話
+            config = {"configurable": {"thread_id": thread_id}}
+            if profiler is not None:
+                config["callbacks"] = [profiler]
+            measure = profiler.measure if profiler is not None else _no_measure
 
-        result = await self.agent.ainvoke(
-            {"messages": [HumanMessage(content=user_message)]},
-            config=config
-        )
+            run = run or RunContext(thread_id)
+            # 同一個執行緒的對話依序執行，讀取歷史到保存結果之間不會與其他請求交錯
+            async with self.threads.turn(thread_id):
+                history, message = await self._prepare_input(user_message, thread_id, workspace, run.tenant, measure)
+
+                with run_scope(run):
+                    async with self._agent_for(workspace, profile) as graph:
+                        result = await graph.ainvoke({"messages": history + [message]}, config=config)
+                new_messages = await self._finish_turn(
+                    user_message, thread_id, workspace, run.tenant, result["messages"][len(history):], measure
+                )
+
+            # 顯示執行過程
+            self._print_trace(new_messages)
 
-        # 顯示執行過程
+            # 取得最終回應
+            final_message = new_messages[-1].content
+
+            print(f"\n{'='*60}")
+            print(f"🤖 最終回答:\n{final_message}")
+            print(f"{'='*60}\n")
+
+            return final_message
+
+    async def astream(
+        self,
+        user_message: str,
+        thread_id: str = "default",
+        workspace: Optional[str] = None,
+        profile: Optional[str] = None,
+        tenant: Optional[str] = None
+    ):
+        """
+        與 Agent 對話（串流版本），邊執行邊產生事件
+
+        事件格式：
+        - {"type": "token", "content": ...}          模型輸出的文字片段
+        - {"type": "tool_start", "name": ..., "input": ...}
+        - {"type": "tool_end", "name": ..., "output": ...}
+        - {"type": "final", "content": ..., "usage": {...}}   最終回答與 token 用量（最後一個事件）
+
+        Args:
+            user_message: 使用者訊息/意圖
+            thread_id: 對話執行緒 ID（用於保持對話記憶）
+            workspace: 工具操作的 workspace 根目錄（需在允許清單中，None 表示目前目錄）
+            profile: 使用的具名 Agent 設定（None 表示預設設定）
+            tenant: 記錄 token 用量的租戶（也區分長期記憶的範圍）
+        """
+        if not self._initialized:
+            raise RuntimeError("Agent not initialized. Call sync_init() or async_init() first.")
+
+        with self._track_run():
+            print(f"\n{'='*60}")
+            print(f"👤 使用者 (串流): {user_message}")
+            print(f"{'='*60}\n")
+
+            config = {"configurable": {"thread_id": thread_id}}
+            async with self.threads.turn(thread_id):
+                history, message = await self._prepare_input(user_message, thread_id, workspace, tenant, _no_measure)
+                messages = []
+                run = RunContext(thread_id, tenant)
+                tokens = _TokenFilter([tool.name for tool in self.tools])
+
+                with run_scope(run):
+                    async with self._agent_for(workspace, profile) as graph:
+                        async for event in graph.astream_events(
+                            {"messages": history + [message]},
+                            config=config,
+                            version="v2"
+                        ):
+                            kind = event["event"]
+                            if kind == "on_chat_model_stream":
+                                if RETRY_TAG in event.get("tags", ()):
+                                    continue  # 會被捨棄的輸出或同一步的重做，不重複串流
+                                content = event["data"]["chunk"].content
+                                if isinstance(content, str) and content:
+                                    content = tokens.feed(event["run_id"], content)
+                                    if content:
+                                        yield {"type": "token", "content": content}
+                            elif kind == "on_chat_model_end":
+                                content = tokens.finish(event["run_id"])
+                                if content:
+                                    yield {"type": "token", "content": content}
+                            elif kind == "on_tool_start":
+                                yield {"type": "tool_start", "name": event["name"], "input": event["data"].get("input")}
+                            elif kind == "on_tool_end":
+                                output = event["data"].get("output")
+                                output = getattr(output, "content", output)
+                                yield {"type": "tool_end", "name": event["name"], "output": str(output)[:1000]}
+                            elif kind == "on_chain_end" and not event.get("parent_ids"):
+                                messages = event["data"]["output"]["messages"]
+
+                messages = await self._finish_turn(
+                    user_message, thread_id, workspace, tenant, messages[len(history):], _no_measure
+                )
+            self._print_trace(messages)
+            yield {
+                "type": "final",
+                "content": messages[-1].content if messages else "",
+                "usage": self.usage.report(run)
+            }
+
+    def _print_trace(self, messages: list):
+        """顯示 Agent 執行軌跡"""
         print("\n--- Agent 執行軌跡 ---")
-        for i, msg in enumerate(result["messages"]):
+        for i, msg in enumerate(messages):
             if isinstance(msg, HumanMessage):
                 print(f"  [{i}] 👤 使用者: {msg.content[:100]}...")
             elif isinstance(msg, AIMessage):
@@ -310,29 +1001,29 @@ class AgenticChatBot:
                 print(f"  [{i}] 📊 工具結果: {str(msg)[:100]}...")
         print("--- 執行完成 ---\n")
 
-        # 取得最終回應
-        final_message = result["messages"][-1].content
-
-        print(f"\n{'='*60}")
-        print(f"🤖 最終回答:\n{final_message}")
-        print(f"{'='*60}\n")
-
-        return final_message
-
-    def chat(self, user_message: str, thread_id: str = "default") -> str:
+    def chat(
+        self,
+        user_message: str,
+        thread_id: str = "default",
+        workspace: Optional[str] = None,
+        profile: Optional[str] = None
+    ) -> str:
         """
         與 Agent 對話（同步版本，支援多輪對話和記憶）
 
-        ⚠️ 注意：此方法在異步環境中會有問題，請使用 achat() 代替
+        在常駐 event loop 上執行，重複使用 sync_init() 建立的連線與資源，
+        可同時從多個執行緒呼叫。在 async 環境中請直接使用 achat()
 
         Args:
             user_message: 使用者訊息/意圖
             thread_id: 對話執行緒 ID（用於保持對話記憶）
+            workspace: 工具操作的 workspace 根目錄（需在允許清單中，None 表示目前目錄）
+            profile: 使用的具名 Agent 設定（None 表示預設設定）
 
         Returns:
             Agent 的最終回應
         """
-        return asyncio.run(self.achat(user_message, thread_id))
+        return self._run_sync(self.achat(user_message, thread_id, workspace, profile=profile))
 
 
 if __name__ == "__main__":
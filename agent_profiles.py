@@ -0,0 +1,90 @@
+"""
+Agent Profiles - 具名的 Agent 設定（模型、取樣參數、系統提示、工具子集、後端）
+
+同一個 server process 可以同時提供多種 Agent 設定，請求以 profile 名稱選擇；
+每個 profile 的 graph 只編譯一次並快取，不必每次請求重新建立模型與載入工具。
+
+設定檔格式（JSON）：
+{
+  "coder": {"model": "qwen2.5-coder-14b", "temperature": 0.2, "system_prompt": "..."},
+  "reader": {"temperature": 0.0, "tools": ["read_text_file", "list_directory", "search_files"]},
+  "remote": {"base_url": "http://gpu-box:1234/v1", "model": "gpt-oss-120b", "max_tokens": 2048}
+}
+"""
+
+import json
+from typing import Dict, List, Optional
+
+
+class UnknownProfile(ValueError):
+    """要求的 profile 不存在"""
+
+
+class AgentProfile:
+    """單一 Agent 設定（未指定的欄位沿用 server 預設值）"""
+
+    def __init__(
+        self,
+        name: str,
+        model: Optional[str] = None,
+        base_url: Optional[str] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        system_prompt: Optional[str] = None,
+        tools: Optional[List[str]] = None,
+    ):
+        """
+        Args:
+            name: profile 名稱
+            model: 模型名稱
+            base_url: OpenAI 相容 API endpoint（例如另一台 LM Studio）
+            temperature: 取樣溫度
+            top_p: nucleus sampling 參數
+            max_tokens: 單次回應的 token 上限
+            system_prompt: 系統提示
+            tools: 可使用的工具名稱（None 表示全部工具）
+        """
+        self.name = name
+        self.model = model
+        self.base_url = base_url
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_tokens = max_tokens
+        self.system_prompt = system_prompt
+        self.tools = tools
+
+    @classmethod
+    def from_dict(cls, name: str, data: dict) -> "AgentProfile":
+        keys = ("model", "base_url", "temperature", "top_p", "max_tokens", "system_prompt", "tools")
+        return cls(name, **{k: data[k] for k in keys if k in data})
+
+    def sampling(self) -> dict:
+        """有設定的取樣參數"""
+        params = {"temperature": self.temperature, "top_p": self.top_p, "max_tokens": self.max_tokens}
+        return {k: v for k, v in params.items() if v is not None}
+
+    def select_tools(self, tools: list) -> list:
+        """依 profile 的工具清單篩選工具"""
+        if self.tools is None:
+            return tools
+        allowed = set(self.tools)
+        return [tool for tool in tools if tool.name in allowed]
+
+    def describe(self) -> dict:
+        return {
+            "model": self.model,
+            "base_url": self.base_url,
+            **self.sampling(),
+            "custom_prompt": self.system_prompt is not None,
+            "tools": self.tools,
+        }
+
+
+def load_profiles(path: Optional[str]) -> Dict[str, AgentProfile]:
+    """讀取 profile 設定檔（未指定時回傳空的 registry）"""
+    if not path:
+        return {}
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    return {name: AgentProfile.from_dict(name, data) for name, data in config.items()}
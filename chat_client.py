@@ -78,6 +78,7 @@ class TerminalChatClient:
         try:
             print("正在連接 LM Studio 並初始化 Agent...\n")
             self.agent = AgenticChatBot()
+            self.agent.sync_init()
         except Exception as e:
             print(f"\n❌ 初始化失敗: {e}")
             print("\n請確認:")
@@ -133,6 +134,9 @@ class TerminalChatClient:
                 print("\n\n👋 再見！\n")
                 break
 
+        # 停止 Agent 的常駐 event loop
+        self.agent.close()
+
 
 if __name__ == "__main__":
     client = TerminalChatClient()
@@ -2,37 +2,101 @@
 """
 Remote Client for LangGraph Agentic AI Server
 透過 HTTP API 連接到遠端的 Agent Server
+
+- RemoteAgentClient / InteractiveCLI：互動式命令列使用
+- AsyncRemoteAgentClient：非同步、共用連線池，回傳 ChatResult，適合在同一個 process 中同時驅動大量對話
 """
 
+import asyncio
 import httpx
+import json
+import random
 import sys
+import time
 import uuid
-from typing import Optional
+from typing import Iterable, List, Optional, Sequence, Union
+
+import wire
+
+try:
+    from websockets.sync.client import connect as ws_connect
+except ImportError:  # 未安裝 websockets 時退回 HTTP 模式
+    ws_connect = None
+
+try:
+    import h2
+except ImportError:  # 未安裝 h2 時 AsyncRemoteAgentClient 使用 HTTP/1.1
+    h2 = None
+
+# 請求確定沒有送出的錯誤（任何 method 都可以安全重試）
+_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# 重送不會重複產生副作用的 method
+_IDEMPOTENT_METHODS = ("GET", "HEAD", "DELETE")
 
 
 class RemoteAgentClient:
     """遠端 Agent 客戶端"""
 
-    def __init__(self, server_url: str = "http://localhost:8011"):
+    def __init__(
+        self,
+        server_url: str = "http://localhost:8011",
+        max_reconnects: int = 8,
+        backoff_base: float = 0.5,
+        backoff_cap: float = 15.0,
+        binary: bool = True
+    ):
         """
         初始化遠端客戶端
 
         Args:
             server_url: Agent Server 的 URL
+            max_reconnects: 事件串流連續斷線時最多重新連線幾次
+            backoff_base: 重新連線的基本等待秒數（指數退避）
+            backoff_cap: 重新連線的最長等待秒數
+            binary: 有安裝 ormsgpack / msgpack 時要求 MessagePack 回應（較小、解碼較快）
         """
         self.server_url = server_url.rstrip('/')
         self.thread_id = str(uuid.uuid4())[:8]
-        self.client = httpx.Client(timeout=300.0)  # 5 分鐘 timeout
+        # httpx 預設送出 Accept-Encoding: gzip, deflate（有安裝 zstandard 時含 zstd）並自動解壓縮
+        headers = {}
+        if binary and wire.MSGPACK_AVAILABLE:
+            headers["Accept"] = f"{wire.MSGPACK_MEDIA_TYPE}, {wire.JSON_MEDIA_TYPE};q=0.9"
+        self.client = httpx.Client(timeout=300.0, headers=headers)  # 5 分鐘 timeout
+        self.max_reconnects = max_reconnects
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+    @staticmethod
+    def _decode(response: httpx.Response):
+        """依 Content-Type 解碼回應（MessagePack 或 JSON）"""
+        if response.headers.get("content-type", "").startswith(wire.MSGPACK_MEDIA_TYPE):
+            return wire.unpackb(response.content)
+        return wire.loads_json(response.content)
+
+    def check_health(self, wait_ready: float = 180.0) -> bool:
+        """
+        檢查伺服器健康狀態
 
-    def check_health(self) -> bool:
-        """檢查伺服器健康狀態"""
+        server 初始化與預熱 LLM 期間 /health 回傳附 Retry-After 的 503，
+        此時最多等待 wait_ready 秒直到就緒（關閉中的 503 不附 Retry-After，直接視為失敗）
+        """
+        deadline = time.monotonic() + wait_ready
+        waiting = False
         try:
-            response = self.client.get(f"{self.server_url}/health")
-            response.raise_for_status()
-            data = response.json()
-            print(f"✅ 伺服器狀態: {data['status']}")
-            print(f"🔧 可用工具數: {data['tools']}")
-            return True
+            while True:
+                response = self.client.get(f"{self.server_url}/health")
+                retry_after = response.headers.get("retry-after")
+                if response.status_code == 503 and retry_after and time.monotonic() < deadline:
+                    if not waiting:
+                        print(f"⏳ 伺服器預熱中（{self._decode(response).get('detail')}），等待就緒...")
+                        waiting = True
+                    time.sleep(float(retry_after) if retry_after.isdigit() else self.backoff_base)
+                    continue
+                response.raise_for_status()
+                data = self._decode(response)
+                print(f"✅ 伺服器狀態: {data['status']}")
+                print(f"🔧 可用工具數: {data['tools']}")
+                return True
         except Exception as e:
             print(f"❌ 無法連接伺服器: {e}")
             return False
@@ -42,7 +106,7 @@ class RemoteAgentClient:
         try:
             response = self.client.get(f"{self.server_url}/status")
             response.raise_for_status()
-            return response.json()
+            return self._decode(response)
         except Exception as e:
             print(f"❌ 取得狀態失敗: {e}")
             return None
@@ -52,7 +116,7 @@ class RemoteAgentClient:
         try:
             response = self.client.get(f"{self.server_url}/tools")
             response.raise_for_status()
-            data = response.json()
+            data = self._decode(response)
             return data['tools']
         except Exception as e:
             print(f"❌ 取得工具列表失敗: {e}")
@@ -74,8 +138,9 @@ class RemoteAgentClient:
             print(f"{'='*60}\n")
             print("🤖 Agent 處理中...\n")
 
+            # 在背景啟動執行，再以可續傳的事件串流接收結果
             response = self.client.post(
-                f"{self.server_url}/chat",
+                f"{self.server_url}/runs",
                 json={
                     "message": message,
                     "thread_id": self.thread_id,
@@ -84,13 +149,17 @@ class RemoteAgentClient:
             )
             response.raise_for_status()
 
-            data = response.json()
-            agent_response = data['response']
+            data = self._follow_run(self._decode(response)['run_id'])
+            if data is None:
+                return None
+            agent_response = data['content']
 
             print(f"\n{'='*60}")
             print(f"🤖 Agent:\n{agent_response}")
             print(f"{'='*60}\n")
             print(f"📊 對話訊息數: {data['message_count']}")
+            if data.get("usage"):
+                print(f"🪙 Token 用量: {data['usage']['total_tokens']}（執行緒累計 {data['usage']['thread_total_tokens']}）")
 
             return agent_response
 
@@ -102,6 +171,71 @@ class RemoteAgentClient:
             print(f"❌ 請求失敗: {e}")
             return None
 
+    def _follow_run(self, run_id: str) -> Optional[dict]:
+        """
+        接收執行事件直到結束；連線中斷時帶 Last-Event-ID 自動重新連線
+
+        Returns:
+            final 事件（取消或失敗時回傳 None）
+        """
+        last_event_id = 0
+        failures = 0
+
+        while True:
+            headers = {"Last-Event-ID": str(last_event_id)} if last_event_id else {}
+            try:
+                with self.client.stream(
+                    "GET",
+                    f"{self.server_url}/runs/{run_id}/events",
+                    headers=headers,
+                    timeout=httpx.Timeout(30.0, read=60.0)
+                ) as response:
+                    response.raise_for_status()
+                    for event_id, event in self._iter_sse(response):
+                        failures = 0
+                        last_event_id = event_id
+                        kind = event.get("type")
+
+                        if kind == "tool_start":
+                            print(f"🔧 呼叫工具: {event['name']}")
+                        elif kind == "gap":
+                            print(f"⚠️  漏失 {event['missed']} 個事件（已超出伺服器緩衝）")
+                        elif kind == "final":
+                            return event
+                        elif kind == "cancelled":
+                            print("⏹️  執行已取消")
+                            return None
+                        elif kind == "error":
+                            print(f"❌ Agent 錯誤: {event['detail']}")
+                            return None
+            except httpx.TransportError as e:
+                print(f"⚠️  事件串流中斷: {e}")
+
+            # 串流在結束前中斷 → 以帶抖動的指數退避重新連線
+            failures += 1
+            if failures > self.max_reconnects:
+                print(f"❌ 重新連線失敗 {self.max_reconnects} 次，放棄")
+                return None
+            delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** failures))
+            print(f"🔄 {delay:.1f} 秒後重新連線（從事件 #{last_event_id} 之後繼續）...")
+            time.sleep(delay)
+
+    @staticmethod
+    def _iter_sse(response: httpx.Response):
+        """解析 Server-Sent Events，產生 (event_id, event)"""
+        event_id, data_lines = None, []
+        for line in response.iter_lines():
+            if not line:
+                if data_lines:
+                    yield int(event_id or 0), wire.loads_json("\n".join(data_lines))
+                event_id, data_lines = None, []
+            elif line.startswith(":"):
+                continue
+            elif line.startswith("id:"):
+                event_id = line[3:].strip()
+            elif line.startswith("data:"):
+                data_lines.append(line[5:].strip())
+
     def get_conversation_history(self) -> Optional[list]:
         """取得當前對話歷史"""
         try:
@@ -109,7 +243,7 @@ class RemoteAgentClient:
                 f"{self.server_url}/conversations/{self.thread_id}"
             )
             response.raise_for_status()
-            return response.json()['messages']
+            return self._decode(response)['messages']
         except httpx.HTTPStatusError:
             return []
         except Exception as e:
@@ -135,11 +269,412 @@ class RemoteAgentClient:
         self.client.close()
 
 
+class ChatResult:
+    """一輪對話的結果（失敗時 error 不為 None）"""
+
+    __slots__ = ("thread_id", "message", "content", "message_count", "usage", "error", "status_code", "elapsed")
+
+    def __init__(
+        self,
+        thread_id: str,
+        message: str,
+        content: Optional[str] = None,
+        message_count: int = 0,
+        usage: Optional[dict] = None,
+        error: Optional[str] = None,
+        status_code: Optional[int] = None,
+        elapsed: float = 0.0
+    ):
+        self.thread_id = thread_id
+        self.message = message
+        self.content = content
+        self.message_count = message_count
+        self.usage = usage or {}
+        self.error = error
+        self.status_code = status_code
+        self.elapsed = elapsed
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self) -> str:
+        status = "ok" if self.ok else f"error={self.error!r}"
+        return f"ChatResult(thread_id={self.thread_id!r}, {status}, elapsed={self.elapsed:.2f}s)"
+
+
+class AsyncAgentSession:
+    """AsyncRemoteAgentClient 上的單一對話（擁有自己的 thread_id）"""
+
+    def __init__(self, client: "AsyncRemoteAgentClient", thread_id: str, workspace: Optional[str] = None,
+                 profile: Optional[str] = None):
+        self.client = client
+        self.thread_id = thread_id
+        self.workspace = workspace
+        self.profile = profile
+
+    async def chat(self, message: str) -> ChatResult:
+        return await self.client.chat(message, self.thread_id, workspace=self.workspace, profile=self.profile)
+
+    async def history(self) -> Optional[list]:
+        return await self.client.get_history(self.thread_id)
+
+    async def clear(self) -> bool:
+        return await self.client.clear(self.thread_id)
+
+
+class AsyncRemoteAgentClient:
+    """
+    非同步的遠端 Agent 客戶端（共用連線池，不輸出到 stdout）
+
+    一個實例可以同時驅動大量對話：每個 session 有自己的 thread_id，
+    呼叫回傳 ChatResult 而不是印出結果，fan_out / run_conversations 以固定的並行數批次執行
+
+    用法：
+        async with AsyncRemoteAgentClient("http://agent:8011", max_connections=200) as client:
+            results = await client.fan_out(["分析 a.py", "分析 b.py"], concurrency=50)
+    """
+
+    def __init__(
+        self,
+        server_url: str = "http://localhost:8011",
+        max_connections: int = 100,
+        max_keepalive_connections: int = 100,
+        keepalive_expiry: float = 30.0,
+        http2: bool = False,
+        timeout: float = 300.0,
+        binary: bool = True,
+        api_key: Optional[str] = None,
+        tenant_id: Optional[str] = None,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_cap: float = 15.0
+    ):
+        """
+        Args:
+            server_url: Agent Server 的 URL
+            max_connections: 連線池的連線數上限
+            max_keepalive_connections: 閒置時保留的連線數（高並行時設成與 max_connections 相同，避免反覆建立連線）
+            keepalive_expiry: 閒置連線保留的秒數
+            http2: 使用 HTTP/2 在少數連線上多工（需 pip install httpx[http2]，未安裝時使用 HTTP/1.1）
+            timeout: 單一請求的逾時秒數（Agent 執行可能很久）
+            binary: 有安裝 ormsgpack / msgpack 時要求 MessagePack 回應
+            api_key: 送出的 X-API-Key（決定租戶與排程權重）
+            tenant_id: 送出的 X-Tenant-ID
+            max_retries: server 在執行前拒絕（429 / 503）或連線失敗時最多重試幾次
+            backoff_base: 重試的基本等待秒數（指數退避，有 Retry-After 時依其指示）
+            backoff_cap: 重試的最長等待秒數
+        """
+        self.server_url = server_url.rstrip('/')
+        self.http2 = http2 and h2 is not None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+        headers = {}
+        if binary and wire.MSGPACK_AVAILABLE:
+            headers["Accept"] = f"{wire.MSGPACK_MEDIA_TYPE}, {wire.JSON_MEDIA_TYPE};q=0.9"
+        if api_key:
+            headers["X-API-Key"] = api_key
+        if tenant_id:
+            headers["X-Tenant-ID"] = tenant_id
+        self.client = httpx.AsyncClient(
+            base_url=self.server_url,
+            headers=headers,
+            http2=self.http2,
+            timeout=httpx.Timeout(timeout, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry
+            )
+        )
+
+    async def __aenter__(self) -> "AsyncRemoteAgentClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        """關閉連線池"""
+        await self.client.aclose()
+
+    def session(self, thread_id: Optional[str] = None, workspace: Optional[str] = None,
+                profile: Optional[str] = None) -> AsyncAgentSession:
+        """建立一個對話 session（未指定 thread_id 時產生新的）"""
+        return AsyncAgentSession(self, thread_id or uuid.uuid4().hex, workspace, profile)
+
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """
+        送出請求，只重試確定沒有被執行的請求
+
+        - 連線失敗（ConnectError / ConnectTimeout / PoolTimeout）：請求沒有送出，一律重試
+        - 其他傳輸錯誤（ReadTimeout、連線中斷等）：請求可能已在 server 執行，只重試冪等的 GET / DELETE
+        - 429 / 503：server 在執行前拒絕，依 Retry-After 或指數退避重試；
+          帶有 X-Run-Started 的 503 表示執行中途失敗，不重試
+        """
+        attempt = 0
+        while True:
+            try:
+                response = await self.client.request(method, path, **kwargs)
+                if (response.status_code not in (429, 503) or response.headers.get("x-run-started")
+                        or attempt >= self.max_retries):
+                    return response
+                retry_after = response.headers.get("retry-after")
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else None
+            except httpx.TransportError as e:
+                if attempt >= self.max_retries:
+                    raise
+                if not isinstance(e, _NOT_SENT_ERRORS) and method not in _IDEMPOTENT_METHODS:
+                    raise
+                delay = None
+            attempt += 1
+            if delay is None:
+                delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+            await asyncio.sleep(min(delay, self.backoff_cap))
+
+    async def chat(
+        self,
+        message: str,
+        thread_id: Optional[str] = None,
+        workspace: Optional[str] = None,
+        profile: Optional[str] = None
+    ) -> ChatResult:
+        """
+        送出一輪對話（不會拋出例外，失敗時回傳 error 不為 None 的 ChatResult）
+
+        Args:
+            message: 使用者訊息/意圖
+            thread_id: 對話執行緒 ID（None 表示新的對話）
+            workspace: 工具操作的 workspace 根目錄
+            profile: 具名 Agent 設定
+        """
+        thread_id = thread_id or uuid.uuid4().hex
+        payload = {"message": message, "thread_id": thread_id}
+        if workspace is not None:
+            payload["workspace"] = workspace
+        if profile is not None:
+            payload["profile"] = profile
+
+        started = time.perf_counter()
+        try:
+            response = await self._request("POST", "/chat", json=payload)
+        except httpx.HTTPError as e:
+            return ChatResult(thread_id, message, error=f"{type(e).__name__}: {e}",
+                              elapsed=time.perf_counter() - started)
+        elapsed = time.perf_counter() - started
+
+        if response.status_code != 200:
+            return ChatResult(thread_id, message, error=response.text, status_code=response.status_code,
+                              elapsed=elapsed)
+        data = RemoteAgentClient._decode(response)
+        return ChatResult(
+            thread_id,
+            message,
+            content=data["response"],
+            message_count=data["message_count"],
+            usage=data.get("usage"),
+            status_code=200,
+            elapsed=elapsed
+        )
+
+    async def get_history(self, thread_id: str) -> Optional[list]:
+        """取得對話歷史（執行緒不存在時回傳 None）"""
+        response = await self._request("GET", f"/conversations/{thread_id}")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return RemoteAgentClient._decode(response)["messages"]
+
+    async def clear(self, thread_id: str) -> bool:
+        """清除對話歷史"""
+        response = await self._request("DELETE", f"/conversations/{thread_id}")
+        return response.status_code == 200
+
+    async def health(self) -> bool:
+        """伺服器是否可以接受請求（預熱完成、未在關閉中）"""
+        try:
+            response = await self.client.get("/health")
+        except httpx.HTTPError:
+            return False
+        return response.status_code == 200
+
+    async def status(self) -> dict:
+        """取得伺服器詳細狀態"""
+        response = await self._request("GET", "/status")
+        response.raise_for_status()
+        return RemoteAgentClient._decode(response)
+
+    @staticmethod
+    async def _bounded(items: Iterable, worker, concurrency: int) -> list:
+        """以 concurrency 個 worker 依序取出 items 執行，結果依輸入順序回傳"""
+        items = list(items)
+        results: list = [None] * len(items)
+        next_index = iter(range(len(items)))
+
+        async def run():
+            for i in next_index:
+                results[i] = await worker(items[i])
+
+        await asyncio.gather(*(run() for _ in range(max(1, min(concurrency, len(items))))))
+        return results
+
+    async def fan_out(self, messages: Iterable[Union[str, dict]], concurrency: int = 16) -> List[ChatResult]:
+        """
+        並行送出多個獨立的請求（最多同時 concurrency 個），結果依輸入順序回傳
+
+        Args:
+            messages: 訊息字串（各自開新的對話），或傳給 chat() 的參數 dict
+                      （例如 {"message": ..., "thread_id": ..., "profile": ...}）
+            concurrency: 同時進行的請求數上限
+        """
+        async def worker(item):
+            return await (self.chat(item) if isinstance(item, str) else self.chat(**item))
+        return await self._bounded(messages, worker, concurrency)
+
+    async def run_conversations(
+        self,
+        conversations: Iterable[Sequence[str]],
+        concurrency: int = 16,
+        workspace: Optional[str] = None,
+        profile: Optional[str] = None
+    ) -> List[List[ChatResult]]:
+        """
+        並行執行多段多輪對話：每段對話在自己的 session 中依序送出，最多同時進行 concurrency 段
+
+        某一輪失敗時該段對話停止，回傳已完成的結果（最後一筆為失敗的結果）
+        """
+        async def worker(turns):
+            session = self.session(workspace=workspace, profile=profile)
+            results = []
+            for message in turns:
+                result = await session.chat(message)
+                results.append(result)
+                if not result.ok:
+                    break
+            return results
+        return await self._bounded(conversations, worker, concurrency)
+
+
+class WebSocketChatSession:
+    """
+    持久的 WebSocket 對話 session
+
+    整個互動過程只建立一條連線，串流顯示 token 與工具事件，
+    對話中按 Ctrl+C 可立即取消目前的執行
+    """
+
+    def __init__(self, server_url: str = "http://localhost:8011"):
+        """
+        Args:
+            server_url: Agent Server 的 URL（http/https 會轉成 ws/wss）
+        """
+        base = server_url.rstrip('/')
+        if base.startswith("https://"):
+            base = "wss://" + base[len("https://"):]
+        elif base.startswith("http://"):
+            base = "ws://" + base[len("http://"):]
+        self.ws_url = f"{base}/ws"
+        self.ws = None
+
+    def connect(self) -> bool:
+        """建立 WebSocket 連線"""
+        if ws_connect is None:
+            return False
+        try:
+            self.ws = ws_connect(self.ws_url, open_timeout=10)
+            self._recv()  # ready
+            return True
+        except Exception as e:
+            print(f"⚠️  WebSocket 連線失敗，改用 HTTP: {e}")
+            self.ws = None
+            return False
+
+    def _recv(self) -> dict:
+        """讀取下一個事件（略過心跳）"""
+        while True:
+            event = json.loads(self.ws.recv())
+            if event.get("type") not in ("heartbeat", "pong"):
+                return event
+
+    def chat(self, message: str, thread_id: str) -> Optional[str]:
+        """
+        透過 WebSocket 與 Agent 對話（串流顯示）
+
+        Args:
+            message: 使用者訊息/意圖
+            thread_id: 對話執行緒 ID
+
+        Returns:
+            Agent 的最終回應（取消或失敗時回傳 None）
+        """
+        print(f"\n{'='*60}")
+        print(f"👤 你: {message}")
+        print(f"{'='*60}\n")
+        print("🤖 Agent 處理中...（Ctrl+C 取消）\n")
+
+        self.ws.send(json.dumps({"type": "chat", "message": message, "thread_id": thread_id}))
+        try:
+            return self._stream_events()
+        except KeyboardInterrupt:
+            print("\n\n⏹️  取消中...")
+            self.ws.send(json.dumps({"type": "cancel"}))
+            return self._stream_events(quiet=True)
+
+    def _stream_events(self, quiet: bool = False) -> Optional[str]:
+        """持續讀取事件直到這一輪結束"""
+        while True:
+            event = self._recv()
+            kind = event.get("type")
+
+            if kind == "token" and not quiet:
+                print(event["content"], end="", flush=True)
+
+            elif kind == "tool_start" and not quiet:
+                print(f"\n🔧 呼叫工具: {event['name']}", flush=True)
+
+            elif kind == "tool_end" and not quiet:
+                print(f"📊 工具結果: {event['output'][:100]}...", flush=True)
+
+            elif kind == "final":
+                print(f"\n\n{'='*60}")
+                print(f"🤖 Agent:\n{event['content']}")
+                print(f"{'='*60}\n")
+                print(f"📊 對話訊息數: {event['message_count']}")
+                if event.get("usage"):
+                    print(f"🪙 Token 用量: {event['usage']['total_tokens']}（執行緒累計 {event['usage']['thread_total_tokens']}）")
+                return event["content"]
+
+            elif kind == "cancelled":
+                print("⏹️  已取消本次執行\n")
+                return None
+
+            elif kind == "error":
+                print(f"\n❌ Agent 錯誤: {event['detail']}")
+                return None
+
+    def close(self):
+        """關閉 WebSocket 連線"""
+        if self.ws is not None:
+            self.ws.close()
+            self.ws = None
+
+
 class InteractiveCLI:
     """互動式命令列介面"""
 
-    def __init__(self, server_url: str = "http://localhost:8011"):
+    def __init__(self, server_url: str = "http://localhost:8011", use_websocket: bool = True):
+        """
+        Args:
+            server_url: Agent Server 的 URL
+            use_websocket: 是否使用持久 WebSocket session（連線失敗時退回 HTTP）
+        """
         self.client = RemoteAgentClient(server_url)
+        self.session = WebSocketChatSession(server_url) if use_websocket else None
 
     def print_welcome(self):
         """顯示歡迎訊息"""
@@ -217,6 +752,12 @@ class InteractiveCLI:
             print("  2. Server 位址正確")
             return
 
+        # 建立持久 WebSocket session
+        if self.session and self.session.connect():
+            print("🔌 已建立 WebSocket session（串流模式）")
+        else:
+            self.session = None
+
         print()
 
         # 主對話迴圈
@@ -257,6 +798,13 @@ class InteractiveCLI:
                     continue
 
                 # 一般對話
+                if self.session:
+                    try:
+                        self.session.chat(user_input, self.client.thread_id)
+                        continue
+                    except Exception as e:
+                        print(f"\n⚠️  WebSocket 中斷，改用 HTTP: {e}")
+                        self.session = None
                 self.client.chat(user_input)
 
             except KeyboardInterrupt:
@@ -268,6 +816,8 @@ class InteractiveCLI:
                 break
 
         # 清理
+        if self.session:
+            self.session.close()
         self.client.close()
 
 
@@ -0,0 +1,287 @@
+"""
+Long-Term Memory - 本地向量索引的長期記憶
+
+把過去的對話與工具查到的事實嵌入成向量，存在以 NumPy memmap 持久化的索引中；
+每次請求只取出與問題最相關的 top-k 則記憶放進 prompt，
+長對話只需重播最近幾輪，其他執行緒在同一個 workspace 學到的事實也能被想起。
+
+- 嵌入模型：有安裝 sentence-transformers 時使用本地 CPU 模型，否則使用 hashing 特徵（不需下載模型）
+- 索引：float32 memmap（vectors.f32）+ JSONL 中繼資料（memories.jsonl），分批計算 cosine 相似度
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain_core.messages import AIMessage, BaseMessage, ToolMessage
+
+from tool_selector import tokenize
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # 未安裝時使用 hashing 嵌入
+    SentenceTransformer = None
+
+
+class HashingEmbedder:
+    """以 feature hashing 把斷詞結果映射到固定維度（不需要模型，適合 CPU）"""
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in tokenize(text):
+                h = zlib.crc32(token.encode("utf-8"))
+                vectors[row, h % self.dim] += 1.0 if (h >> 16) & 1 else -1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-8)
+
+
+class SentenceTransformerEmbedder:
+    """本地 sentence-transformers 模型（在 CPU 上執行）"""
+
+    def __init__(self, model_name: str):
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = model_name
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(texts, batch_size=32, normalize_embeddings=True).astype(np.float32)
+
+
+def make_embedder(model_name: Optional[str] = None):
+    """建立嵌入模型：指定模型且已安裝 sentence-transformers 時使用它，否則使用 hashing"""
+    if model_name and SentenceTransformer is not None:
+        return SentenceTransformerEmbedder(model_name)
+    if model_name:
+        print(f"⚠️ 未安裝 sentence-transformers，長期記憶改用 hashing 嵌入（忽略 {model_name}）")
+    return HashingEmbedder()
+
+
+class VectorIndex:
+    """以 memmap 持久化的 float32 向量索引（path 為 None 時只存在記憶體中）"""
+
+    def __init__(self, dim: int, path: Optional[str] = None, initial_capacity: int = 1024):
+        self.dim = dim
+        self.path = path
+        self.count = 0
+        self.metadata: List[dict] = []
+        self._vectors_file = os.path.join(path, "vectors.f32") if path else None
+        self._metadata_file = os.path.join(path, "memories.jsonl") if path else None
+
+        if path:
+            os.makedirs(path, exist_ok=True)
+            info_file = os.path.join(path, "index.json")
+            if os.path.exists(info_file):
+                with open(info_file, encoding="utf-8") as f:
+                    stored_dim = json.load(f)["dim"]
+                if stored_dim != dim:
+                    raise ValueError(f"Memory index at {path} was built with dim {stored_dim}, embedder has dim {dim}")
+            else:
+                with open(info_file, "w", encoding="utf-8") as f:
+                    json.dump({"dim": dim}, f)
+            if os.path.exists(self._metadata_file):
+                with open(self._metadata_file, encoding="utf-8") as f:
+                    self.metadata = [json.loads(line) for line in f if line.strip()]
+                self.count = len(self.metadata)
+        capacity = max(initial_capacity, self.count)
+        if path and os.path.exists(self._vectors_file):
+            capacity = max(capacity, os.path.getsize(self._vectors_file) // (4 * dim))
+        self.vectors = self._allocate(capacity)
+
+    def _allocate(self, capacity: int) -> np.ndarray:
+        if not self._vectors_file:
+            grown = np.zeros((capacity, self.dim), dtype=np.float32)
+            if getattr(self, "vectors", None) is not None:
+                grown[:self.count] = self.vectors[:self.count]
+            return grown
+
+        mode = "r+" if os.path.exists(self._vectors_file) else "w+"
+        if mode == "r+" and os.path.getsize(self._vectors_file) < capacity * self.dim * 4:
+            if getattr(self, "vectors", None) is not None:
+                self.vectors.flush()
+                del self.vectors
+            with open(self._vectors_file, "r+b") as f:
+                f.truncate(capacity * self.dim * 4)
+        return np.memmap(self._vectors_file, dtype=np.float32, mode=mode, shape=(capacity, self.dim))
+
+    def add(self, vectors: np.ndarray, metadata: List[dict]):
+        """加入向量與對應的中繼資料"""
+        needed = self.count + len(vectors)
+        if needed > len(self.vectors):
+            self.vectors = self._allocate(max(needed, len(self.vectors) * 2))
+        self.vectors[self.count:needed] = vectors
+        if self._vectors_file:
+            self.vectors.flush()
+            with open(self._metadata_file, "a", encoding="utf-8") as f:
+                for item in metadata:
+                    f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        self.metadata.extend(metadata)
+        self.count = needed
+
+    def search(self, query: np.ndarray, top_k: int, mask: Optional[np.ndarray] = None,
+               batch_size: int = 65536) -> List[tuple]:
+        """
+        分批計算 cosine 相似度（向量已正規化，即內積），回傳 [(index, score)]
+
+        Args:
+            query: 已正規化的查詢向量
+            top_k: 回傳幾筆
+            mask: 哪些向量可以被選中（長度為 count 的 bool 陣列）
+            batch_size: 每批計算的向量數（限制暫存記憶體）
+        """
+        best_idx = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for start in range(0, self.count, batch_size):
+            end = min(self.count, start + batch_size)
+            scores = self.vectors[start:end] @ query
+            if mask is not None:
+                scores = np.where(mask[start:end], scores, -np.inf)
+            k = min(top_k, end - start)
+            local = np.argpartition(-scores, k - 1)[:k]
+            best_idx = np.concatenate([best_idx, local + start])
+            best_scores = np.concatenate([best_scores, scores[local]])
+            if len(best_idx) > top_k:
+                keep = np.argpartition(-best_scores, top_k - 1)[:top_k]
+                best_idx, best_scores = best_idx[keep], best_scores[keep]
+
+        order = np.argsort(-best_scores)
+        return [(int(best_idx[i]), float(best_scores[i])) for i in order if np.isfinite(best_scores[i])]
+
+
+def _text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    return " ".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in content)
+
+
+class LongTermMemory:
+    """
+    對話與工具結果的長期記憶（可在多個執行緒間共用，依 scope 區分範圍，例如租戶與 workspace）
+
+    取出的記憶附上記錄時間，讓模型知道檔案內容等事實可能已經過時
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        embedder=None,
+        top_k: int = 4,
+        min_score: float = 0.2,
+        max_chars: int = 600,
+        remember_tools: Optional[List[str]] = None,
+    ):
+        """
+        Args:
+            path: 索引存放目錄（None 表示只存在記憶體中）
+            embedder: 嵌入模型（預設為 HashingEmbedder）
+            top_k: 每次請求最多取出幾則記憶
+            min_score: 相似度低於此值的記憶不使用
+            max_chars: 每則記憶保留的最大字數
+            remember_tools: 結果要記住的工具名稱（None 表示全部工具）
+        """
+        self.embedder = embedder or HashingEmbedder()
+        self.index = VectorIndex(self.embedder.dim, path)
+        self.top_k = top_k
+        self.min_score = min_score
+        self.max_chars = max_chars
+        self.remember_tools = set(remember_tools) if remember_tools is not None else None
+        self.recalls = 0
+        self.recall_seconds = 0.0
+        self._lock = threading.Lock()
+        self._seen = {self._digest(m["scope"], m["text"]) for m in self.index.metadata}
+        self._scope_codes: Dict[str, int] = {}
+        self._scopes = np.array([self._scope_code(m["scope"]) for m in self.index.metadata], dtype=np.int32)
+
+    @staticmethod
+    def _digest(scope: str, text: str) -> str:
+        return hashlib.blake2b(f"{scope}\0{text}".encode("utf-8"), digest_size=16).hexdigest()
+
+    def _scope_code(self, scope: str) -> int:
+        return self._scope_codes.setdefault(scope, len(self._scope_codes))
+
+    def _memories_from_turn(self, user_message: str, messages: List[BaseMessage]) -> List[tuple]:
+        """從一輪對話整理出要記住的內容 [(kind, text)]"""
+        memories = []
+        calls = {}
+        for msg in messages:
+            if isinstance(msg, AIMessage):
+                for call in msg.tool_calls:
+                    calls[call["id"]] = call
+            elif isinstance(msg, ToolMessage):
+                call = calls.get(msg.tool_call_id)
+                name = msg.name or (call["name"] if call else "tool")
+                if self.remember_tools is not None and name not in self.remember_tools:
+                    continue
+                args = json.dumps(call["args"], ensure_ascii=False) if call else ""
+                memories.append(("tool", f"工具 {name}({args}) 的結果：{_text(msg.content)}"[:self.max_chars]))
+
+        final = messages[-1] if messages else None
+        if isinstance(final, AIMessage) and not final.tool_calls:
+            memories.append(("turn", f"使用者問：{user_message}\n回答：{_text(final.content)}"[:self.max_chars]))
+        return memories
+
+    def remember_turn(self, thread_id: str, scope: str, user_message: str, messages: List[BaseMessage]) -> int:
+        """
+        把一輪對話中的問答與工具結果加入記憶（重複的內容會略過）
+
+        Returns:
+            新增的記憶數
+        """
+        now = time.time()
+        items = []
+        with self._lock:
+            for kind, text in self._memories_from_turn(user_message, messages):
+                digest = self._digest(scope, text)
+                if digest in self._seen:
+                    continue
+                self._seen.add(digest)
+                items.append({"thread_id": thread_id, "scope": scope, "kind": kind, "text": text, "created": now})
+        if not items:
+            return 0
+
+        vectors = self.embedder.embed([item["text"] for item in items])
+        with self._lock:
+            self.index.add(vectors, items)
+            codes = np.array([self._scope_code(item["scope"]) for item in items], dtype=np.int32)
+            self._scopes = np.concatenate([self._scopes, codes])
+        return len(items)
+
+    def recall(self, query: str, scope: str) -> List[str]:
+        """取出與 query 最相關的記憶（只在同一個 scope 中搜尋）"""
+        started = time.perf_counter()
+        vector = self.embedder.embed([query])[0]
+        with self._lock:
+            code = self._scope_codes.get(scope)
+            if code is None or self.index.count == 0:
+                return []
+            hits = self.index.search(vector, self.top_k, mask=self._scopes == code)
+            texts = [self._describe(self.index.metadata[i]) for i, score in hits if score >= self.min_score]
+        self.recalls += 1
+        self.recall_seconds += time.perf_counter() - started
+        return texts
+
+    @staticmethod
+    def _describe(item: dict) -> str:
+        """記憶內容加上記錄時間"""
+        created = item.get("created")
+        if created is None:
+            return item["text"]
+        return f"[{time.strftime('%Y-%m-%d %H:%M', time.localtime(created))} 記錄] {item['text']}"
+
+    def stats(self) -> dict:
+        return {
+            "embedder": self.embedder.name,
+            "memories": self.index.count,
+            "path": self.index.path,
+            "recalls": self.recalls,
+            "avg_recall_ms": round(self.recall_seconds / self.recalls * 1000, 2) if self.recalls else 0.0,
+        }
@@ -0,0 +1,159 @@
+"""
+Loop Detection - 偵測 ReAct 迴圈中的重複工具呼叫
+
+本地模型常在 ReAct 迴圈中反覆呼叫同一個工具與參數（例如一直列同一個目錄），
+直到達到 recursion limit，每一圈都浪費一次完整的 LLM 呼叫：
+- 工具層：同一次執行中以相同參數重複呼叫唯讀工具時，直接回傳先前的結果並附上提醒
+- 模型層：連續幾步都只是重複先前的工具呼叫時，不再綁定工具，強制模型給出最終回答
+"""
+
+import functools
+import json
+from typing import Any, Dict, List, Optional, Sequence
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from model_router import _to_messages
+from run_context import current_run
+
+REPEAT_NUDGE = "（提醒：這個工具剛才已用相同參數呼叫過，以上是先前的結果。請根據已取得的資訊繼續，不要重複呼叫。）"
+FINAL_ANSWER_NUDGE = "你已經重複呼叫相同的工具好幾次，沒有取得新資訊。請停止呼叫工具，直接根據目前已取得的資訊給出最終回答。"
+
+# 由 LangChain / MCP adapter 注入、不屬於工具參數的欄位
+_INJECTED_ARGS = {"runtime", "config", "callbacks", "run_manager"}
+
+
+def fingerprint(name: str, args: Any) -> str:
+    """工具呼叫的指紋（工具名稱 + 正規化的參數）"""
+    if isinstance(args, dict):
+        args = {k: v for k, v in args.items() if k not in _INJECTED_ARGS}
+    return f"{name}:{json.dumps(args, sort_keys=True, ensure_ascii=False, default=str)}"
+
+
+def stalled_steps(messages: List[BaseMessage]) -> int:
+    """計算最後一則使用者訊息之後，結尾連續幾步的工具呼叫全都是重複的"""
+    start = 0
+    for i in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[i], HumanMessage):
+            start = i + 1
+            break
+
+    seen = set()
+    stalled = 0
+    for msg in messages[start:]:
+        if not isinstance(msg, AIMessage) or not msg.tool_calls:
+            continue
+        prints = [fingerprint(call["name"], call.get("args")) for call in msg.tool_calls]
+        stalled = stalled + 1 if all(p in seen for p in prints) else 0
+        seen.update(prints)
+    return stalled
+
+
+def _with_nudge(result: Any) -> Any:
+    """在工具結果後附上重複呼叫的提醒"""
+    if isinstance(result, tuple) and len(result) == 2:  # content_and_artifact
+        return _with_nudge(result[0]), result[1]
+    if isinstance(result, list):
+        return [*result, {"type": "text", "text": REPEAT_NUDGE}]
+    return f"{result}\n\n{REPEAT_NUDGE}"
+
+
+class LoopStats:
+    """迴圈偵測統計"""
+
+    def __init__(self):
+        self.repeated_tool_calls = 0
+        self.forced_final_answers = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "repeated_tool_calls": self.repeated_tool_calls,
+            "forced_final_answers": self.forced_final_answers,
+        }
+
+
+def guard_repeats(tools: List[Any], read_only_names: Sequence[str], stats: LoopStats) -> List[Any]:
+    """
+    包裝工具的 coroutine：同一次執行中重複的唯讀呼叫直接回傳先前的結果
+
+    任何非唯讀工具執行後會清空快取（檔案可能已經改變）
+    """
+    for tool in tools:
+        if tool.coroutine is None:
+            continue
+
+        def guarded(original, name, read_only):
+            @functools.wraps(original)
+            async def run(*args, **kwargs):
+                context = current_run()
+                if context is None:
+                    return await original(*args, **kwargs)
+                if not read_only:
+                    context.tool_results.clear()
+                    return await original(*args, **kwargs)
+
+                key = fingerprint(name, kwargs)
+                if key in context.tool_results:
+                    context.repeated_tool_calls += 1
+                    stats.repeated_tool_calls += 1
+                    return _with_nudge(context.tool_results[key])
+                result = await original(*args, **kwargs)
+                context.tool_results[key] = result
+                return result
+            return run
+
+        tool.coroutine = guarded(tool.coroutine, tool.name, tool.name in read_only_names)
+    return tools
+
+
+class LoopGuardModel(Runnable):
+    """
+    包裝 chat model：連續 max_stalled_steps 步都只是重複先前的工具呼叫時，
+    以不綁定工具的模型強制產生最終回答
+    """
+
+    def __init__(
+        self,
+        inner: Runnable,
+        max_stalled_steps: int = 2,
+        bound: Optional[Runnable] = None,
+        stats: Optional[LoopStats] = None,
+    ):
+        """
+        Args:
+            inner: 未綁定工具的 chat model（強制最終回答時使用）
+            max_stalled_steps: 連續幾步沒有進展就強制最終回答
+            bound: 綁定工具後的 model（由 bind_tools 設定）
+            stats: 共用的統計物件
+        """
+        self.inner = inner
+        self.max_stalled_steps = max_stalled_steps
+        self.bound = bound or inner
+        self.stats = stats or LoopStats()
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs) -> "LoopGuardModel":
+        return LoopGuardModel(self.inner, self.max_stalled_steps, self.inner.bind_tools(tools, **kwargs), self.stats)
+
+    def _forced_input(self, input: Any) -> Optional[list]:
+        """沒有進展時回傳強制最終回答的輸入，否則回傳 None"""
+        messages = _to_messages(input)
+        if stalled_steps(messages) < self.max_stalled_steps:
+            return None
+        self.stats.forced_final_answers += 1
+        context = current_run()
+        if context is not None:
+            context.forced_final = True
+        return [*messages, HumanMessage(content=FINAL_ANSWER_NUDGE)]
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> BaseMessage:
+        forced = self._forced_input(input)
+        if forced is not None:
+            return self.inner.invoke(forced, config, **kwargs)
+        return self.bound.invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> BaseMessage:
+        forced = self._forced_input(input)
+        if forced is not None:
+            return await self.inner.ainvoke(forced, config, **kwargs)
+        return await self.bound.ainvoke(input, config, **kwargs)
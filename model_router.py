@@ -0,0 +1,174 @@
+"""
+Two-tier Model Router - 兩階段模型路由
+一般步驟用小而快的模型選擇工具，最終回答、長的執行、失敗後的步驟與格式錯誤的工具呼叫交給較強的模型
+
+路由規則：
+1. 每一步預設交給 fast model
+2. 上一個工具呼叫失敗 → 這一步直接交給 strong model
+3. 同一輪執行已經超過 escalate_after_steps 步 → 之後每一步都直接用 strong model
+4. fast model 產生格式錯誤的 tool call → 升級給 strong model 重做這一步
+5. fast model 沒有呼叫工具（準備最終回答）→ 捨棄它的回答，由 strong model 生成最終回答
+   （synthesize_with_strong=False 時直接採用 fast model 的回答，省下一次生成）
+
+synthesize_with_strong 開啟時 fast model 的輸出不串流（可能被捨棄），
+client 只會收到 strong model 生成的最終回答；關閉時 fast model 的輸出照常串流，
+只有格式錯誤後重做的輸出不再串流。
+"""
+
+from typing import Any, Dict, Optional
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from run_context import retry_config
+
+
+class RouterStats:
+    """各模型的執行步數與升級次數統計（bind_tools 後的 router 共用同一份）"""
+
+    def __init__(self, fast_model: str, strong_model: str):
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self.steps = {"fast": 0, "strong": 0}
+        self.escalations: Dict[str, int] = {}
+
+    def record_step(self, tier: str):
+        self.steps[tier] += 1
+
+    def record_escalation(self, reason: str):
+        self.escalations[reason] = self.escalations.get(reason, 0) + 1
+
+    def snapshot(self) -> dict:
+        return {
+            "models": {
+                self.fast_model: {"tier": "fast", "steps": self.steps["fast"]},
+                self.strong_model: {"tier": "strong", "steps": self.steps["strong"]},
+            },
+            "escalations": dict(self.escalations),
+        }
+
+
+def _to_messages(model_input: Any) -> list:
+    """把 model 輸入（PromptValue 或訊息列表）轉成訊息列表"""
+    if hasattr(model_input, "to_messages"):
+        return model_input.to_messages()
+    if isinstance(model_input, list):
+        return model_input
+    return []
+
+
+def _steps_in_run(messages: list) -> int:
+    """計算最後一則使用者訊息之後，Agent 已經走了幾步"""
+    steps = 0
+    for msg in reversed(messages):
+        if isinstance(msg, HumanMessage):
+            break
+        if isinstance(msg, AIMessage):
+            steps += 1
+    return steps
+
+
+class ModelRouter(Runnable):
+    """
+    兩階段模型路由 Runnable
+
+    可以直接交給 create_react_agent 當作 model 使用；
+    bind_tools() 會把工具同時綁到兩個模型上並保留路由行為。
+    """
+
+    def __init__(
+        self,
+        fast_llm: Runnable,
+        strong_llm: Runnable,
+        fast_model: str,
+        strong_model: str,
+        escalate_after_steps: int = 6,
+        synthesize_with_strong: bool = True,
+        stats: Optional[RouterStats] = None,
+    ):
+        """
+        Args:
+            fast_llm: 中間步驟使用的小模型
+            strong_llm: 最終回答與升級時使用的大模型
+            fast_model: 小模型名稱（統計用）
+            strong_model: 大模型名稱（統計用）
+            escalate_after_steps: 同一輪執行超過幾步後全部改用大模型
+            synthesize_with_strong: 最終回答一律由大模型生成（False 表示直接採用小模型的最終回答）
+            stats: 共用的統計物件
+        """
+        self.fast_llm = fast_llm
+        self.strong_llm = strong_llm
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self.escalate_after_steps = escalate_after_steps
+        self.synthesize_with_strong = synthesize_with_strong
+        self.stats = stats or RouterStats(fast_model, strong_model)
+
+    def bind_tools(self, tools, **kwargs) -> "ModelRouter":
+        """把工具綁到兩個模型上，回傳新的 router（共用統計）"""
+        return ModelRouter(
+            fast_llm=self.fast_llm.bind_tools(tools, **kwargs),
+            strong_llm=self.strong_llm.bind_tools(tools, **kwargs),
+            fast_model=self.fast_model,
+            strong_model=self.strong_model,
+            escalate_after_steps=self.escalate_after_steps,
+            synthesize_with_strong=self.synthesize_with_strong,
+            stats=self.stats,
+        )
+
+    def _route(self, model_input: Any) -> Optional[str]:
+        """生成前判斷這一步是否直接交給 strong model，回傳升級原因（None 表示使用 fast model）"""
+        messages = _to_messages(model_input)
+        if _steps_in_run(messages) >= self.escalate_after_steps:
+            return "step_threshold"
+        if messages and isinstance(messages[-1], ToolMessage) and messages[-1].status == "error":
+            return "tool_error"
+        return None
+
+    def _fast_config(self, config: Optional[RunnableConfig]) -> Optional[RunnableConfig]:
+        """fast model 的回答可能被捨棄時不串流它的輸出"""
+        return retry_config(config) if self.synthesize_with_strong else config
+
+    def _escalate_after_fast(self, response: BaseMessage, config: Optional[RunnableConfig]):
+        """
+        判斷 fast model 的輸出是否要交給 strong model 重做
+
+        Returns:
+            (升級原因, strong model 使用的設定)；不需要升級時原因為 None
+        """
+        if getattr(response, "invalid_tool_calls", None):
+            reason = "malformed_tool_call"
+        elif self.synthesize_with_strong and not getattr(response, "tool_calls", None):
+            reason = "final_answer"
+        else:
+            return None, config
+        # fast model 的輸出已串流時，重做的輸出不再串流
+        return reason, config if self.synthesize_with_strong else retry_config(config)
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> BaseMessage:
+        reason = self._route(input)
+        if reason is None:
+            response = self.fast_llm.invoke(input, self._fast_config(config), **kwargs)
+            self.stats.record_step("fast")
+            reason, config = self._escalate_after_fast(response, config)
+            if reason is None:
+                return response
+        self.stats.record_escalation(reason)
+
+        response = self.strong_llm.invoke(input, config, **kwargs)
+        self.stats.record_step("strong")
+        return response
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> BaseMessage:
+        reason = self._route(input)
+        if reason is None:
+            response = await self.fast_llm.ainvoke(input, self._fast_config(config), **kwargs)
+            self.stats.record_step("fast")
+            reason, config = self._escalate_after_fast(response, config)
+            if reason is None:
+                return response
+        self.stats.record_escalation(reason)
+
+        response = await self.strong_llm.ainvoke(input, config, **kwargs)
+        self.stats.record_step("strong")
+        return response
@@ -0,0 +1,196 @@
+"""
+Profiling - 單次請求的耗時分析與取樣式 stack profiler
+
+- RunProfiler：以 LangChain callback 記錄 LLM 呼叫與 MCP 工具呼叫的時間，
+  算出 LLM / 工具 / 序列化 / graph 本身的耗時，可選擇附帶 cProfile 結果
+- sample_stacks：定期讀取所有執行緒的 stack，輸出 collapsed stack 格式
+  （可直接交給 flamegraph.pl 或 speedscope 產生火焰圖）
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+# cProfile 同一時間只能有一個在執行
+_cprofile_lock = threading.Lock()
+
+
+def _union_seconds(intervals: List[Tuple[float, float]]) -> float:
+    """合併重疊區間後的總秒數（平行的工具呼叫不重複計算）"""
+    total = 0.0
+    current_start = current_end = None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+class RunProfiler(BaseCallbackHandler):
+    """
+    單次 Agent 執行的耗時分析
+
+    以 callbacks 傳入 Agent 執行設定；建立時開始計時，report() 時結束。
+    啟用 cProfile 時，請求失敗也必須呼叫 stop()（可重複呼叫），否則 cProfile 會留在 event loop 上
+    """
+
+    run_inline = True  # 在 event loop 上直接執行，不丟到 thread pool（避免影響計時）
+
+    def __init__(self, cprofile: bool = False):
+        """
+        Args:
+            cprofile: 是否同時以 cProfile 記錄（會記錄到同一 event loop 上其他請求的函式呼叫）
+        """
+        self.started = time.perf_counter()
+        self.intervals: Dict[str, List[Tuple[float, float]]] = defaultdict(list)
+        self.tool_times: Dict[str, List[float]] = defaultdict(list)
+        self._open: Dict[UUID, Tuple[str, str, float]] = {}
+        self._profile: Optional[cProfile.Profile] = None
+        self._cprofile_output: Optional[str] = None
+        self._cprofile_skipped = False
+
+        if cprofile:
+            if _cprofile_lock.acquire(blocking=False):
+                self._profile = cProfile.Profile()
+                try:
+                    self._profile.enable()
+                except ValueError:  # 其他 profiler 已在執行
+                    self._profile = None
+                    _cprofile_lock.release()
+            if self._profile is None:
+                self._cprofile_skipped = True
+
+    # --- LangChain callbacks ---
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages, *, run_id: UUID, **kwargs):
+        self._open[run_id] = ("llm", "llm", time.perf_counter())
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts, *, run_id: UUID, **kwargs):
+        self._open[run_id] = ("llm", "llm", time.perf_counter())
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs):
+        self._close(run_id)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        self._close(run_id)
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, **kwargs):
+        name = (serialized or {}).get("name") or kwargs.get("name") or "tool"
+        self._open[run_id] = ("tool", name, time.perf_counter())
+
+    def on_tool_end(self, output, *, run_id: UUID, **kwargs):
+        self._close(run_id)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        self._close(run_id)
+
+    def _close(self, run_id: UUID):
+        entry = self._open.pop(run_id, None)
+        if entry is None:
+            return
+        category, name, start = entry
+        end = time.perf_counter()
+        self.intervals[category].append((start, end))
+        if category == "tool":
+            self.tool_times[name].append(end - start)
+
+    @contextmanager
+    def measure(self, category: str):
+        """記錄一段程式碼的耗時（例如對話歷史與回應的序列化）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.intervals[category].append((start, time.perf_counter()))
+
+    def stop(self):
+        """停止 cProfile 並釋放 cProfile 鎖（report() 也會呼叫）"""
+        if self._profile is None:
+            return
+        self._profile.disable()
+        _cprofile_lock.release()
+        out = io.StringIO()
+        pstats.Stats(self._profile, stream=out).sort_stats("cumulative").print_stats(40)
+        self._cprofile_output = out.getvalue()
+        self._profile = None
+
+    def report(self) -> dict:
+        """結束計時並回傳耗時分析（毫秒）"""
+        self.stop()
+        total = time.perf_counter() - self.started
+        llm = _union_seconds(self.intervals["llm"])
+        tool = _union_seconds(self.intervals["tool"])
+        serialization = _union_seconds(self.intervals["serialization"])
+        memory = _union_seconds(self.intervals["memory"])
+
+        def ms(seconds: float) -> float:
+            return round(seconds * 1000, 1)
+
+        report = {
+            "total_ms": ms(total),
+            "llm_ms": ms(llm),
+            "llm_calls": len(self.intervals["llm"]),
+            "tool_ms": ms(tool),
+            "tool_calls": len(self.intervals["tool"]),
+            "serialization_ms": ms(serialization),
+            "memory_ms": ms(memory),
+            "graph_overhead_ms": ms(max(0.0, total - llm - tool - serialization - memory)),
+            "tools": {
+                name: {"calls": len(times), "ms": ms(sum(times))}
+                for name, times in self.tool_times.items()
+            },
+        }
+        if self._cprofile_output is not None:
+            report["cprofile"] = self._cprofile_output
+        elif self._cprofile_skipped:
+            report["cprofile"] = "skipped: another profile is already running"
+        return report
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+def sample_stacks(seconds: float, interval: float = 0.005) -> str:
+    """
+    在 seconds 秒內每 interval 秒取樣一次所有執行緒的 stack
+
+    請在獨立執行緒中呼叫（例如 asyncio.to_thread），才能取樣到 event loop 執行緒
+
+    Returns:
+        collapsed stack 格式（每行 "thread;frame;frame count"）
+    """
+    own = threading.get_ident()
+    counts: Counter = Counter()
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}").replace(";", ":"))
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
@@ -0,0 +1,430 @@
+"""
+Resilience - LLM 與工具後端的熔斷器、自適應逾時與重試
+
+後端（LM Studio、MCP 子程序）掛掉或卡住時，請求不該一直等到 client 逾時：
+- CircuitBreaker：最近呼叫的失敗率超過門檻就熔斷（直接失敗），冷卻後以少量探測呼叫試探是否恢復
+- AdaptiveTimeout：依觀察到的延遲百分位數決定逾時，而不是固定的長逾時
+- ResilientBackend：組合以上兩者，冪等呼叫（LLM、唯讀工具）失敗時以 jitter backoff 重試
+- 串流的 LLM 呼叫：逾時限制的是等待下一段輸出的時間（長回答只要持續輸出就不會被中斷），
+  已經輸出 token 後失敗不重試（重試會重複送出已串流的內容）
+- 預熱與 keep-alive（config 帶 PING_TAG）不經過熔斷器，也不計入延遲樣本與統計
+"""
+
+import asyncio
+import functools
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, List, Optional, Sequence
+
+import anyio
+import openai
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables.config import merge_configs
+
+
+# 預熱與 keep-alive 的 LLM 呼叫帶上此 tag：載入模型的延遲與失敗不影響使用者請求的熔斷與逾時
+PING_TAG = "agent:ping"
+
+
+class BackendUnavailable(Exception):
+    """後端熔斷中（或逾時、連線失敗且無法重試），請求直接失敗"""
+
+    def __init__(self, backend: str, detail: str, retry_after: float = 0.0):
+        super().__init__(f"Backend '{backend}' unavailable: {detail}")
+        self.backend = backend
+        self.retry_after = retry_after
+
+
+def is_backend_failure(error: BaseException) -> bool:
+    """
+    是否為後端故障（逾時、連線中斷、5xx），而不是請求本身的錯誤
+
+    工具回報的 FileNotFoundError、PermissionError 等一般 OSError 是請求本身的錯誤，不計入熔斷
+    """
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    return isinstance(error, (
+        asyncio.TimeoutError,
+        ConnectionError,  # 連線被拒、重設、中斷（含 BrokenPipeError）
+        openai.APIConnectionError,  # 包含 APITimeoutError
+        anyio.ClosedResourceError,
+        anyio.BrokenResourceError,
+    ))
+
+
+class StreamProgress(BaseCallbackHandler):
+    """記錄一次 LLM 呼叫的串流進度（是否已輸出 token、最後一次輸出的時間）"""
+
+    run_inline = True
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started_at = time.monotonic()
+        self.first_token_at: Optional[float] = None
+        self.last_progress = self.started_at
+
+    @property
+    def streamed(self) -> bool:
+        return self.first_token_at is not None
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        now = time.monotonic()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self.last_progress = now
+
+
+class CircuitBreaker:
+    """以滑動視窗失敗率判斷的熔斷器（closed → open → half_open → closed）"""
+
+    def __init__(
+        self,
+        failure_rate: float = 0.5,
+        window: int = 20,
+        min_calls: int = 5,
+        open_seconds: float = 30.0,
+        half_open_probes: int = 1,
+    ):
+        """
+        Args:
+            failure_rate: 視窗內失敗率超過多少就熔斷
+            window: 計算失敗率的最近呼叫數
+            min_calls: 視窗內至少要有幾次呼叫才判斷
+            open_seconds: 熔斷後多久開始探測
+            half_open_probes: 探測階段同時允許幾個呼叫
+        """
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.outcomes: Deque[bool] = deque(maxlen=window)
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probes = 0
+        self.times_opened = 0
+
+    def blocked_for(self) -> Optional[float]:
+        """
+        呼叫前檢查是否允許
+
+        Returns:
+            None 表示允許呼叫，否則為建議幾秒後再試
+        """
+        if self.state == "open":
+            remaining = self.opened_at + self.open_seconds - time.monotonic()
+            if remaining > 0:
+                return remaining
+            self.state = "half_open"
+            self.probes = 0
+
+        if self.state == "half_open":
+            if self.probes >= self.half_open_probes:
+                return 1.0  # 探測中，其他呼叫先直接失敗
+            self.probes += 1
+        return None
+
+    def record_success(self):
+        if self.state == "half_open":
+            self.state = "closed"
+            self.outcomes.clear()
+        self.outcomes.append(True)
+
+    def record_failure(self):
+        if self.state == "half_open":
+            self._open()
+            return
+        self.outcomes.append(False)
+        failures = self.outcomes.count(False)
+        if len(self.outcomes) >= self.min_calls and failures / len(self.outcomes) >= self.failure_rate:
+            self._open()
+
+    def release_probe(self):
+        """探測呼叫被取消時歸還探測名額"""
+        if self.state == "half_open" and self.probes > 0:
+            self.probes -= 1
+
+    def _open(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+        self.outcomes.clear()
+
+
+class AdaptiveTimeout:
+    """依最近成功呼叫的延遲百分位數決定逾時"""
+
+    def __init__(
+        self,
+        initial: float,
+        minimum: float,
+        maximum: float,
+        percentile: float = 0.99,
+        multiplier: float = 3.0,
+        window: int = 200,
+        min_samples: int = 10,
+    ):
+        """
+        Args:
+            initial: 樣本不足時使用的逾時
+            minimum: 逾時下限
+            maximum: 逾時上限
+            percentile: 參考的延遲百分位數
+            multiplier: 逾時 = 百分位延遲 × multiplier
+            window: 保留的延遲樣本數
+            min_samples: 至少幾個樣本才開始自適應
+        """
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self.samples: Deque[float] = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+
+    def quantile(self, p: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    def current(self) -> float:
+        if len(self.samples) < self.min_samples:
+            return self.initial
+        return min(self.maximum, max(self.minimum, self.quantile(self.percentile) * self.multiplier))
+
+
+class ResilientBackend:
+    """單一後端的熔斷、逾時與重試"""
+
+    def __init__(
+        self,
+        name: str,
+        breaker: Optional[CircuitBreaker] = None,
+        timeout: Optional[AdaptiveTimeout] = None,
+        retries: int = 2,
+        backoff_base: float = 0.5,
+        backoff_cap: float = 5.0,
+    ):
+        """
+        Args:
+            name: 後端名稱（顯示在錯誤與統計中）
+            breaker: 熔斷器
+            timeout: 自適應逾時
+            retries: 冪等呼叫失敗時最多重試幾次
+            backoff_base: 重試等待的基準秒數（指數成長並加上 jitter）
+            backoff_cap: 重試等待的上限秒數
+        """
+        self.name = name
+        self.breaker = breaker or CircuitBreaker()
+        self.timeout = timeout or AdaptiveTimeout(initial=60.0, minimum=5.0, maximum=300.0)
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.retried = 0
+        self.rejected = 0
+        self.pings = 0
+        self.last_used: Optional[float] = None  # 最近一次實際呼叫的時間（不含 ping）
+
+    def idle_seconds(self) -> float:
+        """距離最近一次實際呼叫過了幾秒（沒有呼叫過時為 inf）"""
+        if self.last_used is None:
+            return float("inf")
+        return time.monotonic() - self.last_used
+
+    def ensure_available(self):
+        """
+        熔斷中時直接失敗（不佔用探測名額），供排隊前提早拒絕請求
+
+        Raises:
+            BackendUnavailable: 熔斷中
+        """
+        breaker = self.breaker
+        if breaker.state == "open":
+            remaining = breaker.opened_at + breaker.open_seconds - time.monotonic()
+            if remaining > 0:
+                self.rejected += 1
+                raise BackendUnavailable(self.name, "circuit open", remaining)
+
+    def _admit(self):
+        retry_after = self.breaker.blocked_for()
+        if retry_after is not None:
+            self.rejected += 1
+            raise BackendUnavailable(self.name, f"circuit {self.breaker.state}", retry_after)
+
+    async def call(
+        self,
+        fn: Callable[[], Awaitable[Any]],
+        idempotent: bool = True,
+        progress: Optional[StreamProgress] = None,
+    ) -> Any:
+        """
+        以熔斷器與自適應逾時執行 fn()，冪等呼叫遇到後端故障時重試
+
+        Args:
+            fn: 要執行的呼叫
+            idempotent: 失敗時是否可以重試
+            progress: 串流呼叫的進度；有提供時逾時改為限制兩次輸出之間的間隔，
+                延遲樣本只記錄第一個 token 的等待時間，已輸出 token 後失敗不重試
+
+        Raises:
+            BackendUnavailable: 熔斷中，或後端故障且已無法重試
+        """
+        attempt = 0
+        while True:
+            self._admit()
+            self.calls += 1
+            self.last_used = time.monotonic()
+            limit = self.timeout.current()
+            started = time.monotonic()
+            if progress is not None:
+                progress.reset()
+            try:
+                result = await self._run(fn, limit, progress)
+            except asyncio.CancelledError:
+                self.breaker.release_probe()
+                raise
+            except Exception as e:
+                if not is_backend_failure(e):
+                    self.breaker.record_success()  # 後端有回應，只是請求本身有誤
+                    raise
+                self.failures += 1
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timeouts += 1
+                self.breaker.record_failure()
+
+                streamed = progress is not None and progress.streamed
+                if not idempotent or streamed or attempt >= self.retries:
+                    detail = f"timed out after {limit:.1f}s" if isinstance(e, asyncio.TimeoutError) else repr(e)
+                    raise BackendUnavailable(self.name, detail, self.breaker.open_seconds) from e
+                attempt += 1
+                self.retried += 1
+                delay = min(self.backoff_cap, self.backoff_base * 2 ** (attempt - 1))
+                await asyncio.sleep(random.uniform(0, delay))
+                continue
+
+            if progress is not None and progress.streamed:
+                self.timeout.observe(progress.first_token_at - started)
+            else:
+                self.timeout.observe(time.monotonic() - started)
+            self.breaker.record_success()
+            return result
+
+    @staticmethod
+    async def _run(fn: Callable[[], Awaitable[Any]], limit: float, progress: Optional[StreamProgress]) -> Any:
+        """執行 fn()：沒有 progress 時限制總時間，有 progress 時限制沒有任何輸出的時間"""
+        if progress is None:
+            return await asyncio.wait_for(fn(), limit)
+
+        task = asyncio.ensure_future(fn())
+        try:
+            while True:
+                remaining = progress.last_progress + limit - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                done, _ = await asyncio.wait({task}, timeout=remaining)
+                if done:
+                    return task.result()
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+    async def ping(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        預熱 / keep-alive 呼叫：只以逾時上限限制，不經過熔斷器，
+        不計入延遲樣本與失敗統計，也不算是實際呼叫（不更新 last_used）
+        """
+        self.pings += 1
+        return await asyncio.wait_for(fn(), self.timeout.maximum)
+
+    def call_sync(self, fn: Callable[[], Any]) -> Any:
+        """同步呼叫只套用熔斷器（無法中斷執行中的同步呼叫，不套用逾時與重試）"""
+        self._admit()
+        self.calls += 1
+        self.last_used = time.monotonic()
+        try:
+            result = fn()
+        except Exception as e:
+            if is_backend_failure(e):
+                self.failures += 1
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "state": self.breaker.state,
+            "times_opened": self.breaker.times_opened,
+            "timeout_s": round(self.timeout.current(), 2),
+            "latency_ms_p50": round(self.timeout.quantile(0.5) * 1000, 1),
+            "latency_ms_p99": round(self.timeout.quantile(0.99) * 1000, 1),
+            "calls": self.calls,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "retried": self.retried,
+            "rejected": self.rejected,
+            "pings": self.pings,
+        }
+
+
+class ResilientModel(Runnable):
+    """
+    以 ResilientBackend 保護的 chat model（LLM 呼叫沒有副作用，視為冪等）
+
+    非同步呼叫會追蹤串流進度：持續輸出的長回答不會逾時，已輸出 token 後失敗也不重試；
+    config 帶 PING_TAG 的呼叫改走 ResilientBackend.ping
+    """
+
+    def __init__(self, inner: Runnable, backend: ResilientBackend):
+        self.inner = inner
+        self.backend = backend
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs) -> "ResilientModel":
+        return ResilientModel(self.inner.bind_tools(tools, **kwargs), self.backend)
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> BaseMessage:
+        return self.backend.call_sync(lambda: self.inner.invoke(input, config, **kwargs))
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> BaseMessage:
+        if PING_TAG in (config or {}).get("tags", ()):
+            return await self.backend.ping(lambda: self.inner.ainvoke(input, config, **kwargs))
+        progress = StreamProgress()
+        config = merge_configs(config, {"callbacks": [progress]})
+        return await self.backend.call(lambda: self.inner.ainvoke(input, config, **kwargs), progress=progress)
+
+
+def guard_tools(tools: List[Any], backend: ResilientBackend, idempotent_names: Sequence[str]) -> List[Any]:
+    """
+    以 ResilientBackend 包裝工具的 coroutine
+
+    Args:
+        tools: MCP 工具（StructuredTool）
+        backend: 工具所屬的後端
+        idempotent_names: 唯讀工具名稱（失敗時可重試）
+    """
+    for tool in tools:
+        if tool.coroutine is None:
+            continue
+
+        def guarded(original, idempotent):
+            @functools.wraps(original)  # 保留簽章，讓 InjectedToolArg 等注入參數照常運作
+            async def run(*args, **kwargs):
+                return await backend.call(lambda: original(*args, **kwargs), idempotent=idempotent)
+            return run
+
+        tool.coroutine = guarded(tool.coroutine, tool.name in idempotent_names)
+    return tools
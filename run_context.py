@@ -0,0 +1,53 @@
+"""
+Run Context - 單次 Agent 執行的共用狀態
+
+以 contextvar 保存，graph 中的模型與工具 wrapper 不需要經過 graph state 就能取得
+同一次執行的資料（LangGraph 建立的子 task 會繼承目前的 context）。
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import merge_configs
+
+# 重做同一步的 LLM 呼叫（模型升級、改綁完整工具集）帶上此 tag，
+# 串流時不再送出它的 token，client 不會看到同一步的兩份輸出
+RETRY_TAG = "agent:retry"
+
+
+class RunContext:
+    """單次執行的狀態"""
+
+    def __init__(self, thread_id: str, tenant: Optional[str] = None):
+        self.thread_id = thread_id
+        self.tenant = tenant
+        self.tool_results: Dict[str, Any] = {}  # 工具呼叫指紋 → 結果（重複呼叫時直接回傳）
+        self.repeated_tool_calls = 0
+        self.forced_final = False
+        self.usage: Any = None  # 此次執行的 token 用量（由 token_accounting 記錄）
+        self.budget_exhausted: Optional[str] = None
+
+
+_current_run: ContextVar[Optional[RunContext]] = ContextVar("current_run", default=None)
+
+
+def current_run() -> Optional[RunContext]:
+    """目前執行的狀態（不在 Agent 執行中時為 None）"""
+    return _current_run.get()
+
+
+@contextmanager
+def run_scope(context: RunContext):
+    """在區塊內以 context 作為目前執行的狀態"""
+    token = _current_run.set(context)
+    try:
+        yield context
+    finally:
+        _current_run.reset(token)
+
+
+def retry_config(config: Optional[RunnableConfig]) -> RunnableConfig:
+    """重做同一步 LLM 呼叫時使用的設定（加上 RETRY_TAG）"""
+    return merge_configs(config, {"tags": [RETRY_TAG]})
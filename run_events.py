@@ -0,0 +1,152 @@
+"""
+Resumable Run Events - 可續傳的 Agent 執行事件串流
+
+每次執行（run）在背景進行，與 client 連線無關；
+產生的事件帶有遞增的 event ID，保存在有上限的 replay buffer 中。
+Client 斷線後帶著 Last-Event-ID 重新連線，就能補收漏掉的事件並繼續接收即時事件，
+不必重新送出請求、重跑所有 LLM 與工具步驟。
+"""
+
+import asyncio
+import time
+import uuid
+from collections import deque
+from contextlib import nullcontext
+from typing import AsyncContextManager, Dict, List, Optional, Tuple
+
+
+class RunBuffer:
+    """單一執行的事件 replay buffer"""
+
+    def __init__(self, run_id: str, thread_id: str, max_events: int = 1000):
+        """
+        Args:
+            run_id: 執行 ID
+            thread_id: 對話執行緒 ID
+            max_events: 最多保留的事件數（超過時丟棄最舊的事件）
+        """
+        self.run_id = run_id
+        self.thread_id = thread_id
+        self.events: deque = deque(maxlen=max_events)
+        self.last_id = 0
+        self.done = False
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self._cond = asyncio.Condition()
+
+    async def publish(self, event: dict):
+        """加入新事件並通知等待中的訂閱者"""
+        async with self._cond:
+            self.last_id += 1
+            self.events.append((self.last_id, event))
+            self._cond.notify_all()
+
+    async def finish(self):
+        """標記執行結束"""
+        async with self._cond:
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._cond.notify_all()
+
+    async def events_after(self, last_event_id: int, timeout: float) -> List[Tuple[int, dict]]:
+        """
+        取得 last_event_id 之後的事件；沒有新事件時最多等待 timeout 秒
+
+        若 client 要求的事件已被 buffer 丟棄，會先回傳一個 gap 事件
+        """
+        async with self._cond:
+            try:
+                await asyncio.wait_for(
+                    self._cond.wait_for(lambda: self.last_id > last_event_id or self.done),
+                    timeout
+                )
+            except asyncio.TimeoutError:
+                return []
+
+            pending = [(i, e) for i, e in self.events if i > last_event_id]
+            if pending and pending[0][0] > last_event_id + 1:
+                missed = pending[0][0] - last_event_id - 1
+                pending.insert(0, (pending[0][0] - 1, {"type": "gap", "missed": missed}))
+            return pending
+
+
+class RunManager:
+    """管理背景執行與其 replay buffer"""
+
+    def __init__(self, max_events_per_run: int = 1000, retention_seconds: float = 300.0):
+        """
+        Args:
+            max_events_per_run: 每個執行最多保留的事件數
+            retention_seconds: 執行結束後 buffer 保留多久（供斷線 client 補收）
+        """
+        self.max_events_per_run = max_events_per_run
+        self.retention_seconds = retention_seconds
+        self.runs: Dict[str, RunBuffer] = {}
+
+    def start(
+        self,
+        agent,
+        message: str,
+        thread_id: str,
+        slot: Optional[AsyncContextManager] = None,
+        options: Optional[dict] = None,
+    ) -> RunBuffer:
+        """
+        在背景啟動一次執行
+
+        Args:
+            agent: AgenticChatBot 實例，或回傳目前實例的函式（取得執行名額後才呼叫，熱重載後排隊中的執行會使用新的 Agent）
+            message: 使用者訊息
+            thread_id: 對話執行緒 ID
+            slot: 執行前要取得的排程名額（async context manager）
+            options: 傳給 agent.astream 的其他參數（例如 workspace）
+        """
+        self._prune()
+        run = RunBuffer(str(uuid.uuid4()), thread_id, self.max_events_per_run)
+        run.task = asyncio.create_task(self._execute(run, agent, message, slot, options or {}))
+        self.runs[run.run_id] = run
+        return run
+
+    def get(self, run_id: str) -> Optional[RunBuffer]:
+        return self.runs.get(run_id)
+
+    def active_count(self) -> int:
+        return sum(1 for run in self.runs.values() if not run.done)
+
+    async def cancel_all(self) -> int:
+        """取消所有尚未結束的執行（關閉 server 時使用），回傳取消的數量"""
+        tasks = [run.task for run in self.runs.values() if not run.done and run.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return len(tasks)
+
+    async def _execute(self, run: RunBuffer, agent, message: str, slot, options: dict):
+        """消化 Agent 串流事件並寫入 buffer"""
+        try:
+            async with slot or nullcontext():
+                if callable(agent):
+                    agent = agent()
+                async for event in agent.astream(message, thread_id=run.thread_id, **options):
+                    if event["type"] == "final":
+                        event["message_count"] = agent.threads.turn_count(run.thread_id)
+                        event["thread_id"] = run.thread_id
+                    await run.publish(event)
+        except asyncio.CancelledError:
+            # 記錄取消事件後繼續往外拋，讓 task 正確標記為已取消
+            await run.publish({"type": "cancelled", "thread_id": run.thread_id})
+            raise
+        except Exception as e:
+            await run.publish({"type": "error", "detail": f"Agent error: {str(e)}"})
+        finally:
+            await run.finish()
+
+    def _prune(self):
+        """移除超過保留時間的已結束執行"""
+        now = time.monotonic()
+        expired = [
+            run_id for run_id, run in self.runs.items()
+            if run.done and now - run.finished_at > self.retention_seconds
+        ]
+        for run_id in expired:
+            del self.runs[run_id]
@@ -0,0 +1,294 @@
+"""
+Weighted Fair Scheduler - 多租戶加權公平排程
+在 Agent 執行前排隊，避免單一 client 的大量長任務餓死其他人
+
+- 加權公平佇列（WFQ）：每個請求依租戶權重取得虛擬完成時間，最小者優先執行
+- 全域與每個租戶的同時執行數上限
+- 每個租戶的 token bucket 速率限制（預設不限制，只受全域上限約束）
+- 每個租戶的佇列長度、等待時間與延遲統計；閒置的未設定租戶會被移除
+"""
+
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Optional
+
+
+class SchedulerRejected(Exception):
+    """租戶佇列已滿，請求被拒絕"""
+
+
+class TenantPolicy:
+    """租戶排程設定"""
+
+    def __init__(
+        self,
+        weight: float = 1.0,
+        max_concurrency: Optional[int] = None,
+        rate: Optional[float] = None,
+        burst: int = 5,
+        max_queue: Optional[int] = None,
+    ):
+        """
+        Args:
+            weight: WFQ 權重（越大分到越多執行機會）
+            max_concurrency: 此租戶最多同時執行幾個請求（None 表示只受全域上限限制）
+            rate: 每秒允許開始的請求數（token bucket 補充速率，None 表示不限制）
+            burst: token bucket 容量
+            max_queue: 排隊中的請求上限，超過則拒絕（None 表示不限制）
+        """
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TenantPolicy":
+        keys = ("weight", "max_concurrency", "rate", "burst", "max_queue")
+        return cls(**{k: data[k] for k in keys if k in data})
+
+
+class TokenBucket:
+    """Token bucket 速率限制"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """距離下一個 token 可用還要幾秒（0 表示現在就有）"""
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class _Waiter:
+    """排隊中的請求"""
+
+    def __init__(self, finish_tag: float, start_tag: float):
+        self.finish_tag = finish_tag
+        self.start_tag = start_tag
+        self.enqueued_at = time.monotonic()
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class _TenantState:
+    """租戶的排程狀態與統計"""
+
+    def __init__(self, policy: TenantPolicy):
+        self.policy = policy
+        self.bucket = TokenBucket(policy.rate, policy.burst) if policy.rate is not None else None
+        self.queue: Deque[_Waiter] = deque()
+        self.running = 0
+        self.last_active = time.monotonic()
+        self.last_finish_tag = 0.0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_times: Deque[float] = deque(maxlen=200)
+        self.latencies: Deque[float] = deque(maxlen=200)
+
+    def at_capacity(self, global_limit: int) -> bool:
+        limit = self.policy.max_concurrency
+        return self.running >= (global_limit if limit is None else limit)
+
+    def wait_time(self) -> float:
+        """距離速率限制允許下一個請求還要幾秒"""
+        return self.bucket.wait_time() if self.bucket is not None else 0.0
+
+    def idle_since(self, now: float) -> Optional[float]:
+        """沒有排隊與執行中的請求、速率限制也已回滿時，回傳閒置的秒數"""
+        if self.queue or self.running:
+            return None
+        if self.bucket is not None and not self.bucket.full():
+            return None  # 移除後重建會得到全滿的 bucket，等回滿再移除
+        return now - self.last_active
+
+    def snapshot(self) -> dict:
+        def percentile(values, p):
+            if not values:
+                return 0.0
+            ordered = sorted(values)
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 1)
+
+        return {
+            "weight": self.policy.weight,
+            "queued": len(self.queue),
+            "running": self.running,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "queue_wait_ms_p50": percentile(self.wait_times, 0.5),
+            "queue_wait_ms_p95": percentile(self.wait_times, 0.95),
+            "latency_ms_p50": percentile(self.latencies, 0.5),
+            "latency_ms_p95": percentile(self.latencies, 0.95),
+        }
+
+
+class FairScheduler:
+    """加權公平排程器"""
+
+    def __init__(
+        self,
+        max_concurrency: int = 4,
+        policies: Optional[Dict[str, TenantPolicy]] = None,
+        default_policy: Optional[TenantPolicy] = None,
+        idle_seconds: float = 600.0,
+    ):
+        """
+        Args:
+            max_concurrency: 全域同時執行的 Agent 數上限
+            policies: 各租戶的排程設定
+            default_policy: 未設定的租戶使用的排程設定
+            idle_seconds: 未設定的租戶閒置超過幾秒後移除其狀態
+        """
+        self.max_concurrency = max_concurrency
+        self.policies = policies or {}
+        self.default_policy = default_policy or TenantPolicy()
+        self.idle_seconds = idle_seconds
+        self.tenants: Dict[str, _TenantState] = {}
+        self.running = 0
+        self.virtual_time = 0.0
+        self.evicted = 0
+        self._last_sweep = time.monotonic()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+    def _tenant(self, tenant: str) -> _TenantState:
+        if tenant not in self.tenants:
+            self._evict_idle()
+            self.tenants[tenant] = _TenantState(self.policies.get(tenant, self.default_policy))
+        state = self.tenants[tenant]
+        state.last_active = time.monotonic()
+        return state
+
+    def _evict_idle(self):
+        """移除閒置的未設定租戶（設定檔中的租戶保留統計）"""
+        now = time.monotonic()
+        if now - self._last_sweep < min(60.0, self.idle_seconds):
+            return
+        self._last_sweep = now
+        for name in [n for n in self.tenants if n not in self.policies]:
+            idle = self.tenants[name].idle_since(now)
+            if idle is not None and idle > self.idle_seconds:
+                del self.tenants[name]
+                self.evicted += 1
+
+    def check_admission(self, tenant: str):
+        """
+        檢查租戶是否還能排隊（供需要提前回應的端點使用）
+
+        Raises:
+            SchedulerRejected: 租戶佇列已滿
+        """
+        state = self._tenant(tenant)
+        if state.policy.max_queue is not None and len(state.queue) >= state.policy.max_queue:
+            state.rejected += 1
+            raise SchedulerRejected(f"Too many queued requests for tenant '{tenant}'")
+
+    @asynccontextmanager
+    async def slot(self, tenant: str):
+        """
+        取得執行名額（排隊直到輪到此租戶）
+
+        Raises:
+            SchedulerRejected: 租戶佇列已滿
+        """
+        self.check_admission(tenant)
+        state = self._tenant(tenant)
+        start_tag = max(self.virtual_time, state.last_finish_tag)
+        waiter = _Waiter(start_tag + 1.0 / state.policy.weight, start_tag)
+        state.last_finish_tag = waiter.finish_tag
+        state.queue.append(waiter)
+        self._dispatch()
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.cancelled():
+                if waiter in state.queue:
+                    state.queue.remove(waiter)
+            else:
+                self._release(state)
+            raise
+
+        started = time.monotonic()
+        state.wait_times.append(started - waiter.enqueued_at)
+        try:
+            yield
+        finally:
+            state.latencies.append(time.monotonic() - waiter.enqueued_at)
+            state.completed += 1
+            state.last_active = time.monotonic()
+            self._release(state)
+
+    def _release(self, state: _TenantState):
+        state.running -= 1
+        self.running -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """依虛擬完成時間把空出的名額分給可執行的租戶"""
+        while self.running < self.max_concurrency:
+            best: Optional[_TenantState] = None
+            retry_in = None
+            for state in self.tenants.values():
+                if not state.queue or state.at_capacity(self.max_concurrency):
+                    continue
+                wait = state.wait_time()
+                if wait > 0:
+                    retry_in = wait if retry_in is None else min(retry_in, wait)
+                    continue
+                if best is None or state.queue[0].finish_tag < best.queue[0].finish_tag:
+                    best = state
+
+            if best is None:
+                if retry_in is not None and retry_in != float("inf"):
+                    self._schedule_wakeup(retry_in)
+                return
+
+            waiter = best.queue.popleft()
+            if waiter.future.done():  # 排隊中已被取消
+                continue
+            if best.bucket is not None:
+                best.bucket.take()
+            best.running += 1
+            self.running += 1
+            self.virtual_time = max(self.virtual_time, waiter.start_tag)
+            waiter.future.set_result(None)
+
+    def _schedule_wakeup(self, delay: float):
+        """速率限制中的租戶在 token 補充後重新排程"""
+        loop = asyncio.get_running_loop()
+        when = loop.time() + delay
+        pending = self._wakeup
+        if pending is not None and loop.time() < pending.when() <= when:
+            return  # 已經排了更早的喚醒
+        if pending is not None:
+            pending.cancel()
+        self._wakeup = loop.call_at(when, self._dispatch)
+
+    def stats(self) -> dict:
+        """全域與各租戶的排程統計"""
+        return {
+            "max_concurrency": self.max_concurrency,
+            "running": self.running,
+            "queued": sum(len(state.queue) for state in self.tenants.values()),
+            "evicted_tenants": self.evicted,
+            "tenants": {name: state.snapshot() for name, state in self.tenants.items()},
+        }
@@ -4,34 +4,305 @@ FastAPI Server for LangGraph ReAct Agent
 提供 HTTP API 介面，讓 client 可以遠端呼叫 Agentic AI
 """
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, WebSocket, Header, Query, Request
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 import uvicorn
+import asyncio
 import json
-from agent import AgenticChatBot
+import math
+import os
+import tempfile
+import time
+from agent import AgentDraining, AgenticChatBot
+from ws_session import WebSocketSession
+from run_events import RunManager
+from scheduler import FairScheduler, SchedulerRejected, TenantPolicy
+from workspace_pool import WorkspaceNotAllowed
+from profiling import RunProfiler, sample_stacks
+from resilience import BackendUnavailable
+from agent_profiles import AgentProfile, UnknownProfile, load_profiles
+from run_context import RunContext
+import wire
 from contextlib import asynccontextmanager
 
 # 全域 agent 實例
 agent: Optional[AgenticChatBot] = None
 
-# 儲存多個對話執行緒
-conversations: Dict[str, list] = {}
+# 兩階段模型路由（設定 FAST_MODEL_NAME 後啟用）
+FAST_MODEL_NAME = os.environ.get("FAST_MODEL_NAME")
+ESCALATE_AFTER_STEPS = int(os.environ.get("ESCALATE_AFTER_STEPS", "6"))
+SYNTHESIZE_WITH_STRONG = os.environ.get("SYNTHESIZE_WITH_STRONG", "1") != "0"
+
+# 每次 LLM 呼叫最多綁定幾個相關工具（0 表示綁定全部工具）
+TOOL_SELECTION_TOP_K = int(os.environ.get("TOOL_SELECTION_TOP_K", "6"))
+
+# WebSocket session 設定
+WS_HEARTBEAT_INTERVAL = float(os.environ.get("WS_HEARTBEAT_INTERVAL", "15"))
+WS_SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", "256"))
+
+# 可續傳事件串流設定
+RUN_BUFFER_SIZE = int(os.environ.get("RUN_BUFFER_SIZE", "1000"))
+RUN_RETENTION_SECONDS = float(os.environ.get("RUN_RETENTION_SECONDS", "300"))
+SSE_HEARTBEAT_INTERVAL = 15.0
+
+# 可由請求指定的 workspace 根目錄（以 os.pathsep 分隔，預設只允許目前目錄）
+ALLOWED_WORKSPACES = [p for p in os.environ.get("ALLOWED_WORKSPACES", "").split(os.pathsep) if p] or None
+WORKSPACE_POOL_SIZE = int(os.environ.get("WORKSPACE_POOL_SIZE", "4"))
+WORKSPACE_IDLE_SECONDS = float(os.environ.get("WORKSPACE_IDLE_SECONDS", "600"))
+
+# 對話執行緒閒置超過幾秒會被壓縮封存
+THREAD_ARCHIVE_SECONDS = float(os.environ.get("THREAD_ARCHIVE_SECONDS", "900"))
+
+# 多租戶排程設定（SCHEDULER_CONFIG 指向 JSON 設定檔）
+AGENT_MAX_CONCURRENCY = int(os.environ.get("AGENT_MAX_CONCURRENCY", "4"))
+SCHEDULER_CONFIG = os.environ.get("SCHEDULER_CONFIG")
+
+# LLM 與工具呼叫的逾時上限（秒），實際逾時依觀察到的延遲自動調整；後端故障時熔斷並回傳 503
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", "120"))
+TOOL_TIMEOUT_SECONDS = float(os.environ.get("TOOL_TIMEOUT_SECONDS", "30"))
+
+# 解析模型以 JSON 文字輸出的工具呼叫，並修正拼錯的工具與參數名稱（0 表示停用）
+TOOL_CALL_REPAIR = os.environ.get("TOOL_CALL_REPAIR", "1") != "0"
+
+# 連續幾步只是重複先前的工具呼叫就強制最終回答（0 表示停用迴圈偵測）
+LOOP_MAX_STALLED_STEPS = int(os.environ.get("LOOP_MAX_STALLED_STEPS", "2"))
+
+# token 預算：單次請求與單一執行緒累計的上限，用完時執行以說明訊息結束（0 表示不限制）
+REQUEST_TOKEN_BUDGET = int(os.environ.get("REQUEST_TOKEN_BUDGET", "0"))
+THREAD_TOKEN_BUDGET = int(os.environ.get("THREAD_TOKEN_BUDGET", "0"))
+
+# 長期記憶：每次請求取出 MEMORY_TOP_K 則相關的過去內容（0 表示停用），
+# 並只重播最近 HISTORY_WINDOW_TURNS 輪對話（0 表示重播完整歷史）
+MEMORY_TOP_K = int(os.environ.get("MEMORY_TOP_K", "0"))
+MEMORY_PATH = os.environ.get("MEMORY_PATH")
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL")
+HISTORY_WINDOW_TURNS = int(os.environ.get("HISTORY_WINDOW_TURNS", "0"))
+
+# 具名 Agent 設定（AGENT_PROFILES 指向 JSON 設定檔，格式見 agent_profiles.py）
+AGENT_PROFILES = os.environ.get("AGENT_PROFILES")
+
+# 啟動時預熱 LLM 後端，並定期送出 keep-alive 避免模型閒置被卸載（0 表示停用）
+WARMUP_ON_START = os.environ.get("WARMUP_ON_START", "1") != "0"
+KEEPALIVE_SECONDS = float(os.environ.get("KEEPALIVE_SECONDS", "240"))
+
+# 管理端點（/debug/profile 等）使用的 token，未設定時停用管理端點
+AGENT_ADMIN_TOKEN = os.environ.get("AGENT_ADMIN_TOKEN")
+
+# 回應超過幾個 bytes 時依 Accept-Encoding 以 zstd / gzip 壓縮（0 表示不壓縮）
+WIRE_COMPRESS_MIN_BYTES = int(os.environ.get("WIRE_COMPRESS_MIN_BYTES", "1024"))
+
+# 關閉 server 或熱重載時，等待執行中的對話結束的上限（秒）
+SHUTDOWN_DRAIN_SECONDS = float(os.environ.get("SHUTDOWN_DRAIN_SECONDS", "30"))
+
+
+def load_scheduler(path: Optional[str]) -> Tuple[FairScheduler, Dict[str, str]]:
+    """
+    讀取排程設定，回傳 (排程器, API key → 租戶名稱)
+
+    設定檔格式：
+    {
+      "max_concurrency": 4,
+      "default": {"weight": 1, "max_concurrency": 2, "rate": 1.0, "burst": 5, "max_queue": 20},
+      "tenants": {
+        "interactive": {"weight": 4, "max_concurrency": 2, "api_keys": ["key-1"]},
+        "batch": {"weight": 1, "max_concurrency": 4, "rate": 0.5, "api_keys": ["key-2"]}
+      }
+    }
+
+    未指定的欄位表示不限制（同時執行數只受全域的 max_concurrency 限制）；
+    沒有設定檔時所有請求屬於 "default" 租戶，只受 AGENT_MAX_CONCURRENCY 限制
+    """
+    config = {}
+    if path:
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+
+    policies = {}
+    api_keys = {}
+    for name, tenant in config.get("tenants", {}).items():
+        policies[name] = TenantPolicy.from_dict(tenant)
+        for key in tenant.get("api_keys", []):
+            api_keys[key] = name
+
+    scheduler = FairScheduler(
+        max_concurrency=config.get("max_concurrency", AGENT_MAX_CONCURRENCY),
+        policies=policies,
+        default_policy=TenantPolicy.from_dict(config.get("default", {}))
+    )
+    return scheduler, api_keys
+
+
+scheduler, tenant_api_keys = load_scheduler(SCHEDULER_CONFIG)
+
+
+def resolve_tenant(api_key: Optional[str], tenant_id: Optional[str]) -> str:
+    """
+    由 X-API-Key（優先）或 X-Tenant-ID header 決定租戶
+
+    X-Tenant-ID 只能指定設定檔中沒有 api_keys 的租戶，其他值一律視為 "default"，
+    client 無法以任意的租戶名稱繞過速率限制
+    """
+    if api_key and api_key in tenant_api_keys:
+        return tenant_api_keys[api_key]
+    if tenant_id in scheduler.policies and tenant_id not in tenant_api_keys.values():
+        return tenant_id
+    return "default"
+
+
+# 背景執行與 replay buffer
+runs = RunManager(max_events_per_run=RUN_BUFFER_SIZE, retention_seconds=RUN_RETENTION_SECONDS)
+
+
+# 預熱與 keep-alive 的背景工作、熱重載狀態、被取代後等待關閉的舊 Agent
+warm_task: Optional[asyncio.Task] = None
+reload_task: Optional[asyncio.Task] = None  # 進行中（或最近一次）的熱重載
+reload_state: Dict[str, Any] = {"status": "idle", "reloads": 0}
+retiring: Dict[asyncio.Task, AgenticChatBot] = {}
+
+
+def current_agent() -> AgenticChatBot:
+    """目前的 Agent（熱重載後為新的實例）"""
+    return agent
+
+
+def create_agent() -> AgenticChatBot:
+    """依環境變數建立（尚未初始化的）Agent"""
+    return AgenticChatBot(
+        fast_model=FAST_MODEL_NAME,
+        escalate_after_steps=ESCALATE_AFTER_STEPS,
+        synthesize_with_strong=SYNTHESIZE_WITH_STRONG,
+        tool_top_k=TOOL_SELECTION_TOP_K,
+        allowed_workspaces=ALLOWED_WORKSPACES,
+        workspace_pool_size=WORKSPACE_POOL_SIZE,
+        workspace_idle_seconds=WORKSPACE_IDLE_SECONDS,
+        thread_idle_seconds=THREAD_ARCHIVE_SECONDS,
+        llm_timeout=LLM_TIMEOUT_SECONDS,
+        tool_timeout=TOOL_TIMEOUT_SECONDS,
+        profiles=load_profiles(AGENT_PROFILES),
+        max_stalled_steps=LOOP_MAX_STALLED_STEPS,
+        request_token_budget=REQUEST_TOKEN_BUDGET,
+        thread_token_budget=THREAD_TOKEN_BUDGET,
+        memory_top_k=MEMORY_TOP_K,
+        memory_path=MEMORY_PATH,
+        embedding_model=EMBEDDING_MODEL,
+        history_window=HISTORY_WINDOW_TURNS,
+        repair_tool_calls=TOOL_CALL_REPAIR
+    )
+
+
+async def warm_and_keep_alive(bot: AgenticChatBot, warm_first: bool = True):
+    """背景預熱 LLM 後端，之後在後端閒置時定期送出 keep-alive"""
+    if warm_first:
+        try:
+            await bot.warmup()
+        except Exception as e:
+            # 預熱失敗不影響服務，第一個請求會自行載入模型
+            print(f"⚠️ 預熱失敗: {e}")
+            bot.warmed = True
+
+    # 只在 LLM 後端閒置超過 KEEPALIVE_SECONDS 時送出（有實際請求時模型本來就保持載入）
+    delay = KEEPALIVE_SECONDS
+    while KEEPALIVE_SECONDS > 0:
+        await asyncio.sleep(delay)
+        try:
+            delay = await bot.keep_alive(KEEPALIVE_SECONDS)
+        except Exception as e:
+            delay = KEEPALIVE_SECONDS
+            print(f"⚠️ Keep-alive 失敗: {e}")
+
+
+async def retire_agent(old: AgenticChatBot):
+    """等待舊 Agent 上的對話結束後關閉它的 workspace 後端"""
+    remaining = await old.drain(SHUTDOWN_DRAIN_SECONDS)
+    if remaining:
+        print(f"⚠️ 舊 Agent 仍有 {remaining} 個執行中的對話，強制關閉")
+    await old.aclose()
+    print("🧹 舊 Agent 已關閉")
+
+
+async def reload_agent() -> dict:
+    """
+    重新載入工具並重新編譯 Agent，完成後原子地換成新的實例
+
+    新 Agent 沿用舊 Agent 的對話歷史、token 用量、長期記憶與熔斷器狀態；
+    已開始的對話在舊實例上執行完畢，新的請求（包含排隊中的）使用新實例；
+    由 start_reload 啟動，同一時間只會有一個重載
+    """
+    global agent, warm_task
+    started = time.monotonic()
+    reload_state.update(status="reloading", error=None)
+    print("🔄 重新載入工具並重新編譯 Agent...")
+    try:
+        new_agent = create_agent()
+        new_agent.adopt(agent)
+        await new_agent.async_init()
+        if WARMUP_ON_START:
+            try:
+                await new_agent.warmup()
+            except Exception as e:
+                print(f"⚠️ 預熱失敗: {e}")
+        new_agent.warmed = True
+    except Exception as e:
+        reload_state.update(status="failed", error=str(e))
+        print(f"❌ 重新載入失敗，繼續使用目前的 Agent: {e}")
+        raise
+
+    old_agent, agent = agent, new_agent
+    if warm_task is not None:
+        warm_task.cancel()
+    warm_task = asyncio.create_task(warm_and_keep_alive(new_agent, warm_first=False))
+    task = asyncio.create_task(retire_agent(old_agent))
+    retiring[task] = old_agent
+    task.add_done_callback(lambda t: retiring.pop(t, None))
+
+    reload_state.update(
+        status="reloaded",
+        reloads=reload_state["reloads"] + 1,
+        tools=len(new_agent.tools),
+        seconds=round(time.monotonic() - started, 2),
+        finished_at=time.time()
+    )
+    print(f"✅ Agent 已重新載入（{len(new_agent.tools)} 個工具，{reload_state['seconds']}s）")
+    return dict(reload_state)
+
+
+def start_reload() -> asyncio.Task:
+    """
+    在背景開始熱重載
+
+    在回傳前（同一個 event loop 步驟內）就記錄進行中的 task，
+    同時送出的重載請求只有一個會開始，其他的回傳 409
+
+    Raises:
+        HTTPException: 已有重載在進行中
+    """
+    global reload_task
+    if reload_task is not None and not reload_task.done():
+        raise HTTPException(status_code=409, detail="Reload already in progress")
+    reload_task = asyncio.create_task(reload_agent())
+    return reload_task
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """應用程式生命週期管理"""
-    global agent
+    global agent, warm_task
 
     print("🚀 啟動 LangGraph Agent Server...")
     print("="*60)
 
     # 初始化 Agent
     try:
-        agent = AgenticChatBot()
+        agent = create_agent()
         await agent.async_init()  # 使用 async 初始化
+        if WARMUP_ON_START:
+            # 在背景預熱，完成前 /health 回傳 503
+            warm_task = asyncio.create_task(warm_and_keep_alive(agent))
+        else:
+            agent.warmed = True
+            warm_task = None
         print("\n✅ Agent Server 已就緒")
         print(f"📡 監聽位址: http://0.0.0.0:8011")
         print(f"📚 API 文檔: http://localhost:8011/docs")
@@ -42,8 +313,18 @@ async def lifespan(app: FastAPI):
 
     yield
 
-    # 清理資源
+    # 清理資源：停止接受新的執行，等待執行中的對話結束（最多 SHUTDOWN_DRAIN_SECONDS 秒）後關閉 MCP 子程序
     print("\n👋 關閉 Agent Server...")
+    if warm_task is not None:
+        warm_task.cancel()
+        await asyncio.gather(warm_task, return_exceptions=True)
+    remaining = await agent.drain(SHUTDOWN_DRAIN_SECONDS)
+    cancelled = await runs.cancel_all()
+    if remaining or cancelled:
+        print(f"⚠️ 已取消 {max(remaining, cancelled)} 個未完成的執行")
+    await asyncio.gather(*retiring, return_exceptions=True)
+    await agent.aclose()
+    print("✅ 已關閉所有 MCP 子程序")
 
 
 app = FastAPI(
@@ -58,7 +339,10 @@ class ChatRequest(BaseModel):
     """對話請求"""
     message: str
     thread_id: Optional[str] = "default"
-    verbose: bool = False
+    verbose: bool = False  # 回應中附上耗時分析（LLM / 工具 / 序列化 / graph）
+    cprofile: bool = False  # 耗時分析附上 cProfile 結果（需要 X-Admin-Token）
+    workspace: Optional[str] = None  # 工具操作的根目錄（需在 ALLOWED_WORKSPACES 中）
+    profile: Optional[str] = None  # 具名 Agent 設定（見 GET /profiles）
 
 
 class ChatResponse(BaseModel):
@@ -66,6 +350,8 @@ class ChatResponse(BaseModel):
     response: str
     thread_id: str
     message_count: int
+    usage: Optional[Dict[str, Any]] = None
+    profile: Optional[Dict[str, Any]] = None
 
 
 class StatusResponse(BaseModel):
@@ -73,6 +359,10 @@ class StatusResponse(BaseModel):
     status: str
     tools_count: int
     active_threads: int
+    scheduler: Dict[str, Any] = {}
+    tokens: Dict[str, Any] = {}
+    in_flight: int = 0
+    reload: Dict[str, Any] = {}
 
 
 @app.get("/")
@@ -88,9 +378,13 @@ async def root():
 
 @app.get("/health")
 async def health():
-    """健康檢查"""
+    """健康檢查（LLM 後端預熱完成前回傳 503，附 Retry-After 表示稍後即可就緒）"""
     if agent is None:
-        raise HTTPException(status_code=503, detail="Agent not initialized")
+        raise HTTPException(status_code=503, detail="Agent not initialized", headers={"Retry-After": "2"})
+    if agent.draining:
+        raise HTTPException(status_code=503, detail="Agent draining")
+    if not agent.warmed:
+        raise HTTPException(status_code=503, detail="Agent warming up", headers={"Retry-After": "2"})
 
     return {
         "status": "healthy",
@@ -108,12 +402,115 @@ async def get_status():
     return StatusResponse(
         status="running",
         tools_count=len(agent.tools),
-        active_threads=len(conversations)
+        active_threads=len(agent.threads),
+        scheduler=scheduler.stats(),
+        tokens=agent.usage.stats(),
+        in_flight=agent.in_flight + sum(old.in_flight for old in retiring.values()),
+        reload=reload_state
     )
 
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+@app.get("/metrics")
+async def get_metrics():
+    """取得執行統計（各模型執行步數等）"""
+    if agent is None:
+        raise HTTPException(status_code=503, detail="Agent not initialized")
+
+    return agent.get_metrics()
+
+
+def wire_response(request: Request, data: Any) -> Response:
+    """依 Accept / Accept-Encoding 以 JSON 或 MessagePack 編碼回應，並壓縮大的回應"""
+    body, media_type, headers = wire.encode_response(
+        data,
+        request.headers.get("accept"),
+        request.headers.get("accept-encoding"),
+        WIRE_COMPRESS_MIN_BYTES
+    )
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+def backend_unavailable(error: BackendUnavailable, run_started: bool = False) -> HTTPException:
+    """
+    後端熔斷或故障時的 503 回應
+
+    run_started 為 True 表示執行已開始（工具可能已經執行過），
+    加上 X-Run-Started header 告知 client 不可自動重送
+    """
+    headers = {"Retry-After": str(max(1, math.ceil(error.retry_after)))}
+    if run_started:
+        headers["X-Run-Started"] = "true"
+    return HTTPException(status_code=503, detail=str(error), headers=headers)
+
+
+def require_admin(token: Optional[str]):
+    """確認管理端點的 X-Admin-Token"""
+    if not AGENT_ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints disabled (set AGENT_ADMIN_TOKEN)")
+    if token != AGENT_ADMIN_TOKEN:
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+
+def history_tenant(api_key: Optional[str], tenant_id: Optional[str], admin_token: Optional[str]) -> Optional[str]:
+    """
+    可讀取對話歷史的租戶
+
+    一般請求只能看到自己租戶的執行緒；帶有效 X-Admin-Token 時回傳 None，表示所有租戶
+    """
+    if AGENT_ADMIN_TOKEN and admin_token == AGENT_ADMIN_TOKEN:
+        return None
+    return resolve_tenant(api_key, tenant_id)
+
+
+def check_thread_access(thread_id: str, tenant: Optional[str]):
+    """執行緒不存在或屬於其他租戶時回傳 404（不透露其他租戶的 thread_id 是否存在）"""
+    owner = agent.threads.owner(thread_id)
+    if owner is None or (tenant is not None and owner != tenant):
+        raise HTTPException(status_code=404, detail="Thread not found")
+
+
+def check_accepting():
+    """server 關閉中時回傳 503，讓 client 重試到其他 instance"""
+    if agent.draining:
+        raise HTTPException(status_code=503, detail="Server is shutting down", headers={"Retry-After": "5"})
+
+
+def check_llm_backend(profile: Optional[AgentProfile]):
+    """請求使用的 LLM 後端（profile 可以指定其他 endpoint）熔斷中時直接回傳 503，不進入排隊"""
+    try:
+        agent.llm_backend_for(profile).ensure_available()
+    except BackendUnavailable as e:
+        raise backend_unavailable(e)
+
+
+def check_profile(profile: Optional[str]) -> Optional[AgentProfile]:
+    """確認請求的 profile 存在並回傳其設定（None 表示預設設定）"""
+    try:
+        return agent.get_profile(profile)
+    except UnknownProfile as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def check_workspace(workspace: Optional[str]):
+    """確認請求的 workspace 在允許清單中"""
+    if workspace is None:
+        return
+    try:
+        agent.workspaces.resolve(workspace)
+    except WorkspaceNotAllowed as e:
+        raise HTTPException(status_code=403, detail=str(e))
+
+
+# 回應由 wire_response 依 Accept 編碼（JSON / MessagePack），不經過 FastAPI 的 response_model 序列化；
+# responses 只用於 OpenAPI 文件
+@app.post("/chat", response_model=None, responses={200: {"model": ChatResponse}})
+async def chat(
+    request: ChatRequest,
+    http_request: Request,
+    x_api_key: Optional[str] = Header(None),
+    x_tenant_id: Optional[str] = Header(None),
+    x_admin_token: Optional[str] = Header(None)
+):
     """
     與 Agentic AI 對話
 
@@ -122,53 +519,398 @@ async def chat(request: ChatRequest):
     if agent is None:
         raise HTTPException(status_code=503, detail="Agent not initialized")
 
+    check_accepting()
+    check_workspace(request.workspace)
+    check_llm_backend(check_profile(request.profile))
+    if request.cprofile:
+        # cProfile 會記錄整個 event loop 上的呼叫並拖慢所有請求，只開放給管理者
+        require_admin(x_admin_token)
+    tenant = resolve_tenant(x_api_key, x_tenant_id)
+    profiler = RunProfiler(cprofile=request.cprofile) if request.verbose or request.cprofile else None
+    run = RunContext(request.thread_id, tenant)
     try:
-        # 執行 Agent（自主多步驟執行）- 使用異步版本
-        response = await agent.achat(
-            user_message=request.message,
-            thread_id=request.thread_id
-        )
-
-        # 記錄對話歷史
-        if request.thread_id not in conversations:
-            conversations[request.thread_id] = []
-
-        conversations[request.thread_id].append({
-            "user": request.message,
-            "assistant": response
-        })
-
-        return ChatResponse(
+        # 依租戶排隊取得執行名額，再執行 Agent（自主多步驟執行）
+        async with scheduler.slot(tenant):
+            response = await agent.achat(
+                user_message=request.message,
+                thread_id=request.thread_id,
+                workspace=request.workspace,
+                profiler=profiler,
+                profile=request.profile,
+                run=run
+            )
+
+        result = ChatResponse(
             response=response,
             thread_id=request.thread_id,
-            message_count=len(conversations[request.thread_id])
+            message_count=agent.threads.turn_count(request.thread_id),
+            usage=agent.usage.report(run)
         )
-
+        if profiler is None:
+            return wire_response(http_request, result.model_dump())
+
+        # 回應本身的編碼時間無法放進回應內容，改以 Server-Timing header 回報
+        result.profile = profiler.report()
+        started = time.perf_counter()
+        encoded = wire_response(http_request, result.model_dump())
+        encoded.headers["Server-Timing"] = f"encode;dur={(time.perf_counter() - started) * 1000:.1f}"
+        return encoded
+
+    except SchedulerRejected as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except BackendUnavailable as e:
+        raise backend_unavailable(e, run_started=True)
+    except AgentDraining as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Agent error: {str(e)}")
+    finally:
+        # 排隊被拒或執行失敗時也要停止 cProfile
+        if profiler is not None:
+            profiler.stop()
+
+
+class RunResponse(BaseModel):
+    """背景執行回應"""
+    run_id: str
+    thread_id: str
+    events_url: str
+
+
+@app.post("/runs", response_model=RunResponse)
+async def create_run(
+    request: ChatRequest,
+    x_api_key: Optional[str] = Header(None),
+    x_tenant_id: Optional[str] = Header(None)
+):
+    """
+    在背景啟動一次 Agent 執行
+
+    執行不受 client 連線影響；透過 GET /runs/{run_id}/events 接收事件串流
+    """
+    if agent is None:
+        raise HTTPException(status_code=503, detail="Agent not initialized")
+
+    check_accepting()
+    check_workspace(request.workspace)
+    check_llm_backend(check_profile(request.profile))
+    tenant = resolve_tenant(x_api_key, x_tenant_id)
+    try:
+        scheduler.check_admission(tenant)
+    except SchedulerRejected as e:
+        raise HTTPException(status_code=429, detail=str(e))
+
+    run = runs.start(
+        current_agent,
+        request.message,
+        request.thread_id,
+        slot=scheduler.slot(tenant),
+        options={"workspace": request.workspace, "profile": request.profile, "tenant": tenant}
+    )
+    return RunResponse(
+        run_id=run.run_id,
+        thread_id=run.thread_id,
+        events_url=f"/runs/{run.run_id}/events"
+    )
+
+
+@app.get("/runs/{run_id}/events")
+async def stream_run_events(
+    run_id: str,
+    last_event_id: Optional[int] = None,
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID")
+):
+    """
+    以 Server-Sent Events 串流執行事件
+
+    帶上 Last-Event-ID header（或 last_event_id 參數）重新連線時，
+    會先補送漏掉的事件再繼續即時串流
+    """
+    run = runs.get(run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="Run not found")
+
+    if last_event_id is None:
+        try:
+            last_event_id = int(last_event_id_header) if last_event_id_header else 0
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID header")
+
+    async def event_stream():
+        cursor = last_event_id
+        while True:
+            pending = await run.events_after(cursor, timeout=SSE_HEARTBEAT_INTERVAL)
+            if not pending:
+                if run.done and cursor >= run.last_id:
+                    return
+                yield ": keep-alive\n\n"
+                continue
+            for event_id, event in pending:
+                cursor = event_id
+                data = wire.dumps_json(event).decode("utf-8")
+                yield f"id: {event_id}\nevent: {event['type']}\ndata: {data}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    """
+    持久的 WebSocket 對話 session
+
+    下行串流 token 與工具事件，上行傳送使用者訊息與取消訊號
+    """
+    await websocket.accept()
+    if agent is None:
+        await websocket.close(code=1013, reason="Agent not initialized")
+        return
+    if agent.draining:
+        await websocket.close(code=1012, reason="Server is shutting down")
+        return
+
+    tenant = resolve_tenant(websocket.headers.get("x-api-key"), websocket.headers.get("x-tenant-id"))
+    session = WebSocketSession(
+        websocket,
+        current_agent,
+        heartbeat_interval=WS_HEARTBEAT_INTERVAL,
+        send_queue_size=WS_SEND_QUEUE_SIZE,
+        slot_factory=lambda: scheduler.slot(tenant),
+        run_options={"tenant": tenant}
+    )
+    await session.run()
+
+
+@app.get("/conversations")
+async def list_conversations(
+    request: Request,
+    limit: int = Query(50, ge=1, le=1000),
+    cursor: int = Query(0, ge=0),
+    x_api_key: Optional[str] = Header(None),
+    x_tenant_id: Optional[str] = Header(None),
+    x_admin_token: Optional[str] = Header(None)
+):
+    """
+    分頁列出對話執行緒（cursor 為上一頁回傳的 next_cursor，刪除執行緒不會讓分頁錯位）
+
+    只列出請求租戶的執行緒；帶 X-Admin-Token 時列出所有租戶的執行緒
+    """
+    if agent is None:
+        raise HTTPException(status_code=503, detail="Agent not initialized")
+
+    tenant = history_tenant(x_api_key, x_tenant_id, x_admin_token)
+    threads = agent.threads.list_threads(after=cursor, limit=limit, tenant=tenant)
+    next_cursor = threads[-1]["cursor"] if len(threads) == limit else None
+    return wire_response(request, {
+        "threads": threads,
+        "count": len(threads),
+        "total": agent.threads.count(tenant),
+        "next_cursor": next_cursor
+    })
 
 
 @app.get("/conversations/{thread_id}")
-async def get_conversation(thread_id: str):
-    """取得特定對話執行緒的歷史"""
-    if thread_id not in conversations:
+async def get_conversation(
+    thread_id: str,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+    since_id: Optional[int] = None,
+    x_api_key: Optional[str] = Header(None),
+    x_tenant_id: Optional[str] = Header(None),
+    x_admin_token: Optional[str] = Header(None)
+):
+    """
+    取得特定對話執行緒的歷史（只能讀取自己租戶的執行緒，X-Admin-Token 不受限制）
+
+    不帶 limit 時回傳完整歷史；帶 limit 時分頁，
+    下一頁以回傳的 next_cursor 作為 since_id 取得
+    """
+    if agent is None:
+        raise HTTPException(status_code=503, detail="Agent not initialized")
+    check_thread_access(thread_id, history_tenant(x_api_key, x_tenant_id, x_admin_token))
+
+    if limit is None and since_id is None and offset == 0:
+        turns, next_cursor = agent.threads.turns(thread_id), None
+    else:
+        page = agent.threads.turns_page(thread_id, limit=limit or 1000, offset=offset, since_id=since_id)
+        turns, next_cursor = page if page is not None else (None, None)
+
+    if turns is None:
         raise HTTPException(status_code=404, detail="Thread not found")
 
-    return {
+    return wire_response(request, {
         "thread_id": thread_id,
-        "messages": conversations[thread_id],
-        "count": len(conversations[thread_id])
-    }
+        "messages": turns,
+        "count": len(turns),
+        "next_cursor": next_cursor
+    })
 
 
 @app.delete("/conversations/{thread_id}")
-async def clear_conversation(thread_id: str):
-    """清除特定對話執行緒"""
-    if thread_id in conversations:
-        del conversations[thread_id]
-        return {"status": "cleared", "thread_id": thread_id}
-    else:
+async def clear_conversation(
+    thread_id: str,
+    x_api_key: Optional[str] = Header(None),
+    x_tenant_id: Optional[str] = Header(None),
+    x_admin_token: Optional[str] = Header(None)
+):
+    """清除特定對話執行緒（只能清除自己租戶的執行緒，X-Admin-Token 不受限制）"""
+    if agent is None:
         raise HTTPException(status_code=404, detail="Thread not found")
+    check_thread_access(thread_id, history_tenant(x_api_key, x_tenant_id, x_admin_token))
+    agent.threads.delete(thread_id)
+    agent.usage.forget_thread(thread_id)
+    return {"status": "cleared", "thread_id": thread_id}
+
+
+@app.get("/export")
+async def export_conversations(
+    request: Request,
+    thread_id: Optional[List[str]] = Query(None),
+    x_admin_token: Optional[str] = Header(None)
+):
+    """
+    以 NDJSON 串流匯出對話（每行一則訊息），不會在記憶體中組出完整內容
+
+    不指定 thread_id 時匯出所有執行緒（包含所有租戶），因此需要 X-Admin-Token；
+    client 支援時以 zstd / gzip 逐段壓縮
+    """
+    require_admin(x_admin_token)
+    if agent is None:
+        raise HTTPException(status_code=503, detail="Agent not initialized")
+
+    thread_ids = thread_id or list(agent.threads.threads)
+
+    async def ndjson_chunks():
+        for tid in thread_ids:
+            lines = []
+            for row in agent.threads.export_rows(tid):
+                lines.append(wire.dumps_json(row) + b"\n")
+                if len(lines) >= 256:
+                    yield b"".join(lines)
+                    lines = []
+            if lines:
+                yield b"".join(lines)
+            await asyncio.sleep(0)  # 讓出 event loop，避免大量匯出卡住其他請求
+
+    headers = {"Content-Disposition": "attachment; filename=conversations.ndjson", "Vary": "Accept-Encoding"}
+    encoding = wire.choose_encoding(request.headers.get("accept-encoding")) if WIRE_COMPRESS_MIN_BYTES else None
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return StreamingResponse(
+        wire.compress_stream(ndjson_chunks(), encoding),
+        media_type="application/x-ndjson",
+        headers=headers
+    )
+
+
+@app.post("/import")
+async def import_conversations(
+    request: Request,
+    replace: bool = False,
+    x_admin_token: Optional[str] = Header(None)
+):
+    """
+    匯入 /export 產生的 NDJSON（需要 X-Admin-Token）
+
+    邊接收邊檢查，檢查過的訊息寫入暫存檔，記憶體用量與上傳大小無關；
+    全部內容檢查通過後才從暫存檔依序匯入，任何一行有誤時回傳 400 且不會修改既有的對話；
+    replace=true 時，匯入檔中出現的執行緒會先清空既有內容，否則接在既有內容之後
+    """
+    require_admin(x_admin_token)
+    if agent is None:
+        raise HTTPException(status_code=503, detail="Agent not initialized")
+
+    with tempfile.TemporaryFile() as spool:
+        thread_ids = set()
+        count = 0
+
+        def parse_line(line: bytes):
+            nonlocal count
+            if not line.strip():
+                return
+            row = json.loads(line)
+            agent.threads.validate_row(row)
+            spool.write(line.strip() + b"\n")
+            thread_ids.add(row["thread_id"])
+            count += 1
+
+        # 尚未遇到換行的片段先暫存，只切割新收到的 chunk（很長的一行不會被反覆複製）
+        pending: List[bytes] = []
+        try:
+            async for chunk in request.stream():
+                *lines, tail = chunk.split(b"\n")
+                if lines:
+                    parse_line(b"".join(pending + lines[:1]))
+                    for line in lines[1:]:
+                        parse_line(line)
+                    pending = []
+                if tail:
+                    pending.append(tail)
+            parse_line(b"".join(pending))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid NDJSON at message {count + 1}: {e}")
+
+        def spooled_rows():
+            spool.seek(0)
+            for line in spool:
+                yield json.loads(line)
+
+        imported = agent.threads.import_rows(spooled_rows(), replace=replace)
+    return {"status": "imported", "threads": len(thread_ids), "messages": imported}
+
+
+@app.get("/debug/profile", response_class=PlainTextResponse)
+async def debug_profile(
+    seconds: float = Query(5.0, gt=0, le=60),
+    interval_ms: float = Query(5.0, ge=1, le=1000),
+    x_admin_token: Optional[str] = Header(None)
+):
+    """
+    取樣執行中 server 所有執行緒的 stack，回傳 collapsed stack（可產生火焰圖）
+
+    例：curl -H "X-Admin-Token: ..." "localhost:8000/debug/profile?seconds=10" | flamegraph.pl > out.svg
+    """
+    require_admin(x_admin_token)
+    return await asyncio.to_thread(sample_stacks, seconds, interval_ms / 1000)
+
+
+@app.post("/admin/reload", status_code=202)
+async def admin_reload(response: Response, wait: bool = False, x_admin_token: Optional[str] = Header(None)):
+    """
+    重新載入工具（MCP schema、profile 設定）並重新編譯 Agent，不中斷服務
+
+    新的 Agent 在背景建立並預熱，完成後原子地取代目前的 Agent；
+    執行中的對話在舊 Agent 上完成後才關閉舊的 MCP 子程序。wait=true 時等待重新載入完成
+    """
+    require_admin(x_admin_token)
+    if agent is None:
+        raise HTTPException(status_code=503, detail="Agent not initialized")
+    task = start_reload()
+    if not wait:
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())  # 錯誤已記錄在 reload_state
+        return {"status": "reloading"}
+    try:
+        result = await task
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Reload failed: {e}")
+    response.status_code = 200
+    return result
+
+
+@app.get("/profiles")
+async def list_profiles():
+    """列出可用的具名 Agent 設定"""
+    if agent is None:
+        raise HTTPException(status_code=503, detail="Agent not initialized")
+
+    return {
+        "default": {"model": agent.model, "base_url": agent.base_url},
+        "profiles": {name: profile.describe() for name, profile in agent.profiles.items()}
+    }
 
 
 @app.get("/tools")
@@ -197,5 +939,6 @@ if __name__ == "__main__":
         host="0.0.0.0",
         port=8011,
         reload=False,  # 生產環境關閉 reload
-        log_level="info"
+        log_level="info",
+        timeout_graceful_shutdown=int(SHUTDOWN_DRAIN_SECONDS)
     )
@@ -0,0 +1,8 @@
+"""
+pytest 設定：專案模組放在根目錄（不是套件），測試時加入 sys.path
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
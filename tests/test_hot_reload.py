@@ -0,0 +1,106 @@
+"""熱重載：drain 等待執行中的對話並拒絕新的執行，adopt 讓新 Agent 沿用舊 Agent 的狀態，同時只有一個重載"""
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from langchain_core.messages import AIMessage, HumanMessage
+
+import server
+from agent import AgentDraining, AgenticChatBot
+from run_context import RunContext
+
+
+def test_drain_waits_for_in_flight_runs_and_rejects_new_ones():
+    bot = AgenticChatBot()
+
+    async def main():
+        release = asyncio.Event()
+
+        async def run():
+            with bot._track_run():
+                await release.wait()
+
+        task = asyncio.create_task(run())
+        await asyncio.sleep(0)
+        assert bot.in_flight == 1
+
+        drain = asyncio.create_task(bot.drain(timeout=5))
+        await asyncio.sleep(0)
+        with pytest.raises(AgentDraining):
+            with bot._track_run():
+                pass
+        assert not drain.done()
+
+        release.set()
+        assert await drain == 0
+        await task
+
+    asyncio.run(main())
+
+
+def test_drain_timeout_reports_remaining_runs():
+    bot = AgenticChatBot()
+
+    async def main():
+        release = asyncio.Event()
+
+        async def run():
+            with bot._track_run():
+                await release.wait()
+
+        task = asyncio.create_task(run())
+        await asyncio.sleep(0)
+        remaining = await bot.drain(timeout=0.01)
+        release.set()
+        await task
+        return remaining
+
+    assert asyncio.run(main()) == 1
+    assert bot.in_flight == 0
+
+
+def test_adopt_shares_runtime_state_with_the_old_agent():
+    old, new = AgenticChatBot(), AgenticChatBot()
+    old.threads.append("t1", [HumanMessage(content="hi"), AIMessage(content="hello")])
+    old.usage.record(RunContext("t1"), 10, 5, estimated=False)
+    old.llm_backend.breaker._open()
+
+    new.adopt(old)
+    assert new.threads.to_messages("t1") == old.threads.to_messages("t1")
+    assert new.usage.thread_tokens(RunContext("t1")) == 15
+    assert new.llm_backend.breaker.state == "open"
+
+    # 交接期間在舊 Agent 上結束的對話，新 Agent 也看得到
+    old.threads.append("t1", [HumanMessage(content="again"), AIMessage(content="done")])
+    assert new.threads.turn_count("t1") == 2
+
+
+def test_adopt_after_init_is_rejected():
+    old, new = AgenticChatBot(), AgenticChatBot()
+    new._initialized = True
+    with pytest.raises(RuntimeError):
+        new.adopt(old)
+
+
+def test_concurrent_reload_requests_start_one_reload(monkeypatch):
+    started = []
+
+    async def fake_reload():
+        started.append(1)
+        await asyncio.sleep(0.01)
+        return {"status": "reloaded"}
+
+    monkeypatch.setattr(server, "reload_agent", fake_reload)
+    monkeypatch.setattr(server, "reload_task", None)
+
+    async def main():
+        task = server.start_reload()
+        with pytest.raises(HTTPException) as rejected:
+            server.start_reload()
+        assert rejected.value.status_code == 409
+        await task
+        await server.start_reload()  # 上一次完成後可以再次重載
+
+    asyncio.run(main())
+    assert len(started) == 2
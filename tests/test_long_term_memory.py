@@ -0,0 +1,76 @@
+"""long_term_memory：向量索引的擴充與搜尋、記憶範圍與記錄時間"""
+
+import numpy as np
+from langchain_core.messages import AIMessage, ToolMessage
+
+from long_term_memory import LongTermMemory, VectorIndex
+
+
+def _unit(rows: int, dim: int, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).normal(size=(rows, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_in_memory_index_grows_and_keeps_vectors():
+    vectors = _unit(10, 8)
+    index = VectorIndex(8, initial_capacity=2)
+    for row in range(10):
+        index.add(vectors[row:row + 1], [{"row": row}])
+
+    assert index.count == 10
+    assert len(index.vectors) >= 10
+    np.testing.assert_allclose(index.vectors[:10], vectors)
+    assert index.search(vectors[7], top_k=1)[0][0] == 7
+
+
+def test_memmap_index_grows_and_reopens(tmp_path):
+    vectors = _unit(5, 8, seed=1)
+    index = VectorIndex(8, str(tmp_path), initial_capacity=2)
+    index.add(vectors[:3], [{"row": row} for row in range(3)])
+    index.add(vectors[3:], [{"row": row} for row in range(3, 5)])
+    del index
+
+    reopened = VectorIndex(8, str(tmp_path), initial_capacity=2)
+    assert reopened.count == 5
+    assert [item["row"] for item in reopened.metadata] == [0, 1, 2, 3, 4]
+    np.testing.assert_allclose(reopened.vectors[:5], vectors)
+
+
+def test_batched_search_matches_full_ranking_and_respects_mask():
+    vectors = _unit(50, 16, seed=2)
+    index = VectorIndex(16)
+    index.add(vectors, [{} for _ in range(50)])
+    query = vectors[3]
+
+    expected = list(np.argsort(-(vectors @ query))[:5])
+    assert [i for i, _ in index.search(query, top_k=5, batch_size=7)] == expected
+
+    mask = np.zeros(50, dtype=bool)
+    mask[[10, 20, 30]] = True
+    assert sorted(i for i, _ in index.search(query, top_k=5, mask=mask, batch_size=7)) == [10, 20, 30]
+
+
+def _turn(tool: str, output: str):
+    return [
+        AIMessage(content="", tool_calls=[{"name": tool, "args": {"path": "notes.txt"}, "id": "1"}]),
+        ToolMessage(content=output, tool_call_id="1", name=tool),
+        AIMessage(content="完成"),
+    ]
+
+
+def test_recall_is_limited_to_scope_and_tagged_with_time():
+    memory = LongTermMemory(min_score=0.0)
+    memory.remember_turn("t1", "alice:/repo", "讀 notes.txt", _turn("read_file", "部署密碼在保險箱"))
+
+    recalled = memory.recall("notes.txt 部署密碼", "alice:/repo")
+    assert any("部署密碼在保險箱" in text for text in recalled)
+    assert all(text.startswith("[") and "記錄]" in text for text in recalled)
+    assert memory.recall("notes.txt 部署密碼", "bob:/repo") == []
+
+
+def test_skips_tools_outside_remember_list():
+    memory = LongTermMemory(min_score=0.0, remember_tools=["read_file"])
+    added = memory.remember_turn("t1", "default:/repo", "寫 notes.txt", _turn("write_file", "Successfully wrote"))
+
+    assert added == 1  # 只有問答本身
+    assert not any("Successfully wrote" in item["text"] for item in memory.index.metadata)
@@ -0,0 +1,99 @@
+"""loop_detection：重複的工具呼叫直接回傳先前結果，沒有進展時不綁定工具強制最終回答"""
+
+import asyncio
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.tools import StructuredTool
+
+from loop_detection import FINAL_ANSWER_NUDGE, REPEAT_NUDGE, LoopGuardModel, LoopStats, guard_repeats, stalled_steps
+from run_context import RunContext, run_scope
+
+
+class _Model:
+    """回傳固定訊息的假模型，記錄收到的輸入與是否綁定工具"""
+
+    def __init__(self, calls, tools=None):
+        self.calls = calls
+        self.tools = tools
+
+    def bind_tools(self, tools, **kwargs):
+        return _Model(self.calls, [t.name for t in tools])
+
+    def invoke(self, input, config=None, **kwargs):
+        self.calls.append((self.tools, input))
+        return AIMessage("ok")
+
+
+def _step(path: str, call_id: str) -> list:
+    return [
+        AIMessage("", tool_calls=[{"name": "list_directory", "args": {"path": path}, "id": call_id}]),
+        ToolMessage("a.py", tool_call_id=call_id),
+    ]
+
+
+def _history(*paths: str) -> list:
+    messages = [HumanMessage("列出目錄")]
+    for i, path in enumerate(paths):
+        messages += _step(path, f"c{i}")
+    return messages
+
+
+def _tool(name: str, calls: list) -> StructuredTool:
+    async def run(path: str) -> str:
+        calls.append((name, path))
+        return f"{name} {path} #{len(calls)}"
+    return StructuredTool.from_function(coroutine=run, name=name, description=name)
+
+
+def test_stalled_steps_counts_trailing_repeats():
+    assert stalled_steps(_history(".", "src")) == 0
+    assert stalled_steps(_history(".", ".", ".")) == 2
+    assert stalled_steps(_history(".", ".", "src")) == 0
+    # 新的使用者訊息重新計算
+    assert stalled_steps(_history(".", ".") + [AIMessage("done"), HumanMessage("再一次")]) == 0
+
+
+def test_guard_forces_final_answer_without_tools():
+    calls, stats = [], LoopStats()
+    model = LoopGuardModel(_Model(calls), max_stalled_steps=2, stats=stats).bind_tools(
+        [_tool("list_directory", [])]
+    )
+
+    model.invoke(_history(".", "."))
+    assert calls[-1][0] == ["list_directory"]
+
+    context = RunContext("t1")
+    with run_scope(context):
+        model.invoke(_history(".", ".", "."))
+    tools, forced_input = calls[-1]
+    assert tools is None  # 不綁定工具，模型只能直接回答
+    assert forced_input[-1].content == FINAL_ANSWER_NUDGE
+    assert context.forced_final
+    assert stats.forced_final_answers == 1
+
+
+def test_repeated_read_only_call_returns_previous_result():
+    calls, stats = [], LoopStats()
+    read, write = guard_repeats([_tool("read_file", calls), _tool("write_file", calls)], ["read_file"], stats)
+
+    async def main():
+        with run_scope(RunContext("t1")):
+            first = await read.ainvoke({"path": "a.py"})
+            again = await read.ainvoke({"path": "a.py"})
+            await write.ainvoke({"path": "a.py"})
+            after_write = await read.ainvoke({"path": "a.py"})
+        return first, again, after_write
+
+    first, again, after_write = asyncio.run(main())
+    assert again == f"{first}\n\n{REPEAT_NUDGE}"
+    assert after_write != first  # 寫入後快取清空，重新讀取
+    assert calls == [("read_file", "a.py"), ("write_file", "a.py"), ("read_file", "a.py")]
+    assert stats.repeated_tool_calls == 1
+
+
+def test_calls_outside_a_run_are_not_cached():
+    calls = []
+    (read,) = guard_repeats([_tool("read_file", calls)], ["read_file"], LoopStats())
+    asyncio.run(read.ainvoke({"path": "a.py"}))
+    asyncio.run(read.ainvoke({"path": "a.py"}))
+    assert len(calls) == 2
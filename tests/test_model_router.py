@@ -0,0 +1,87 @@
+"""model_router：升級規則與最終回答由大模型生成"""
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from model_router import ModelRouter
+from run_context import RETRY_TAG
+
+
+class _Scripted:
+    """回傳固定訊息的假模型，記錄每次呼叫的 config"""
+
+    def __init__(self, message):
+        self.message = message
+        self.configs = []
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def invoke(self, input, config=None, **kwargs):
+        self.configs.append(config or {})
+        return self.message
+
+
+TOOL_CALL = AIMessage("", tool_calls=[{"name": "read_file", "args": {"path": "a.py"}, "id": "c1"}])
+MALFORMED = AIMessage("", invalid_tool_calls=[{"name": "read_file", "args": "{", "id": "c1", "error": "bad json"}])
+ANSWER = AIMessage("小模型的回答")
+STRONG = AIMessage("大模型的回答")
+
+
+def _router(fast_message, **kwargs):
+    fast, strong = _Scripted(fast_message), _Scripted(STRONG)
+    return ModelRouter(fast, strong, "fast", "strong", escalate_after_steps=3, **kwargs), fast, strong
+
+
+def _streamed(config) -> bool:
+    return RETRY_TAG not in config.get("tags", [])
+
+
+def test_tool_call_stays_on_fast_model():
+    router, fast, strong = _router(TOOL_CALL)
+    assert router.invoke([HumanMessage("列出檔案")]) is TOOL_CALL
+    assert not strong.configs
+    assert router.stats.steps == {"fast": 1, "strong": 0}
+
+
+def test_final_answer_is_synthesized_by_strong_model():
+    router, fast, strong = _router(ANSWER)
+    assert router.invoke([HumanMessage("hi")]) is STRONG
+    # 小模型的回答會被捨棄，不串流；只串流大模型的最終回答
+    assert not _streamed(fast.configs[0])
+    assert _streamed(strong.configs[0])
+    assert router.stats.escalations == {"final_answer": 1}
+
+
+def test_fast_final_answer_kept_when_synthesis_disabled():
+    router, fast, strong = _router(ANSWER, synthesize_with_strong=False)
+    assert router.invoke([HumanMessage("hi")]) is ANSWER
+    assert _streamed(fast.configs[0])
+    assert not strong.configs
+
+
+def test_malformed_call_escalates():
+    router, _, strong = _router(MALFORMED, synthesize_with_strong=False)
+    assert router.invoke([HumanMessage("hi")]) is STRONG
+    assert not _streamed(strong.configs[0])  # 小模型的輸出已經串流過
+    assert router.stats.escalations == {"malformed_tool_call": 1}
+
+
+def test_tool_error_routes_straight_to_strong_model():
+    router, fast, _ = _router(TOOL_CALL)
+    messages = [HumanMessage("讀檔"), TOOL_CALL, ToolMessage("not found", tool_call_id="c1", status="error")]
+    assert router.invoke(messages) is STRONG
+    assert not fast.configs
+    assert router.stats.escalations == {"tool_error": 1}
+
+
+def test_step_threshold_routes_straight_to_strong_model():
+    router, fast, _ = _router(TOOL_CALL)
+    messages = [HumanMessage("讀檔")]
+    for i in range(3):
+        messages += [TOOL_CALL, ToolMessage("ok", tool_call_id="c1")]
+    assert router.invoke(messages) is STRONG
+    assert not fast.configs
+    assert router.stats.escalations == {"step_threshold": 1}
+
+    # 新的使用者訊息重新計算步數
+    assert router.invoke(messages + [AIMessage("done"), HumanMessage("再一次")]) is TOOL_CALL
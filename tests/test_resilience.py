@@ -0,0 +1,175 @@
+"""resilience：熔斷器狀態轉換、自適應逾時、重試與串流呼叫的逾時"""
+
+import asyncio
+
+import pytest
+
+from resilience import (
+    AdaptiveTimeout,
+    BackendUnavailable,
+    CircuitBreaker,
+    ResilientBackend,
+    StreamProgress,
+)
+
+
+def _backend(**kwargs) -> ResilientBackend:
+    kwargs.setdefault("breaker", CircuitBreaker(min_calls=2, open_seconds=30.0))
+    kwargs.setdefault("timeout", AdaptiveTimeout(initial=0.05, minimum=0.01, maximum=0.05))
+    return ResilientBackend("test", backoff_base=0.0, **kwargs)
+
+
+def _failing(error: Exception, calls: list):
+    async def fn():
+        calls.append(1)
+        raise error
+    return fn
+
+
+def test_breaker_opens_probes_and_closes():
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=4, open_seconds=30.0)
+    for ok in (True, False, True):
+        breaker.record_success() if ok else breaker.record_failure()
+    assert breaker.state == "closed"
+
+    breaker.record_failure()  # 2 / 4 失敗
+    assert breaker.state == "open"
+    assert breaker.blocked_for() > 0
+
+    breaker.opened_at -= 31  # 冷卻結束
+    assert breaker.blocked_for() is None
+    assert breaker.state == "half_open"
+    assert breaker.blocked_for() == 1.0  # 探測中，其他呼叫直接失敗
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.blocked_for() is None
+
+
+def test_failed_probe_reopens_breaker():
+    breaker = CircuitBreaker(min_calls=1, open_seconds=30.0)
+    breaker.record_failure()
+    breaker.opened_at -= 31
+    assert breaker.blocked_for() is None
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.times_opened == 2
+
+
+def test_adaptive_timeout_follows_latency_within_bounds():
+    timeout = AdaptiveTimeout(initial=60.0, minimum=1.0, maximum=30.0, multiplier=3.0, min_samples=5)
+    for _ in range(4):
+        timeout.observe(2.0)
+    assert timeout.current() == 60.0  # 樣本不足
+
+    timeout.observe(2.0)
+    assert timeout.current() == 6.0
+
+    for _ in range(5):
+        timeout.observe(0.01)
+    assert timeout.current() == 6.0  # p99 仍是 2 秒
+
+    fast = AdaptiveTimeout(initial=60.0, minimum=1.0, maximum=30.0, min_samples=1)
+    fast.observe(0.01)
+    assert fast.current() == 1.0
+    fast.observe(100.0)
+    assert fast.current() == 30.0
+
+
+def test_idempotent_call_retries_then_opens_breaker():
+    backend = _backend(breaker=CircuitBreaker(min_calls=3, open_seconds=30.0))
+    calls = []
+    with pytest.raises(BackendUnavailable):
+        asyncio.run(backend.call(_failing(ConnectionError("refused"), calls)))
+
+    assert len(calls) == 1 + backend.retries
+    assert backend.retried == backend.retries
+    assert backend.breaker.state == "open"
+
+    # 熔斷中直接失敗，不會呼叫後端
+    with pytest.raises(BackendUnavailable):
+        asyncio.run(backend.call(_failing(ConnectionError("refused"), calls)))
+    assert len(calls) == 1 + backend.retries
+    assert backend.rejected == 1
+
+
+def test_open_breaker_stops_retries():
+    backend = _backend()  # 兩次失敗就熔斷
+    calls = []
+    with pytest.raises(BackendUnavailable, match="circuit open"):
+        asyncio.run(backend.call(_failing(ConnectionError("refused"), calls)))
+    assert len(calls) == 2
+
+
+def test_non_idempotent_call_is_not_retried():
+    backend = _backend(breaker=CircuitBreaker(min_calls=10))
+    calls = []
+    with pytest.raises(BackendUnavailable):
+        asyncio.run(backend.call(_failing(ConnectionError("reset"), calls), idempotent=False))
+    assert len(calls) == 1
+
+
+def test_request_errors_do_not_count_as_backend_failures():
+    backend = _backend()
+    calls = []
+    for _ in range(3):
+        with pytest.raises(FileNotFoundError):
+            asyncio.run(backend.call(_failing(FileNotFoundError("missing.txt"), calls)))
+    assert len(calls) == 3
+    assert backend.failures == 0
+    assert backend.breaker.state == "closed"
+
+
+def test_slow_call_times_out():
+    backend = _backend(breaker=CircuitBreaker(min_calls=10))
+
+    async def slow():
+        await asyncio.sleep(1)
+
+    with pytest.raises(BackendUnavailable, match="timed out"):
+        asyncio.run(backend.call(slow))
+    assert backend.timeouts == 1 + backend.retries
+
+
+def _streaming(progress: StreamProgress, tokens: int, gap: float, fail: bool = False):
+    async def fn():
+        for _ in range(tokens):
+            await asyncio.sleep(gap)
+            progress.on_llm_new_token("x")
+        if fail:
+            raise ConnectionError("stream dropped")
+        return "done"
+    return fn
+
+
+def test_streaming_call_only_times_out_between_tokens():
+    backend = _backend(timeout=AdaptiveTimeout(initial=0.2, minimum=0.01, maximum=0.2))
+    progress = StreamProgress()
+    # 總時間約 0.5 秒，超過 0.2 秒的逾時，但每段輸出之間都在逾時內
+    assert asyncio.run(backend.call(_streaming(progress, 10, 0.05), progress=progress)) == "done"
+    assert backend.timeouts == 0
+    assert backend.timeout.samples[-1] < 0.2  # 只記錄第一個 token 的延遲
+
+
+def test_streamed_call_is_not_retried():
+    backend = _backend(breaker=CircuitBreaker(min_calls=10))
+    progress = StreamProgress()
+    with pytest.raises(BackendUnavailable):
+        asyncio.run(backend.call(_streaming(progress, 2, 0.0, fail=True), progress=progress))
+    assert backend.calls == 1
+    assert backend.retried == 0
+
+
+def test_ping_bypasses_breaker_and_stats():
+    backend = _backend()
+    backend.breaker._open()
+
+    async def ok():
+        return "pong"
+
+    assert asyncio.run(backend.ping(ok)) == "pong"
+    assert backend.pings == 1
+    assert backend.calls == 0
+    assert not backend.timeout.samples
+    assert backend.idle_seconds() == float("inf")
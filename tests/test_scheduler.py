@@ -0,0 +1,100 @@
+"""scheduler：加權公平排程、同時執行上限、速率限制與閒置租戶的移除"""
+
+import asyncio
+
+import pytest
+
+from scheduler import FairScheduler, SchedulerRejected, TenantPolicy
+
+
+async def _run_jobs(scheduler, jobs, hold=0.01):
+    """依序送出 (租戶, 數量) 的請求，回傳取得執行名額的租戶順序與最大同時執行數"""
+    order = []
+    peak = {"all": 0}
+    running = {"all": 0}
+
+    async def job(tenant):
+        async with scheduler.slot(tenant):
+            order.append(tenant)
+            running["all"] += 1
+            running[tenant] = running.get(tenant, 0) + 1
+            peak["all"] = max(peak["all"], running["all"])
+            peak[tenant] = max(peak.get(tenant, 0), running[tenant])
+            await asyncio.sleep(hold)
+            running["all"] -= 1
+            running[tenant] -= 1
+
+    tasks = []
+    for tenant, count in jobs:
+        tasks += [asyncio.create_task(job(tenant)) for _ in range(count)]
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    return order, peak
+
+
+def test_weighted_tenant_overtakes_backlog():
+    scheduler = FairScheduler(
+        max_concurrency=1,
+        policies={"interactive": TenantPolicy(weight=4), "batch": TenantPolicy(weight=1)},
+    )
+    order, _ = asyncio.run(_run_jobs(scheduler, [("batch", 10), ("interactive", 4)]))
+    # batch 先排了 10 個，interactive 的 4 個仍應在前半段完成
+    assert max(i for i, tenant in enumerate(order) if tenant == "interactive") < 8
+    assert scheduler.stats()["tenants"]["batch"]["completed"] == 10
+
+
+def test_default_policy_is_limited_only_by_global_concurrency():
+    scheduler = FairScheduler(max_concurrency=4)
+    _, peak = asyncio.run(_run_jobs(scheduler, [("default", 12)]))
+    assert peak["all"] == 4
+
+
+def test_tenant_concurrency_cap():
+    scheduler = FairScheduler(max_concurrency=4, policies={"batch": TenantPolicy(max_concurrency=1)})
+    _, peak = asyncio.run(_run_jobs(scheduler, [("batch", 4), ("default", 4)]))
+    assert peak["batch"] == 1
+    assert peak["all"] <= 4
+
+
+def test_rate_limit_spaces_out_starts():
+    scheduler = FairScheduler(max_concurrency=5, default_policy=TenantPolicy(rate=20, burst=1))
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await _run_jobs(scheduler, [("default", 5)], hold=0)
+        return loop.time() - started
+
+    assert asyncio.run(main()) >= 0.15  # 第一個用掉 burst，其餘每 50ms 一個
+
+
+def test_queue_limit_rejects():
+    scheduler = FairScheduler(max_concurrency=1, default_policy=TenantPolicy(max_queue=1))
+
+    async def main():
+        gate = asyncio.Event()
+
+        async def hold():
+            async with scheduler.slot("default"):
+                await gate.wait()
+
+        running = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        queued = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerRejected):
+            scheduler.check_admission("default")
+        gate.set()
+        await asyncio.gather(running, queued)
+
+    asyncio.run(main())
+    assert scheduler.stats()["tenants"]["default"]["rejected"] == 1
+
+
+def test_idle_unconfigured_tenants_are_evicted():
+    scheduler = FairScheduler(max_concurrency=2, policies={"kept": TenantPolicy()}, idle_seconds=0)
+    asyncio.run(_run_jobs(scheduler, [("kept", 1), ("a", 1), ("b", 1)], hold=0))
+    scheduler._last_sweep = 0.0
+    scheduler.check_admission("c")
+    assert set(scheduler.tenants) == {"kept", "c"}
+    assert scheduler.stats()["evicted_tenants"] == 2
@@ -0,0 +1,107 @@
+"""thread_store：匯出 / 匯入往返、封存還原與同一執行緒的依序執行"""
+
+import asyncio
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from thread_store import ThreadStore
+
+
+def _conversation():
+    return [
+        HumanMessage(content="列出檔案"),
+        AIMessage(content="", tool_calls=[{"name": "list_directory", "args": {"path": "."}, "id": "c1"}]),
+        ToolMessage(content=[{"type": "text", "text": "a.py\nb.py"}], tool_call_id="c1", name="list_directory"),
+        AIMessage(content="有 a.py 與 b.py"),
+    ]
+
+
+def _dump(store, thread_id):
+    return [(type(m).__name__, m.content, getattr(m, "tool_calls", None)) for m in store.to_messages(thread_id)]
+
+
+@pytest.mark.parametrize("archived", [False, True])
+def test_export_import_round_trip(archived):
+    source = ThreadStore()
+    source.append("t1", _conversation())
+    source.append("t2", [HumanMessage(content="hi"), AIMessage(content="hello")])
+    if archived:
+        source.idle_seconds = -1
+        assert source.archive_idle(force=True) == 2
+
+    rows = [row for tid in ("t1", "t2") for row in source.export_rows(tid)]
+    for row in rows:
+        ThreadStore.validate_row(row)
+
+    target = ThreadStore()
+    assert target.import_rows(rows) == 6
+    assert _dump(target, "t1") == _dump(source, "t1")
+    assert _dump(target, "t2") == _dump(source, "t2")
+    assert [r["seq"] for r in target.export_rows("t1")] == [1, 2, 3, 4]
+    assert target.turn_count("t1") == source.turn_count("t1") == 1
+
+
+def test_import_replace_only_clears_imported_threads():
+    store = ThreadStore()
+    store.append("t1", [HumanMessage(content="old"), AIMessage(content="old answer")])
+    store.append("t2", [HumanMessage(content="keep"), AIMessage(content="kept")])
+    rows = [
+        {"thread_id": "t1", "role": "human", "content": "new"},
+        {"thread_id": "t1", "role": "ai", "content": "new answer"},
+    ]
+
+    assert store.import_rows(rows, replace=True) == 2
+    assert [m.content for m in store.to_messages("t1")] == ["new", "new answer"]
+    assert [m.content for m in store.to_messages("t2")] == ["keep", "kept"]
+
+
+@pytest.mark.parametrize("row", [
+    {"role": "human", "content": "x"},
+    {"thread_id": "t", "role": "robot", "content": "x"},
+    {"thread_id": "t", "role": "ai", "tool_calls": [{"args": {}}]},
+    {"thread_id": "t", "role": "ai", "tool_calls": [{"name": "f", "args": "[]"}]},
+    {"thread_id": "t", "role": "human", "tool_calls": [{"name": "f", "args": {}, "id": "c1"}]},
+    {"thread_id": "t", "role": "ai", "tool_calls": [{"name": "f", "args": {}, "id": None}]},
+    {"thread_id": "t", "role": "ai", "tool_calls": [{"name": "f", "args": {}, "id": 7}]},
+    {"thread_id": "t", "role": "tool", "content": "x"},
+    {"thread_id": "t", "role": "tool", "content": "x", "tool_call_id": 1},
+])
+def test_validate_row_rejects_malformed_rows(row):
+    with pytest.raises(ValueError):
+        ThreadStore.validate_row(row)
+
+
+def test_threads_are_listed_per_tenant():
+    store = ThreadStore()
+    store.append("a1", [HumanMessage(content="hi")], tenant="alice")
+    store.append("b1", [HumanMessage(content="hi")], tenant="bob")
+    store.append("d1", [HumanMessage(content="hi")])
+
+    assert [t["thread_id"] for t in store.list_threads(tenant="alice")] == ["a1"]
+    assert [t["thread_id"] for t in store.list_threads()] == ["a1", "b1", "d1"]
+    assert store.count("bob") == 1
+    assert store.owner("d1") == "default"
+    assert store.owner("missing") is None
+
+    target = ThreadStore()
+    target.import_rows(store.export_rows("b1"))
+    assert target.owner("b1") == "bob"
+
+
+def test_concurrent_turns_on_one_thread_do_not_interleave():
+    store = ThreadStore()
+
+    async def turn(label):
+        async with store.turn("t1"):
+            store.append("t1", [HumanMessage(content=f"{label} question")])
+            await asyncio.sleep(0.01)
+            store.append("t1", [AIMessage(content=f"{label} answer")])
+
+    async def main():
+        await asyncio.gather(turn("a"), turn("b"))
+
+    asyncio.run(main())
+    contents = [m.content for m in store.to_messages("t1")]
+    assert contents == ["a question", "a answer", "b question", "b answer"]
+    assert not store._turn_locks
@@ -0,0 +1,34 @@
+"""token_accounting：執行緒預算依 (租戶, thread_id) 區分"""
+
+from run_context import RunContext
+from token_accounting import TokenLedger
+
+
+def test_thread_budget_is_scoped_by_tenant():
+    ledger = TokenLedger(thread_budget=100)
+    ledger.record(RunContext("shared", "alice"), 80, 30, estimated=False)
+
+    assert ledger.exhausted(RunContext("shared", "alice")) == "thread budget of 100 tokens"
+    assert ledger.exhausted(RunContext("shared", "bob")) is None
+    assert ledger.thread_tokens(RunContext("shared", "bob")) == 0
+
+
+def test_missing_tenant_uses_default_bucket():
+    ledger = TokenLedger(thread_budget=100)
+    ledger.record(RunContext("t1"), 60, 60, estimated=True)
+
+    assert ledger.thread_tokens(RunContext("t1", "default")) == 120
+    assert ledger.stats()["total"]["estimated_calls"] == 1
+
+
+def test_forget_thread_clears_every_tenant():
+    ledger = TokenLedger(thread_budget=100)
+    ledger.record(RunContext("shared", "alice"), 80, 30, estimated=False)
+    ledger.record(RunContext("shared", "bob"), 10, 10, estimated=False)
+    ledger.record(RunContext("other", "bob"), 10, 10, estimated=False)
+
+    ledger.forget_thread("shared")
+
+    assert ledger.exhausted(RunContext("shared", "alice")) is None
+    assert ledger.thread_tokens(RunContext("shared", "bob")) == 0
+    assert ledger.thread_tokens(RunContext("other", "bob")) == 20
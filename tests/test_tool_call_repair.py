@@ -0,0 +1,77 @@
+"""tool_call_repair：文字工具呼叫的解析與修正"""
+
+from langchain_core.messages import AIMessage
+from langchain_core.tools import StructuredTool
+
+from tool_call_repair import ToolCallRepairModel, parse_text_tool_calls
+
+TOOLS = ["read_file", "list_directory"]
+
+
+class _Echo:
+    """回傳固定訊息的假模型"""
+
+    def __init__(self, message):
+        self.message = message
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def invoke(self, input, config=None, **kwargs):
+        return self.message
+
+
+def _read_file(path: str, head: int = 0) -> str:
+    return path
+
+
+def _repair(message: AIMessage) -> AIMessage:
+    tool = StructuredTool.from_function(_read_file, name="read_file", description="read a file")
+    return ToolCallRepairModel(_Echo(message)).bind_tools([tool]).invoke([])
+
+
+def test_fenced_call():
+    text = '好的：\n```json\n{"name": "read_file", "arguments": {"path": "a.py"}}\n```'
+    assert parse_text_tool_calls(text, TOOLS) == [{"name": "read_file", "args": {"path": "a.py"}}]
+
+
+def test_tagged_call_is_always_parsed():
+    text = '<tool_call>{"tool": "unknown_tool", "parameters": {"x": 1}}</tool_call>'
+    assert parse_text_tool_calls(text) == [{"name": "unknown_tool", "args": {"x": 1}}]
+
+
+def test_bare_json_with_bound_tool_name():
+    text = '{"name": "list_directory", "args": {"path": "."}}'
+    assert parse_text_tool_calls(text, TOOLS) == [{"name": "list_directory", "args": {"path": "."}}]
+
+
+def test_json_in_answer_is_not_a_tool_call():
+    assert parse_text_tool_calls('example: {"name": "Alice"}') == []
+    assert parse_text_tool_calls('example: {"name": "Alice", "action": "run"}', TOOLS) == []
+    assert parse_text_tool_calls('```json\n{"name": "Alice", "age": 3}\n```', TOOLS) == []
+    assert parse_text_tool_calls("答案是 {1, 2}", TOOLS) == []
+
+
+def test_repairs_misspelled_name_and_args():
+    response = _repair(AIMessage('```json\n{"name": "Read-File", "arguments": {"pth": "a.py", "head": "5"}}\n```'))
+    assert response.content == ""
+    assert [(tc["name"], tc["args"]) for tc in response.tool_calls] == [("read_file", {"path": "a.py", "head": 5})]
+
+
+def test_plain_answer_is_unchanged():
+    answer = AIMessage('使用者資料：{"name": "Alice", "arguments": "none"}')
+    response = _repair(answer)
+    assert response is answer
+    assert not response.invalid_tool_calls
+
+
+def test_explicit_unknown_tool_is_reported_invalid():
+    response = _repair(AIMessage('<tool_call>{"name": "delete_everything", "arguments": {}}</tool_call>'))
+    assert not response.tool_calls
+    assert [tc["name"] for tc in response.invalid_tool_calls] == ["delete_everything"]
+
+
+def test_native_call_keeps_original_when_unrepairable():
+    message = AIMessage("", tool_calls=[{"name": "read_file", "args": {"other": 1}, "id": "c1"}])
+    response = _repair(message)
+    assert response.tool_calls == message.tool_calls
@@ -0,0 +1,76 @@
+"""tool_selector：依對話內容綁定工具子集，呼叫被省略的工具時改綁完整工具集"""
+
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.tools import StructuredTool
+
+from run_context import RETRY_TAG
+from tool_selector import SelectiveToolModel
+
+
+def _tool(name: str, description: str) -> StructuredTool:
+    return StructuredTool.from_function(lambda path: path, name=name, description=description)
+
+
+TOOLS = [
+    _tool("read_file", "Read the complete contents of a file"),
+    _tool("write_file", "Create or overwrite a file with new content"),
+    _tool("list_directory", "List files and directories in a directory"),
+    _tool("move_file", "Move or rename files and directories"),
+    _tool("search_files", "Recursively search for files matching a pattern"),
+]
+
+
+class _Scripted:
+    """依序回傳訊息的假模型，記錄每次呼叫綁定的工具與 config"""
+
+    def __init__(self, script, calls=None, names=None):
+        self.script = script
+        self.calls = [] if calls is None else calls
+        self.names = names
+
+    def bind_tools(self, tools, **kwargs):
+        return _Scripted(self.script, self.calls, sorted(t.name for t in tools))
+
+    def invoke(self, input, config=None, **kwargs):
+        self.calls.append((self.names, config or {}))
+        return self.script.pop(0)
+
+
+def _call(name: str) -> AIMessage:
+    return AIMessage("", tool_calls=[{"name": name, "args": {"path": "a.txt"}, "id": "c1"}])
+
+
+def _model(script, top_k=2):
+    inner = _Scripted(script)
+    return SelectiveToolModel(inner, top_k=top_k).bind_tools(TOOLS), inner
+
+
+def test_binds_relevant_subset():
+    model, inner = _model([_call("read_file")])
+    response = model.invoke([HumanMessage("read the file a.txt")])
+
+    assert response.tool_calls[0]["name"] == "read_file"
+    names, _ = inner.calls[0]
+    assert "read_file" in names and len(names) == 2
+    assert model.stats.fallbacks == 0
+
+
+def test_falls_back_to_full_set_when_omitted_tool_is_called():
+    model, inner = _model([_call("move_file"), _call("move_file")])
+    response = model.invoke([HumanMessage("read the file a.txt")])
+
+    assert response.tool_calls[0]["name"] == "move_file"
+    (subset, _), (full, config) = inner.calls
+    assert "move_file" not in subset
+    assert full == sorted(t.name for t in TOOLS)
+    # 重做的輸出不再串流
+    assert RETRY_TAG in config["tags"]
+    assert model.stats.fallbacks == 1
+
+
+def test_unrelated_query_binds_full_set():
+    model, inner = _model([AIMessage("你好")])
+    model.invoke([HumanMessage("你好")])
+
+    assert inner.calls[0][0] == sorted(t.name for t in TOOLS)
+    assert model.stats.full_set_calls == 1
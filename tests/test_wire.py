@@ -0,0 +1,101 @@
+"""wire：Accept / Accept-Encoding 協商、回應編碼與串流壓縮"""
+
+import asyncio
+import gzip
+import zlib
+
+import pytest
+
+import wire
+
+needs_msgpack = pytest.mark.skipif(not wire.MSGPACK_AVAILABLE, reason="ormsgpack / msgpack not installed")
+needs_zstd = pytest.mark.skipif(wire.zstandard is None, reason="zstandard not installed")
+
+
+@needs_msgpack
+@pytest.mark.parametrize("accept, expected", [
+    ("application/msgpack", True),
+    ("application/x-msgpack", True),
+    ("application/msgpack, application/json;q=0.9", True),
+    ("application/json, application/msgpack;q=0.5", False),
+    ("application/msgpack;q=0", False),
+    ("application/json", False),
+    (None, False),
+])
+def test_wants_msgpack(accept, expected):
+    assert wire.wants_msgpack(accept) is expected
+
+
+@pytest.mark.parametrize("accept_encoding, expected", [
+    ("gzip", "gzip"),
+    ("gzip;q=0, deflate", None),
+    ("identity", None),
+    (None, None),
+])
+def test_choose_encoding_gzip_or_identity(accept_encoding, expected):
+    assert wire.choose_encoding(accept_encoding) == expected
+
+
+@needs_zstd
+def test_choose_encoding_prefers_zstd():
+    assert wire.choose_encoding("gzip, zstd") == "zstd"
+    assert wire.choose_encoding("gzip, zstd;q=0") == "gzip"
+
+
+def test_encode_response_only_compresses_large_bodies():
+    small = {"response": "hi"}
+    body, media_type, headers = wire.encode_response(small, "application/json", "gzip", min_compress_bytes=1024)
+    assert media_type == wire.JSON_MEDIA_TYPE
+    assert "Content-Encoding" not in headers
+    assert wire.loads_json(body) == small
+
+    large = {"response": "字" * 2000}
+    body, _, headers = wire.encode_response(large, "application/json", "gzip", min_compress_bytes=1024)
+    assert headers["Content-Encoding"] == "gzip"
+    assert headers["Vary"] == "Accept, Accept-Encoding"
+    assert wire.loads_json(gzip.decompress(body)) == large
+
+    body, _, headers = wire.encode_response(large, "application/json", "gzip", min_compress_bytes=0)
+    assert "Content-Encoding" not in headers
+
+
+@needs_msgpack
+def test_encode_response_msgpack_round_trip():
+    data = {"response": "完成", "usage": {"total_tokens": 12}, "tools": ["a", "b"]}
+    body, media_type, _ = wire.encode_response(data, "application/msgpack", None)
+    assert media_type == wire.MSGPACK_MEDIA_TYPE
+    assert wire.unpackb(body) == data
+
+
+def _stream(chunks, encoding):
+    async def source():
+        for chunk in chunks:
+            yield chunk
+
+    async def collect():
+        return [part async for part in wire.compress_stream(source(), encoding)]
+
+    return asyncio.run(collect())
+
+
+def test_compress_stream_gzip_is_decodable_after_each_chunk():
+    chunks = [f'{{"seq": {i}}}\n'.encode() for i in range(5)]
+    parts = _stream(chunks, "gzip")
+
+    decoder = zlib.decompressobj(31)
+    # 每段 flush 後就能解出該段內容，client 可以邊收邊解
+    for chunk, part in zip(chunks, parts):
+        assert decoder.decompress(part) == chunk
+    assert gzip.decompress(b"".join(parts)) == b"".join(chunks)
+
+
+@needs_zstd
+def test_compress_stream_zstd_round_trip():
+    chunks = [b"line one\n", b"line two\n"]
+    parts = _stream(chunks, "zstd")
+    decoder = wire.zstandard.ZstdDecompressor().decompressobj()
+    assert decoder.decompress(b"".join(parts)) == b"".join(chunks)
+
+
+def test_compress_stream_passthrough():
+    assert _stream([b"a", b"b"], None) == [b"a", b"b"]
@@ -0,0 +1,544 @@
+"""
+Thread Store - 精簡的對話歷史儲存
+
+- 以 __slots__ 的 MessageRecord 取代完整的 LangChain message 物件
+- 角色與工具名稱使用 sys.intern，所有執行緒共用同一份字串
+- 相同的 tool call（名稱 + 參數）只存一份，以參照計數管理
+- 閒置超過門檻的執行緒壓縮成 zstd（未安裝時用 zlib）blob，下次存取時再還原
+- 同一個執行緒一次只執行一輪對話（turn()），同時送出的請求依序執行，訊息不會交錯
+- 每個執行緒記錄建立它的租戶，列出與讀取歷史時只看得到自己租戶的執行緒
+"""
+
+import asyncio
+import hashlib
+import json
+import sys
+import time
+import zlib
+from contextlib import asynccontextmanager
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    SystemMessage,
+    ToolMessage,
+)
+
+try:
+    import zstandard
+except ImportError:  # 未安裝 zstandard 時使用 zlib
+    zstandard = None
+
+
+# 未指定租戶時的執行緒所屬（與 server 的 resolve_tenant 預設值相同）
+DEFAULT_TENANT = "default"
+
+_ROLES = {
+    HumanMessage: sys.intern("human"),
+    AIMessage: sys.intern("ai"),
+    ToolMessage: sys.intern("tool"),
+    SystemMessage: sys.intern("system"),
+}
+
+
+class MessageRecord:
+    """單則訊息的精簡表示"""
+
+    __slots__ = ("seq", "role", "content", "content_is_json", "name", "tool_call_id", "tool_calls")
+
+    def __init__(
+        self,
+        seq: int,
+        role: str,
+        content: str,
+        content_is_json: bool = False,
+        name: Optional[str] = None,
+        tool_call_id: Optional[str] = None,
+        tool_calls: Tuple[Tuple[str, str], ...] = (),
+    ):
+        self.seq = seq
+        self.role = role
+        self.content = content
+        self.content_is_json = content_is_json
+        self.name = name
+        self.tool_call_id = tool_call_id
+        self.tool_calls = tool_calls  # ((payload_key, call_id), ...)
+
+
+class ThreadRecord:
+    """單一執行緒：訊息列表，或壓縮後的 blob"""
+
+    __slots__ = ("messages", "blob", "next_seq", "turns", "last_access", "created", "tenant")
+
+    def __init__(self, created: int = 0, tenant: str = DEFAULT_TENANT):
+        self.messages: Optional[List[MessageRecord]] = []
+        self.blob: Optional[bytes] = None
+        self.next_seq = 1
+        self.turns = 0  # 使用者訊息數（對話輪數），不必走訪訊息就能回報
+        self.last_access = time.monotonic()
+        self.created = created  # 建立順序（分頁 cursor，刪除其他執行緒時不會變動）
+        self.tenant = tenant  # 建立執行緒的租戶（只有同一租戶能讀取歷史）
+
+
+def _compress(data: bytes) -> bytes:
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return zlib.compress(data, 6)
+
+
+def _decompress(blob: bytes) -> bytes:
+    if zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(blob)
+    return zlib.decompress(blob)
+
+
+def _export_call(name: str, args_json: str, call_id: Optional[str]) -> dict:
+    """匯出格式的工具呼叫（沒有 id 時省略 id 欄位）"""
+    call = {"name": name, "args": json.loads(args_json)}
+    if call_id is not None:
+        call["id"] = call_id
+    return call
+
+
+class ThreadStore:
+    """所有對話執行緒的精簡歷史"""
+
+    def __init__(self, idle_seconds: float = 900.0, sweep_interval: float = 60.0):
+        """
+        Args:
+            idle_seconds: 執行緒閒置超過幾秒會被壓縮封存
+            sweep_interval: 最多每隔幾秒檢查一次閒置執行緒
+        """
+        self.idle_seconds = idle_seconds
+        self.sweep_interval = sweep_interval
+        self.threads: Dict[str, ThreadRecord] = {}
+        self._payloads: Dict[str, Tuple[str, str]] = {}  # key → (tool name, args JSON)
+        self._payload_refs: Dict[str, int] = {}
+        self._last_sweep = time.monotonic()
+        self._created = 0
+        self._turn_locks: Dict[str, asyncio.Lock] = {}
+        self._turn_users: Dict[str, int] = {}
+        self.archived_count = 0
+        self.rehydrated_count = 0
+
+    def __len__(self) -> int:
+        return len(self.threads)
+
+    def __contains__(self, thread_id: str) -> bool:
+        return thread_id in self.threads
+
+    # ---- tool call payload 去重 ----
+
+    def _intern_payload(self, name: str, args_json: str) -> str:
+        key = sys.intern(hashlib.blake2b(f"{name}\0{args_json}".encode(), digest_size=12).hexdigest())
+        if key not in self._payloads:
+            self._payloads[key] = (sys.intern(name), args_json)
+            self._payload_refs[key] = 0
+        self._payload_refs[key] += 1
+        return key
+
+    def _release_payloads(self, records: Iterable[MessageRecord]):
+        for record in records:
+            for key, _ in record.tool_calls:
+                self._payload_refs[key] -= 1
+                if self._payload_refs[key] == 0:
+                    del self._payload_refs[key]
+                    del self._payloads[key]
+
+    # ---- 轉換 ----
+
+    def _to_record(self, seq: int, msg: BaseMessage) -> MessageRecord:
+        content, is_json = msg.content, False
+        if not isinstance(content, str):
+            content, is_json = json.dumps(content, ensure_ascii=False), True
+
+        tool_calls = ()
+        if isinstance(msg, AIMessage) and msg.tool_calls:
+            tool_calls = tuple(
+                (self._intern_payload(tc["name"], json.dumps(tc["args"], ensure_ascii=False, sort_keys=True)), tc["id"])
+                for tc in msg.tool_calls
+            )
+
+        name = getattr(msg, "name", None)
+        return MessageRecord(
+            seq=seq,
+            role=_ROLES.get(type(msg), sys.intern(msg.type)),
+            content=content,
+            content_is_json=is_json,
+            name=sys.intern(name) if name else None,
+            tool_call_id=getattr(msg, "tool_call_id", None),
+            tool_calls=tool_calls,
+        )
+
+    def _to_message(self, record: MessageRecord) -> BaseMessage:
+        content = json.loads(record.content) if record.content_is_json else record.content
+        if record.role == "human":
+            return HumanMessage(content=content)
+        if record.role == "ai":
+            tool_calls = []
+            for key, call_id in record.tool_calls:
+                name, args_json = self._payloads[key]
+                tool_calls.append({"name": name, "args": json.loads(args_json), "id": call_id})
+            return AIMessage(content=content, tool_calls=tool_calls, name=record.name)
+        if record.role == "tool":
+            return ToolMessage(content=content, tool_call_id=record.tool_call_id, name=record.name)
+        return SystemMessage(content=content)
+
+    # ---- 封存 / 還原 ----
+
+    def _to_row(self, r: MessageRecord) -> list:
+        """MessageRecord → 可序列化的 row（封存與匯出共用）"""
+        calls = [[*self._payloads[key], call_id] for key, call_id in r.tool_calls]
+        return [r.seq, r.role, r.content, r.content_is_json, r.name, r.tool_call_id, calls]
+
+    def _from_row(self, row: list) -> MessageRecord:
+        seq, role, content, is_json, name, tool_call_id, calls = row
+        return MessageRecord(
+            seq=seq,
+            role=sys.intern(role),
+            content=content,
+            content_is_json=is_json,
+            name=sys.intern(name) if name else None,
+            tool_call_id=tool_call_id,
+            tool_calls=tuple((self._intern_payload(n, a), call_id) for n, a, call_id in calls),
+        )
+
+    def _archive(self, thread: ThreadRecord):
+        """把執行緒壓縮成 blob，釋放訊息物件"""
+        rows = [self._to_row(r) for r in thread.messages]
+        thread.blob = _compress(json.dumps(rows, ensure_ascii=False).encode("utf-8"))
+        self._release_payloads(thread.messages)
+        thread.messages = None
+        self.archived_count += 1
+
+    def _rehydrate(self, thread: ThreadRecord):
+        """從 blob 還原訊息"""
+        rows = json.loads(_decompress(thread.blob).decode("utf-8"))
+        thread.messages = [self._from_row(row) for row in rows]
+        thread.blob = None
+        self.rehydrated_count += 1
+
+    def _get(self, thread_id: str, create: bool = False, tenant: Optional[str] = None) -> Optional[ThreadRecord]:
+        thread = self.threads.get(thread_id)
+        if thread is None:
+            if not create:
+                return None
+            self._created += 1
+            thread = self.threads[thread_id] = ThreadRecord(self._created, tenant or DEFAULT_TENANT)
+        if thread.messages is None:
+            self._rehydrate(thread)
+        thread.last_access = time.monotonic()
+        return thread
+
+    def archive_idle(self, force: bool = False) -> int:
+        """
+        壓縮閒置的執行緒
+
+        Args:
+            force: 忽略 sweep_interval 立即檢查
+
+        Returns:
+            本次封存的執行緒數
+        """
+        now = time.monotonic()
+        if not force and now - self._last_sweep < self.sweep_interval:
+            return 0
+        self._last_sweep = now
+
+        archived = 0
+        for thread in self.threads.values():
+            if thread.messages is not None and now - thread.last_access > self.idle_seconds:
+                self._archive(thread)
+                archived += 1
+        return archived
+
+    # ---- 公開 API ----
+
+    @asynccontextmanager
+    async def turn(self, thread_id: str):
+        """
+        在區塊內獨佔執行緒（從讀取歷史到保存新訊息）
+
+        同一個執行緒同時有第二個請求時會等待前一輪完成，
+        避免兩輪對話讀到相同的歷史、各自附加的訊息互相交錯
+        """
+        lock = self._turn_locks.setdefault(thread_id, asyncio.Lock())
+        self._turn_users[thread_id] = self._turn_users.get(thread_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._turn_users[thread_id] -= 1
+            if not self._turn_users[thread_id]:
+                del self._turn_users[thread_id]
+                del self._turn_locks[thread_id]
+
+    def append(self, thread_id: str, messages: Iterable[BaseMessage], tenant: Optional[str] = None):
+        """把新訊息加入執行緒（新的執行緒屬於 tenant）"""
+        thread = self._get(thread_id, create=True, tenant=tenant)
+        for msg in messages:
+            record = self._to_record(thread.next_seq, msg)
+            thread.messages.append(record)
+            thread.next_seq += 1
+            if record.role == "human":
+                thread.turns += 1
+        self.archive_idle()
+
+    def to_messages(self, thread_id: str, last_turns: int = 0) -> List[BaseMessage]:
+        """
+        還原執行緒的 LangChain 訊息（用於送進 Agent）
+
+        Args:
+            last_turns: 只還原最後幾輪對話（0 表示全部）
+        """
+        thread = self._get(thread_id)
+        if thread is None:
+            return []
+        records = thread.messages
+        if last_turns:
+            seen = 0
+            for i in range(len(records) - 1, -1, -1):
+                if records[i].role == "human":
+                    seen += 1
+                    if seen == last_turns:
+                        records = records[i:]
+                        break
+        return [self._to_message(r) for r in records]
+
+    def turns(self, thread_id: str) -> Optional[List[dict]]:
+        """
+        以「使用者訊息 + 最終回答」為一輪列出對話
+
+        Returns:
+            [{"id": ..., "user": ..., "assistant": ...}, ...]；執行緒不存在時回傳 None
+        """
+        thread = self._get(thread_id)
+        if thread is None:
+            return None
+        return list(self._iter_turns(thread))
+
+    def _iter_turns(self, thread: ThreadRecord) -> Iterator[dict]:
+        turn = None
+        for r in thread.messages:
+            if r.role == "human":
+                if turn is not None:
+                    yield turn
+                turn = {"id": r.seq, "user": r.content, "assistant": ""}
+            elif r.role == "ai" and not r.tool_calls and turn is not None:
+                turn["assistant"] = r.content
+        if turn is not None:
+            yield turn
+
+    def turns_page(
+        self,
+        thread_id: str,
+        limit: int,
+        offset: int = 0,
+        since_id: Optional[int] = None,
+    ) -> Optional[Tuple[List[dict], Optional[int]]]:
+        """
+        分頁列出對話
+
+        Args:
+            limit: 每頁最多幾輪
+            offset: 略過前幾輪（套用 since_id 之後）
+            since_id: 只列出 id 大於此值的對話
+
+        Returns:
+            (這一頁的對話, 下一頁的 since_id cursor 或 None)；執行緒不存在時回傳 None
+        """
+        thread = self._get(thread_id)
+        if thread is None:
+            return None
+
+        turns = (t for t in self._iter_turns(thread) if since_id is None or t["id"] > since_id)
+        page = list(islice(turns, offset, offset + limit + 1))
+        if len(page) > limit:
+            page = page[:limit]
+            return page, page[-1]["id"]
+        return page, None
+
+    def turn_count(self, thread_id: str) -> int:
+        """執行緒的對話輪數（不會還原封存的執行緒）"""
+        thread = self.threads.get(thread_id)
+        return thread.turns if thread is not None else 0
+
+    def count(self, tenant: Optional[str] = None) -> int:
+        """執行緒數量（指定 tenant 時只計算該租戶的執行緒）"""
+        if tenant is None:
+            return len(self.threads)
+        return sum(1 for thread in self.threads.values() if thread.tenant == tenant)
+
+    def owner(self, thread_id: str) -> Optional[str]:
+        """執行緒所屬的租戶（執行緒不存在時回傳 None）"""
+        thread = self.threads.get(thread_id)
+        return thread.tenant if thread is not None else None
+
+    def list_threads(self, after: int = 0, limit: int = 50, tenant: Optional[str] = None) -> List[dict]:
+        """
+        列出執行緒摘要（不會還原封存的執行緒）
+
+        Args:
+            after: 只列出 cursor 大於此值的執行緒（上一頁最後一筆的 cursor）
+            limit: 最多幾筆
+            tenant: 只列出此租戶的執行緒（None 表示所有租戶）
+        """
+        # dict 依插入順序排列，與 created 的順序一致
+        threads = (
+            (tid, t) for tid, t in self.threads.items()
+            if t.created > after and (tenant is None or t.tenant == tenant)
+        )
+        return [
+            {
+                "thread_id": thread_id,
+                "message_count": thread.next_seq - 1,
+                "archived": thread.messages is None,
+                "cursor": thread.created,
+            }
+            for thread_id, thread in islice(threads, limit)
+        ]
+
+    def export_rows(self, thread_id: str) -> Iterator[dict]:
+        """
+        逐則匯出執行緒的訊息（封存的執行緒只暫時解壓，不會還原）
+
+        每則訊息格式：
+        {"thread_id", "tenant", "seq", "role", "content", "name", "tool_call_id", "tool_calls": [{"name", "args", "id"}]}
+        （沒有 id 的工具呼叫不輸出 id 欄位）
+        """
+        thread = self.threads.get(thread_id)
+        if thread is None:
+            return
+        if thread.messages is None:
+            rows = json.loads(_decompress(thread.blob).decode("utf-8"))
+        else:
+            rows = (self._to_row(r) for r in list(thread.messages))
+
+        for seq, role, content, is_json, name, tool_call_id, calls in rows:
+            yield {
+                "thread_id": thread_id,
+                "tenant": thread.tenant,
+                "seq": seq,
+                "role": role,
+                "content": json.loads(content) if is_json else content,
+                "name": name,
+                "tool_call_id": tool_call_id,
+                "tool_calls": [_export_call(n, a, call_id) for n, a, call_id in calls],
+            }
+
+    @staticmethod
+    def validate_row(row: dict):
+        """
+        檢查一則 export_rows 格式的訊息
+
+        Raises:
+            ValueError: 欄位缺少或型別不符
+        """
+        if not isinstance(row, dict):
+            raise ValueError("row must be an object")
+        if not isinstance(row.get("thread_id"), str) or not row["thread_id"]:
+            raise ValueError("thread_id must be a non-empty string")
+        if row.get("tenant") is not None and not isinstance(row["tenant"], str):
+            raise ValueError("tenant must be a string")
+        if row.get("role") not in ("human", "ai", "tool", "system"):
+            raise ValueError(f"unknown role: {row.get('role')!r}")
+        if row.get("name") is not None and not isinstance(row["name"], str):
+            raise ValueError("name must be a string")
+        if row["role"] == "tool" or row.get("tool_call_id") is not None:
+            if not isinstance(row.get("tool_call_id"), str):
+                raise ValueError("tool_call_id must be a string")
+        calls = row.get("tool_calls") or []
+        if not isinstance(calls, list):
+            raise ValueError("tool_calls must be a list")
+        if calls and row["role"] != "ai":
+            raise ValueError("only ai messages can have tool_calls")
+        for tc in calls:
+            if not isinstance(tc, dict) or not isinstance(tc.get("name"), str):
+                raise ValueError("each tool call needs a name")
+            if not isinstance(tc.get("args", {}), dict):
+                raise ValueError("tool call args must be an object")
+            if "id" in tc and not isinstance(tc["id"], str):
+                raise ValueError("tool call id must be a string")
+
+    def import_rows(self, rows: Iterable[dict], replace: bool = False) -> int:
+        """
+        匯入 export_rows 格式的訊息（請先以 validate_row 檢查全部內容）
+
+        Args:
+            replace: 匯入資料中出現的執行緒先清空既有的訊息
+
+        Returns:
+            匯入的訊息數
+        """
+        seen = set()
+        count = 0
+        for row in rows:
+            if replace and row["thread_id"] not in seen:
+                self.delete(row["thread_id"])
+            seen.add(row["thread_id"])
+            self._import_row(row)
+            count += 1
+        return count
+
+    def _import_row(self, row: dict):
+        thread = self._get(row["thread_id"], create=True, tenant=row.get("tenant"))
+
+        content = row.get("content", "")
+        is_json = not isinstance(content, str)
+        calls = [
+            [tc["name"], json.dumps(tc.get("args", {}), ensure_ascii=False, sort_keys=True), tc.get("id")]
+            for tc in row.get("tool_calls") or []
+        ]
+        thread.messages.append(self._from_row([
+            thread.next_seq,
+            row["role"],
+            json.dumps(content, ensure_ascii=False) if is_json else content,
+            is_json,
+            row.get("name"),
+            row.get("tool_call_id"),
+            calls,
+        ]))
+        thread.next_seq += 1
+        if row["role"] == "human":
+            thread.turns += 1
+
+    def delete(self, thread_id: str) -> bool:
+        """刪除執行緒"""
+        thread = self.threads.pop(thread_id, None)
+        if thread is None:
+            return False
+        if thread.messages is not None:
+            self._release_payloads(thread.messages)
+        return True
+
+    def stats(self) -> dict:
+        """執行緒數量與大約的記憶體用量"""
+        live_bytes = 0
+        live_messages = 0
+        archived_bytes = 0
+        archived_threads = 0
+        for thread in self.threads.values():
+            if thread.messages is None:
+                archived_threads += 1
+                archived_bytes += sys.getsizeof(thread.blob)
+                continue
+            live_messages += len(thread.messages)
+            live_bytes += sys.getsizeof(thread.messages)
+            for r in thread.messages:
+                live_bytes += sys.getsizeof(r) + sys.getsizeof(r.content) + sys.getsizeof(r.tool_calls)
+
+        payload_bytes = sum(sys.getsizeof(args) for _, args in self._payloads.values())
+        return {
+            "threads": len(self.threads),
+            "live_threads": len(self.threads) - archived_threads,
+            "archived_threads": archived_threads,
+            "live_messages": live_messages,
+            "live_bytes": live_bytes,
+            "archived_bytes": archived_bytes,
+            "tool_call_payloads": len(self._payloads),
+            "tool_call_payload_bytes": payload_bytes,
+            "compression": "zstd" if zstandard is not None else "zlib",
+        }
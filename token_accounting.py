@@ -0,0 +1,201 @@
+"""
+Token Accounting - 每個請求、執行緒與租戶的 token 用量與預算
+
+共用的本地硬體上，token 量才是真正的容量限制：
+- MeteredModel 記錄每次 LLM 回應的 usage_metadata；後端沒有回傳用量時以字數估計
+- TokenLedger 依請求、執行緒與租戶彙總，並在超過預算時讓執行以一則說明訊息正常結束
+"""
+
+import json
+import re
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from model_router import _to_messages
+from run_context import RunContext, current_run
+from tool_selector import estimate_schema_tokens
+
+_CJK_RE = re.compile(r"[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]")
+
+
+def estimate_text_tokens(text: str) -> int:
+    """估計文字的 token 數（中日文約 1 字 / token，其他約 4 字元 / token）"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimate_message_tokens(message: BaseMessage) -> int:
+    """估計單則訊息的 token 數（含角色標記等固定開銷）"""
+    content = message.content
+    if not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False)
+    tokens = 4 + estimate_text_tokens(content)
+    for call in getattr(message, "tool_calls", None) or []:
+        tokens += estimate_text_tokens(call["name"] + json.dumps(call.get("args", {}), ensure_ascii=False))
+    return tokens
+
+
+class TokenUsage:
+    """token 用量"""
+
+    __slots__ = ("prompt_tokens", "completion_tokens", "llm_calls", "estimated_calls")
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.llm_calls = 0
+        self.estimated_calls = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, prompt_tokens: int, completion_tokens: int, estimated: bool):
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.llm_calls += 1
+        if estimated:
+            self.estimated_calls += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+            "llm_calls": self.llm_calls,
+            "estimated_calls": self.estimated_calls,
+        }
+
+
+class TokenLedger:
+    """依執行緒與租戶彙總 token 用量，並檢查預算"""
+
+    def __init__(self, request_budget: int = 0, thread_budget: int = 0):
+        """
+        Args:
+            request_budget: 單次請求的 token 上限（0 表示不限制）
+            thread_budget: 單一執行緒累計的 token 上限（0 表示不限制）
+        """
+        self.request_budget = request_budget
+        self.thread_budget = thread_budget
+        self.total = TokenUsage()
+        # 執行緒用量以 (租戶, thread_id) 區分，不同租戶使用相同的 thread_id 不會共用預算
+        self.by_thread: Dict[Tuple[str, str], TokenUsage] = {}
+        self.by_tenant: Dict[str, TokenUsage] = {}
+        self.budget_stops = 0
+
+    def record(self, context: RunContext, prompt_tokens: int, completion_tokens: int, estimated: bool):
+        """記錄一次 LLM 呼叫的用量"""
+        if context.usage is None:
+            context.usage = TokenUsage()
+        tenant = context.tenant or "default"
+        for usage in (
+            context.usage,
+            self.total,
+            self.by_thread.setdefault((tenant, context.thread_id), TokenUsage()),
+            self.by_tenant.setdefault(tenant, TokenUsage()),
+        ):
+            usage.add(prompt_tokens, completion_tokens, estimated)
+
+    def thread_tokens(self, context: RunContext) -> int:
+        """執行所屬的 (租戶, 執行緒) 累計用量"""
+        usage = self.by_thread.get((context.tenant or "default", context.thread_id))
+        return usage.total_tokens if usage else 0
+
+    def exhausted(self, context: RunContext) -> Optional[str]:
+        """已用完的預算說明（尚未用完時回傳 None）"""
+        used = context.usage.total_tokens if context.usage else 0
+        if self.request_budget and used >= self.request_budget:
+            return f"request budget of {self.request_budget} tokens"
+        if self.thread_budget and self.thread_tokens(context) >= self.thread_budget:
+            return f"thread budget of {self.thread_budget} tokens"
+        return None
+
+    def forget_thread(self, thread_id: str):
+        """清除執行緒在所有租戶下的累計用量（對話被刪除時）"""
+        for key in [key for key in self.by_thread if key[1] == thread_id]:
+            del self.by_thread[key]
+
+    def report(self, context: RunContext) -> dict:
+        """單次請求的用量（附上執行緒累計與預算狀態）"""
+        usage = context.usage or TokenUsage()
+        return {
+            **usage.to_dict(),
+            "thread_total_tokens": self.thread_tokens(context),
+            "budget_exhausted": context.budget_exhausted,
+        }
+
+    def stats(self) -> dict:
+        return {
+            "request_budget": self.request_budget,
+            "thread_budget": self.thread_budget,
+            "budget_stops": self.budget_stops,
+            "threads": len(self.by_thread),
+            "total": self.total.to_dict(),
+            "tenants": {name: usage.to_dict() for name, usage in self.by_tenant.items()},
+        }
+
+
+class MeteredModel(Runnable):
+    """
+    記錄 token 用量的 chat model wrapper
+
+    在 Agent 執行中（有 RunContext）時記錄用量；預算用完時不呼叫模型，
+    直接回傳沒有工具呼叫的說明訊息，讓 ReAct 迴圈正常結束
+    """
+
+    def __init__(self, inner: Runnable, ledger: TokenLedger, schema_tokens: int = 0):
+        """
+        Args:
+            inner: 實際的 chat model
+            ledger: 共用的用量帳本
+            schema_tokens: 綁定的工具 schema 估計佔用的 token 數（估計 prompt 用量時加上）
+        """
+        self.inner = inner
+        self.ledger = ledger
+        self.schema_tokens = schema_tokens
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs) -> "MeteredModel":
+        schema_tokens = sum(estimate_schema_tokens(tool) for tool in tools)
+        return MeteredModel(self.inner.bind_tools(tools, **kwargs), self.ledger, schema_tokens)
+
+    def _check_budget(self, context: Optional[RunContext]) -> Optional[AIMessage]:
+        if context is None:
+            return None
+        reason = self.ledger.exhausted(context)
+        if reason is None:
+            return None
+        if context.budget_exhausted is None:
+            context.budget_exhausted = reason
+            self.ledger.budget_stops += 1
+        return AIMessage(content=f"⚠️ 已達 token 預算上限（{reason}），停止執行。請縮小任務範圍或開啟新的對話後再試。")
+
+    def _record(self, context: Optional[RunContext], input: Any, response: BaseMessage):
+        if context is None:
+            return
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            self.ledger.record(context, usage.get("input_tokens", 0), usage.get("output_tokens", 0), estimated=False)
+            return
+        prompt = self.schema_tokens + sum(estimate_message_tokens(msg) for msg in _to_messages(input))
+        self.ledger.record(context, prompt, estimate_message_tokens(response), estimated=True)
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> BaseMessage:
+        context = current_run()
+        stop = self._check_budget(context)
+        if stop is not None:
+            return stop
+        response = self.inner.invoke(input, config, **kwargs)
+        self._record(context, input, response)
+        return response
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> BaseMessage:
+        context = current_run()
+        stop = self._check_budget(context)
+        if stop is not None:
+            return stop
+        response = await self.inner.ainvoke(input, config, **kwargs)
+        self._record(context, input, response)
+        return response
@@ -0,0 +1,307 @@
+"""
+Tool Call Repair - 把模型以文字輸出的工具呼叫轉成真正的 tool_calls
+
+部分本地模型（例如 gemma-3n）不支援原生 function calling，會把工具呼叫印成 JSON 文字，
+ReAct 迴圈會把它當成最終回答結束。這裡在模型回應後多一個解析階段：
+1. 回應沒有 tool_calls 時，從內容中找出 <tool_call> 標籤 / ``` 區塊 / JSON 形式的工具呼叫
+   （一般文字中的 JSON 只有名稱對應到綁定的工具時才算，回答中的 JSON 範例不受影響）
+2. 依綁定的工具 schema 驗證：工具名稱與參數名稱拼錯時以最接近的名稱修正，型別不符時轉型
+3. 原生的 tool_calls 也會修正參數名稱與型別；明確的呼叫格式全部無法對應到工具時放進 invalid_tool_calls
+"""
+
+import difflib
+import json
+import re
+import uuid
+from typing import Any, Dict, List, Optional, Sequence
+
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.messages.tool import invalid_tool_call, tool_call
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+_FENCE_RE = re.compile(r"```[a-zA-Z_]*\s*\n?(.*?)```", re.DOTALL)
+_TAG_RE = re.compile(r"<tool_call>(.*?)</tool_call>", re.DOTALL)
+
+# 各種模型輸出工具呼叫時使用的欄位名稱
+_NAME_KEYS = ("name", "tool", "tool_name", "function", "action")
+_ARGS_KEYS = ("arguments", "args", "parameters", "input", "action_input", "tool_input")
+
+
+def _normalize(name: str) -> str:
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+def _closest(name: str, candidates: Sequence[str], cutoff: float) -> Optional[str]:
+    """找出最接近的名稱（先比較忽略大小寫與分隔符號的寫法，再用 difflib）"""
+    if name in candidates:
+        return name
+    normalized = {_normalize(c): c for c in candidates}
+    if _normalize(name) in normalized:
+        return normalized[_normalize(name)]
+    matches = difflib.get_close_matches(name, list(candidates), n=1, cutoff=cutoff)
+    return matches[0] if matches else None
+
+
+def _json_values(block: str) -> List[Any]:
+    """取出一段文字中所有的 JSON 物件 / 陣列"""
+    values = []
+    decoder = json.JSONDecoder()
+    pos = 0
+    while True:
+        starts = [i for i in (block.find("{", pos), block.find("[", pos)) if i != -1]
+        if not starts:
+            break
+        start = min(starts)
+        try:
+            value, end = decoder.raw_decode(block, start)
+        except json.JSONDecodeError:
+            pos = start + 1
+            continue
+        values.append(value)
+        pos = end
+    return values
+
+
+def _as_call(value: Any) -> List[tuple]:
+    """把一個 JSON 值轉成 [(name, args, 是否帶參數欄位)]（不像工具呼叫時回傳空串列）"""
+    if isinstance(value, list):
+        return [call for item in value for call in _as_call(item)]
+    if not isinstance(value, dict):
+        return []
+    if isinstance(value.get("tool_calls"), list):
+        return _as_call(value["tool_calls"])
+    if isinstance(value.get("function"), dict):
+        return _as_call(value["function"])
+
+    name = next((value[k] for k in _NAME_KEYS if isinstance(value.get(k), str)), None)
+    if name is None:
+        return []
+    args_key = next((k for k in _ARGS_KEYS if k in value), None)
+    return [(name, value[args_key] if args_key else {}, args_key is not None)]
+
+
+def _text_calls(text: str, tool_names: Sequence[str], cutoff: float) -> List[tuple]:
+    """
+    找出文字中的工具呼叫，回傳 [(name, args, 是否為明確的呼叫格式)]
+
+    - <tool_call> 標籤內的 JSON 一律視為工具呼叫
+    - ``` 區塊內的 JSON 需帶有參數欄位（arguments、args 等），或名稱對應到綁定的工具
+    - 一般文字中的 JSON 只有名稱對應到綁定的工具時才算，回答中的 JSON 範例不會被當成工具呼叫
+    """
+    if "{" not in text:
+        return []
+
+    def resolves(name: str) -> bool:
+        return _closest(name, tool_names, cutoff) is not None
+
+    tagged = _TAG_RE.findall(text)
+    fenced = _FENCE_RE.findall(text)
+    if not tagged and not fenced:
+        return [(n, a, False) for v in _json_values(text) for n, a, _ in _as_call(v) if resolves(n)]
+
+    calls = [(n, a, True) for block in tagged for v in _json_values(block) for n, a, _ in _as_call(v)]
+    for block in fenced:
+        for value in _json_values(block):
+            calls += [(n, a, has_args) for n, a, has_args in _as_call(value) if has_args or resolves(n)]
+    return calls
+
+
+def may_be_text_tool_call(text: str) -> bool:
+    """串流中的文字是否可能是工具呼叫的開頭（JSON、``` 區塊或 <tool_call> 標籤）"""
+    text = text.lstrip()
+    if not text:
+        return True
+    if text[0] in "{[":
+        return True
+    return any(text.startswith(p) or p.startswith(text) for p in ("```", "<tool_call>"))
+
+
+def parse_text_tool_calls(text: str, tool_names: Sequence[str] = (), cutoff: float = 0.8) -> List[dict]:
+    """
+    從模型輸出的文字中找出工具呼叫 [{"name", "args"}]
+
+    Args:
+        text: 模型輸出的文字
+        tool_names: 綁定的工具名稱（一般文字中的 JSON 需對應到其中之一才算工具呼叫）
+        cutoff: 名稱對應的最低相似度
+    """
+    return [{"name": name, "args": args} for name, args, _ in _text_calls(text, list(tool_names), cutoff)]
+
+
+def _coerce(value: Any, schema: dict) -> Any:
+    """依 schema 的型別修正常見的錯誤（數字寫成字串、單一值沒包成陣列等）"""
+    expected = schema.get("type")
+    if expected == "string" and isinstance(value, (int, float, bool)):
+        return json.dumps(value) if isinstance(value, bool) else str(value)
+    if expected == "integer" and isinstance(value, str) and re.fullmatch(r"-?\d+", value.strip()):
+        return int(value)
+    if expected == "number" and isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    if expected == "boolean" and isinstance(value, str) and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    if expected == "array" and not isinstance(value, list):
+        return [value]
+    return value
+
+
+class ToolCallRepairStats:
+    """工具呼叫修正統計"""
+
+    def __init__(self):
+        self.text_calls_parsed = 0
+        self.names_repaired = 0
+        self.args_repaired = 0
+        self.rejected = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "text_calls_parsed": self.text_calls_parsed,
+            "names_repaired": self.names_repaired,
+            "args_repaired": self.args_repaired,
+            "rejected": self.rejected,
+        }
+
+
+class ToolCallRepairModel(Runnable):
+    """
+    包裝 chat model：依綁定的工具 schema 解析與修正工具呼叫
+
+    沒有綁定工具時（例如強制最終回答）原樣回傳模型的回應
+    """
+
+    def __init__(
+        self,
+        inner: Runnable,
+        schemas: Optional[Dict[str, dict]] = None,
+        stats: Optional[ToolCallRepairStats] = None,
+        name_cutoff: float = 0.8,
+        arg_cutoff: float = 0.6,
+    ):
+        """
+        Args:
+            inner: 實際的 chat model
+            schemas: 綁定工具的參數 schema（工具名稱 → JSON schema，由 bind_tools 設定）
+            stats: 共用的統計物件
+            name_cutoff: 工具名稱修正的最低相似度
+            arg_cutoff: 參數名稱修正的最低相似度
+        """
+        self.inner = inner
+        self.schemas = schemas or {}
+        self.stats = stats or ToolCallRepairStats()
+        self.name_cutoff = name_cutoff
+        self.arg_cutoff = arg_cutoff
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs) -> "ToolCallRepairModel":
+        schemas = {}
+        for tool in tools:
+            function = convert_to_openai_tool(tool)["function"]
+            schemas[function["name"]] = function.get("parameters") or {}
+        return ToolCallRepairModel(
+            self.inner.bind_tools(tools, **kwargs), schemas, self.stats, self.name_cutoff, self.arg_cutoff
+        )
+
+    def _repair_args(self, args: dict, schema: dict) -> tuple:
+        """修正參數名稱與型別，回傳 (args, 是否有修正, 錯誤說明或 None)"""
+        properties = schema.get("properties") or {}
+        if not properties:
+            return args, False, None
+
+        repaired = {}
+        changed = False
+        for key, value in args.items():
+            target = key if key in properties else _closest(
+                key, [p for p in properties if p not in args and p not in repaired], self.arg_cutoff
+            )
+            if target is None:
+                if schema.get("additionalProperties") is True:
+                    repaired[key] = value
+                else:
+                    changed = True  # schema 沒有這個參數，丟掉
+                continue
+            coerced = _coerce(value, properties[target])
+            changed = changed or target != key or coerced is not value
+            repaired[target] = coerced
+
+        missing = [name for name in schema.get("required", []) if name not in repaired]
+        if missing:
+            return repaired, changed, f"Missing required arguments: {', '.join(missing)}"
+        return repaired, changed, None
+
+    def _repair_call(self, name: str, args: Any, call_id: Optional[str]) -> tuple:
+        """修正單一工具呼叫，回傳 (tool_call, None) 或 (None, invalid_tool_call)"""
+        call_id = call_id or f"call_{uuid.uuid4().hex[:24]}"
+        target = _closest(name, list(self.schemas), self.name_cutoff)
+        if target is None:
+            return None, invalid_tool_call(
+                name=name, args=json.dumps(args, ensure_ascii=False), id=call_id, error=f"Unknown tool: {name}"
+            )
+        if isinstance(args, str):
+            try:
+                args = json.loads(args) if args.strip() else {}
+            except json.JSONDecodeError:
+                return None, invalid_tool_call(name=target, args=args, id=call_id, error="Arguments are not valid JSON")
+        if not isinstance(args, dict):
+            return None, invalid_tool_call(
+                name=target, args=json.dumps(args, ensure_ascii=False), id=call_id, error="Arguments must be an object"
+            )
+
+        args, changed, error = self._repair_args(args, self.schemas[target])
+        if error is not None:
+            return None, invalid_tool_call(name=target, args=json.dumps(args, ensure_ascii=False), id=call_id, error=error)
+        if target != name:
+            self.stats.names_repaired += 1
+        if changed:
+            self.stats.args_repaired += 1
+        return tool_call(name=target, args=args, id=call_id), None
+
+    def _repair(self, response: BaseMessage) -> BaseMessage:
+        if not self.schemas or not isinstance(response, AIMessage):
+            return response
+
+        from_text = explicit = False
+        calls = [(tc["name"], tc["args"], tc.get("id")) for tc in response.tool_calls]
+        if not calls and not response.invalid_tool_calls and isinstance(response.content, str):
+            found = _text_calls(response.content, list(self.schemas), self.name_cutoff)
+            calls = [(name, args, None) for name, args, _ in found]
+            from_text = bool(calls)
+            explicit = any(is_explicit for _, _, is_explicit in found)
+        if not calls:
+            return response
+
+        if not from_text:
+            # 原生呼叫只修正參數（工具名稱不在綁定的子集時交給上層處理），
+            # 無法修正的保持原樣，由 ToolNode 把驗證錯誤回傳給模型
+            repaired = []
+            for original, (name, args, call_id) in zip(response.tool_calls, calls):
+                fixed = self._repair_call(name, args, call_id)[0] if name in self.schemas else None
+                repaired.append(fixed or original)
+            return response.model_copy(update={"tool_calls": repaired})
+
+        valid, invalid = [], []
+        for name, args, call_id in calls:
+            fixed, rejected = self._repair_call(name, args, call_id)
+            if fixed is not None:
+                valid.append(fixed)
+            else:
+                invalid.append(rejected)
+        if not valid:
+            if not explicit:
+                # 一般文字中提到工具名稱但不是有效的呼叫：當成一般回答
+                return response
+            # 明確的工具呼叫格式但無法對應到綁定的工具：保留原文，並讓上層（工具子集、模型路由）知道
+            self.stats.rejected += len(invalid)
+            return response.model_copy(update={"invalid_tool_calls": invalid})
+        # 無效的呼叫不留在訊息中（送回模型時會變成沒有結果的 tool_call）
+        self.stats.rejected += len(invalid)
+        self.stats.text_calls_parsed += len(valid)
+        return response.model_copy(update={"content": "", "tool_calls": valid})
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> BaseMessage:
+        return self._repair(self.inner.invoke(input, config, **kwargs))
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> BaseMessage:
+        return self._repair(await self.inner.ainvoke(input, config, **kwargs))
@@ -0,0 +1,289 @@
+"""
+Dynamic Tool Selector - 每次 LLM 呼叫只綁定相關的工具子集
+用 BM25 對工具名稱、描述與參數說明評分，減少每一步的 prompt prefill 成本
+
+規則：
+1. 依使用者訊息與最近的對話內容，選出分數最高的 top_k 個工具
+2. 本輪已經呼叫過的工具一定保留
+3. 沒有任何工具得分時綁定完整工具集
+4. 模型呼叫了不在子集中的工具 → 自動改綁完整工具集重新執行這一步（重做的輸出不再串流）
+"""
+
+import json
+import math
+import re
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from run_context import retry_config
+
+
+# 中文關鍵字 → 工具描述中的英文詞彙（MCP 工具描述為英文）
+KEYWORD_SYNONYMS = {
+    "讀": ["read"],
+    "看": ["read"],
+    "內容": ["read", "content"],
+    "寫": ["write"],
+    "存": ["write"],
+    "建立": ["create", "write"],
+    "新增": ["create", "write"],
+    "編輯": ["edit"],
+    "修改": ["edit"],
+    "取代": ["edit"],
+    "列": ["list"],
+    "目錄": ["directory"],
+    "資料夾": ["directory"],
+    "結構": ["tree", "directory"],
+    "樹": ["tree"],
+    "大小": ["size"],
+    "檔案": ["file"],
+    "搜尋": ["search"],
+    "找": ["search"],
+    "移動": ["move"],
+    "重新命名": ["move", "rename"],
+    "資訊": ["info"],
+    "圖片": ["media", "image"],
+    "多個": ["multiple"],
+    "允許": ["allowed"],
+}
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+|[\u4e00-\u9fff]+")
+
+
+def _normalize_word(word: str) -> str:
+    """簡單的英文字尾正規化（files → file, directories → directory）"""
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """斷詞：英文單字（拆開 snake_case / camelCase）、中文 bigram 與關鍵字對應"""
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text).lower().replace("_", " ")
+    tokens = []
+    for chunk in _TOKEN_RE.findall(text):
+        if chunk[0].isascii():
+            tokens.append(_normalize_word(chunk))
+            continue
+        if len(chunk) == 1:
+            tokens.append(chunk)
+        tokens.extend(chunk[i:i + 2] for i in range(len(chunk) - 1))
+        for keyword, words in KEYWORD_SYNONYMS.items():
+            if keyword in chunk:
+                tokens.extend(words)
+    return tokens
+
+
+def _message_text(msg: BaseMessage) -> str:
+    """取出訊息的純文字內容"""
+    if isinstance(msg.content, str):
+        return msg.content
+    return " ".join(
+        part.get("text", "") if isinstance(part, dict) else str(part)
+        for part in msg.content
+    )
+
+
+def estimate_schema_tokens(tool) -> int:
+    """估計一個工具 schema 佔用的 prompt token 數（約 4 字元 / token）"""
+    return max(1, len(json.dumps(convert_to_openai_tool(tool), ensure_ascii=False)) // 4)
+
+
+class ToolSelector:
+    """BM25 工具檢索器"""
+
+    def __init__(self, tools: Sequence, k1: float = 1.5, b: float = 0.75):
+        self.tools = list(tools)
+        self.k1 = k1
+        self.b = b
+
+        self._doc_terms: List[Counter] = []
+        for tool in self.tools:
+            text = f"{tool.name} {tool.name} {tool.description or ''}"
+            schema = tool.args_schema if isinstance(tool.args_schema, dict) else {}
+            for prop, spec in schema.get("properties", {}).items():
+                text += f" {prop} {spec.get('description', '')}"
+            self._doc_terms.append(Counter(tokenize(text)))
+
+        self._avg_len = (
+            sum(sum(terms.values()) for terms in self._doc_terms) / len(self._doc_terms)
+            if self._doc_terms else 0.0
+        )
+        doc_freq = Counter(term for terms in self._doc_terms for term in terms)
+        n = len(self._doc_terms)
+        self._idf = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for term, df in doc_freq.items()
+        }
+
+    def score(self, query: str) -> Dict[str, float]:
+        """計算每個工具對查詢的 BM25 分數"""
+        query_terms = Counter(tokenize(query))
+        scores = {}
+        for tool, terms in zip(self.tools, self._doc_terms):
+            length = sum(terms.values())
+            total = 0.0
+            for term, qf in query_terms.items():
+                tf = terms.get(term)
+                if not tf:
+                    continue
+                norm = tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / self._avg_len))
+                total += self._idf[term] * norm * qf
+            scores[tool.name] = total
+        return scores
+
+    def select(self, messages: List[BaseMessage], top_k: int) -> Optional[List[str]]:
+        """
+        依對話內容選出工具子集
+
+        Returns:
+            工具名稱列表；None 表示應使用完整工具集
+        """
+        # 查詢 = 最後一則使用者訊息（加權兩次）+ 最近幾則訊息
+        query_parts = []
+        used = []
+        for msg in reversed(messages):
+            if isinstance(msg, AIMessage):
+                used.extend(tc["name"] for tc in msg.tool_calls)
+            if isinstance(msg, HumanMessage):
+                query_parts.extend([_message_text(msg)] * 2)
+                break
+        recent = [m for m in messages if not isinstance(m, SystemMessage)][-4:]
+        query_parts.extend(_message_text(m)[:500] for m in recent)
+
+        scores = self.score(" ".join(query_parts))
+        ranked = [name for name, s in sorted(scores.items(), key=lambda x: -x[1]) if s > 0]
+        if not ranked:
+            return None
+
+        selected = [name for name in used if name in scores]
+        for name in ranked:
+            if len(selected) >= top_k:
+                break
+            if name not in selected:
+                selected.append(name)
+        if len(selected) >= len(self.tools):
+            return None
+        return selected
+
+
+class ToolSelectionStats:
+    """工具子集選擇統計"""
+
+    def __init__(self):
+        self.calls = 0
+        self.full_set_calls = 0
+        self.fallbacks = 0
+        self.schema_tokens_bound = 0
+        self.schema_tokens_full = 0
+
+    def snapshot(self) -> dict:
+        avg = lambda total: round(total / self.calls, 1) if self.calls else 0.0
+        return {
+            "calls": self.calls,
+            "full_set_calls": self.full_set_calls,
+            "fallbacks": self.fallbacks,
+            "avg_schema_tokens_per_step": avg(self.schema_tokens_bound),
+            "avg_schema_tokens_full_set": avg(self.schema_tokens_full),
+        }
+
+
+class SelectiveToolModel(Runnable):
+    """
+    包裝 chat model，每次呼叫只綁定相關的工具子集
+
+    bind_tools() 只記下完整工具集，真正綁定在每次呼叫時依對話內容決定
+    """
+
+    def __init__(
+        self,
+        inner: Runnable,
+        top_k: int = 6,
+        tools: Optional[Sequence] = None,
+        bind_kwargs: Optional[dict] = None,
+        stats: Optional[ToolSelectionStats] = None,
+    ):
+        """
+        Args:
+            inner: 實際的 chat model（或 ModelRouter）
+            top_k: 每次綁定的工具數量上限
+            tools: 完整工具集（由 bind_tools 設定）
+            bind_kwargs: 傳給 inner.bind_tools 的其他參數
+            stats: 共用的統計物件
+        """
+        self.inner = inner
+        self.top_k = top_k
+        self.tools = list(tools or [])
+        self.bind_kwargs = bind_kwargs or {}
+        self.stats = stats or ToolSelectionStats()
+        self.selector = ToolSelector(self.tools) if self.tools else None
+        self._schema_tokens = {tool.name: estimate_schema_tokens(tool) for tool in self.tools}
+        self._bound_cache: Dict[Optional[tuple], Runnable] = {}
+
+    def bind_tools(self, tools, **kwargs) -> "SelectiveToolModel":
+        """記下完整工具集，回傳新的 wrapper（共用統計）"""
+        return SelectiveToolModel(
+            inner=self.inner,
+            top_k=self.top_k,
+            tools=tools,
+            bind_kwargs=kwargs,
+            stats=self.stats,
+        )
+
+    def _bound(self, names: Optional[List[str]]) -> Runnable:
+        """取得綁定指定工具子集的模型（None 表示完整工具集），結果會快取"""
+        key = tuple(sorted(names)) if names is not None else None
+        if key not in self._bound_cache:
+            tools = self.tools if names is None else [t for t in self.tools if t.name in names]
+            self._bound_cache[key] = self.inner.bind_tools(tools, **self.bind_kwargs)
+        return self._bound_cache[key]
+
+    def _plan(self, model_input: Any) -> Optional[List[str]]:
+        """決定這一步要綁定的工具子集並記錄統計"""
+        messages = model_input.to_messages() if hasattr(model_input, "to_messages") else list(model_input)
+        names = self.selector.select(messages, self.top_k)
+
+        self.stats.calls += 1
+        self.stats.schema_tokens_full += sum(self._schema_tokens.values())
+        if names is None:
+            self.stats.full_set_calls += 1
+            self.stats.schema_tokens_bound += sum(self._schema_tokens.values())
+        else:
+            self.stats.schema_tokens_bound += sum(self._schema_tokens[n] for n in names)
+        return names
+
+    def _needs_full_set(self, response: BaseMessage, names: Optional[List[str]]) -> bool:
+        """模型呼叫了被省略的工具 → 需要用完整工具集重做"""
+        if names is None:
+            return False
+        requested = [tc["name"] for tc in getattr(response, "tool_calls", [])]
+        requested += [tc.get("name") for tc in getattr(response, "invalid_tool_calls", [])]
+        return any(name not in names for name in requested if name)
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> BaseMessage:
+        if self.selector is None:
+            return self.inner.invoke(input, config, **kwargs)
+
+        names = self._plan(input)
+        response = self._bound(names).invoke(input, config, **kwargs)
+        if self._needs_full_set(response, names):
+            self.stats.fallbacks += 1
+            response = self._bound(None).invoke(input, retry_config(config), **kwargs)
+        return response
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs) -> BaseMessage:
+        if self.selector is None:
+            return await self.inner.ainvoke(input, config, **kwargs)
+
+        names = self._plan(input)
+        response = await self._bound(names).ainvoke(input, config, **kwargs)
+        if self._needs_full_set(response, names):
+            self.stats.fallbacks += 1
+            response = await self._bound(None).ainvoke(input, retry_config(config), **kwargs)
+        return response
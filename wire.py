@@ -0,0 +1,181 @@
+"""
+Wire Format - API 回應的內容協商與壓縮
+
+對話歷史與工具結果很多的回應可能很大，client 也可能在慢速網路上：
+- 編碼：client 的 Accept 包含 application/msgpack 時回傳 MessagePack，否則回傳 JSON
+  （有安裝 orjson / ormsgpack 時使用，編碼速度快數倍；未安裝時退回 json / msgpack）
+- 壓縮：回應超過門檻且 client 的 Accept-Encoding 支援時以 zstd（優先）或 gzip 壓縮
+- 串流回應（NDJSON 匯出）逐段壓縮並 flush，client 可邊收邊解
+"""
+
+import gzip
+import json
+import zlib
+from typing import Any, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # 未安裝 orjson 時使用標準 json
+    orjson = None
+
+try:
+    import ormsgpack
+except ImportError:
+    ormsgpack = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # 未安裝 zstandard 時只支援 gzip
+    zstandard = None
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+_MSGPACK_MEDIA_TYPES = (MSGPACK_MEDIA_TYPE, "application/x-msgpack")
+
+MSGPACK_AVAILABLE = ormsgpack is not None or msgpack is not None
+
+
+def dumps_json(data: Any) -> bytes:
+    """編碼 JSON（UTF-8，不跳脫中文）"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads_json(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def packb(data: Any) -> bytes:
+    """編碼 MessagePack"""
+    if ormsgpack is not None:
+        return ormsgpack.packb(data, option=ormsgpack.OPT_NON_STR_KEYS)
+    if msgpack is not None:
+        return msgpack.packb(data, use_bin_type=True)
+    raise RuntimeError("MessagePack requires ormsgpack or msgpack")
+
+
+def unpackb(data: bytes) -> Any:
+    """解碼 MessagePack"""
+    if ormsgpack is not None:
+        return ormsgpack.unpackb(data)
+    if msgpack is not None:
+        return msgpack.unpackb(data, raw=False)
+    raise RuntimeError("MessagePack requires ormsgpack or msgpack")
+
+
+def _parse_header(value: Optional[str]) -> dict:
+    """解析 Accept / Accept-Encoding header，回傳 {值: q}"""
+    items = {}
+    for part in (value or "").split(","):
+        name, *params = [p.strip() for p in part.split(";")]
+        if not name:
+            continue
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        items[name.lower()] = q
+    return items
+
+
+def wants_msgpack(accept: Optional[str]) -> bool:
+    """client 是否偏好 MessagePack（q 值不低於 JSON）"""
+    if not MSGPACK_AVAILABLE:
+        return False
+    accepted = _parse_header(accept)
+    q = max(accepted.get(t, 0.0) for t in _MSGPACK_MEDIA_TYPES)
+    return q > 0 and q >= accepted.get(JSON_MEDIA_TYPE, 0.0)
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """依 Accept-Encoding 選擇壓縮方式（zstd 優先，其次 gzip）"""
+    accepted = _parse_header(accept_encoding)
+    if zstandard is not None and accepted.get("zstd", 0.0) > 0:
+        return "zstd"
+    if accepted.get("gzip", 0.0) > 0:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    return gzip.compress(body, compresslevel=5)
+
+
+def encode_body(data: Any, accept: Optional[str]) -> Tuple[bytes, str]:
+    """依 Accept header 編碼，回傳 (內容, media type)"""
+    if wants_msgpack(accept):
+        return packb(data), MSGPACK_MEDIA_TYPE
+    return dumps_json(data), JSON_MEDIA_TYPE
+
+
+def encode_response(
+    data: Any,
+    accept: Optional[str],
+    accept_encoding: Optional[str],
+    min_compress_bytes: int = 1024,
+) -> Tuple[bytes, str, dict]:
+    """
+    編碼並（必要時）壓縮回應
+
+    Args:
+        data: 回應內容（可 JSON 序列化的資料）
+        accept: client 的 Accept header
+        accept_encoding: client 的 Accept-Encoding header
+        min_compress_bytes: 超過幾個 bytes 才壓縮（0 表示不壓縮）
+
+    Returns:
+        (內容, media type, 額外的 response headers)
+    """
+    body, media_type = encode_body(data, accept)
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    encoding = choose_encoding(accept_encoding) if min_compress_bytes and len(body) >= min_compress_bytes else None
+    if encoding is not None:
+        body = compress(body, encoding)
+        headers["Content-Encoding"] = encoding
+    return body, media_type, headers
+
+
+class StreamCompressor:
+    """逐段壓縮串流回應，每段之後 flush，client 可以即時解壓縮"""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        else:
+            self._compressor = zlib.compressobj(5, zlib.DEFLATED, 31)  # wbits=31 → gzip 格式
+
+    def compress(self, chunk: bytes) -> bytes:
+        if self.encoding == "zstd":
+            return self._compressor.compress(chunk) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+async def compress_stream(chunks, encoding: Optional[str]):
+    """壓縮 async 串流（encoding 為 None 時原樣輸出）"""
+    if encoding is None:
+        async for chunk in chunks:
+            yield chunk
+        return
+    compressor = StreamCompressor(encoding)
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
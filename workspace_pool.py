@@ -0,0 +1,251 @@
+"""
+Workspace Pool - 依工作目錄保留常駐的 MCP 工具後端
+
+每個 workspace root 對應一個常駐的 filesystem MCP server session 與編譯好的 Agent，
+第一次使用時才啟動（lazy spawn），超過池大小或閒置太久時依 LRU 關閉閒置的後端。
+一個 server process 就能同時服務多個專案目錄。
+
+- 背景 task 定期清理閒置的後端（沒有新請求時也會執行）
+- MCP session 中斷（子程序結束、連線關閉）的後端會被丟棄，下次使用時重新啟動
+- 常駐的 root（預設的目前目錄）不會因閒置或 LRU 被關閉
+"""
+
+import asyncio
+import functools
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import anyio
+from langchain_mcp_adapters.sessions import create_session
+from langchain_mcp_adapters.tools import load_mcp_tools
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED
+
+
+class WorkspaceNotAllowed(ValueError):
+    """要求的 workspace 不在允許清單中"""
+
+
+def is_session_lost(error: BaseException) -> bool:
+    """MCP session 是否已中斷（之後的工具呼叫都會失敗，需要重新啟動後端）"""
+    if isinstance(error, McpError):
+        return error.error.code == CONNECTION_CLOSED
+    return isinstance(error, (anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream))
+
+
+class WorkspaceBackend:
+    """單一 workspace 的常駐工具後端"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.tools: List[Any] = []
+        self.agent = None
+        self.variants: Dict[str, Any] = {}  # profile 名稱 → 在此 workspace 編譯好的 graph
+        self.active_runs = 0
+        self.last_used = time.monotonic()
+        self.error: Optional[BaseException] = None
+        self._ready = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, connection: dict, prepare: Callable[[str, list], tuple]):
+        """在背景 task 中建立 MCP session（session 必須在同一個 task 中開啟與關閉）"""
+        self._task = asyncio.create_task(self._serve(connection, prepare))
+
+    async def _serve(self, connection: dict, prepare: Callable[[str, list], tuple]):
+        try:
+            async with create_session(connection) as session:
+                await session.initialize()
+                tools = await load_mcp_tools(session, server_name="filesystem")
+                self.tools, self.agent = prepare(self.root, self._watch(tools))
+                self._ready.set()
+                await self._stop.wait()
+        except Exception as e:
+            self.error = e
+        finally:
+            self._ready.set()
+
+    def _watch(self, tools: list) -> list:
+        """工具呼叫發現 session 已中斷時標記後端失效並結束 session，由 pool 重新啟動"""
+        for tool in tools:
+            if tool.coroutine is None:
+                continue
+
+            def watched(original):
+                @functools.wraps(original)
+                async def run(*args, **kwargs):
+                    try:
+                        return await original(*args, **kwargs)
+                    except Exception as e:
+                        if is_session_lost(e):
+                            self.error = e
+                            self._stop.set()
+                        raise
+                return run
+
+            tool.coroutine = watched(tool.coroutine)
+        return tools
+
+    @property
+    def alive(self) -> bool:
+        """後端是否可用（啟動中或 session 運作中；已失敗、已關閉或 session 中斷時為 False）"""
+        if self.error is not None or self._stop.is_set():
+            return False
+        return self._task is None or not self._task.done()
+
+    async def wait_ready(self):
+        """等待後端啟動完成"""
+        await self._ready.wait()
+        if self.error is not None:
+            raise RuntimeError(f"Failed to start workspace backend for {self.root}: {self.error}")
+
+    async def close(self):
+        """關閉 MCP session 與子程序"""
+        self._stop.set()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+class WorkspacePool:
+    """依 workspace root 管理常駐工具後端的 LRU 池"""
+
+    def __init__(
+        self,
+        allowed_roots: Sequence[str],
+        connection_factory: Callable[[str], dict],
+        prepare: Callable[[str, list], tuple],
+        max_size: int = 4,
+        idle_seconds: float = 600.0,
+        pinned_roots: Sequence[str] = (),
+    ):
+        """
+        Args:
+            allowed_roots: 允許的 workspace 根目錄（子目錄也允許）
+            connection_factory: root → MCP 連線設定
+            prepare: (root, 原始 MCP 工具) → (修正後的工具, 編譯好的 Agent)
+            max_size: 最多同時保留幾個後端
+            idle_seconds: 閒置超過幾秒的後端會被關閉
+            pinned_roots: 常駐的 root（一律允許，不會因閒置或 LRU 被關閉，例如預設的目前目錄）
+        """
+        self.allowed_roots = [os.path.realpath(root) for root in allowed_roots]
+        self.pinned_roots = {os.path.realpath(root) for root in pinned_roots}
+        self.connection_factory = connection_factory
+        self.prepare = prepare
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self.sweep_interval = max(1.0, min(60.0, idle_seconds / 2))
+        self.backends: "OrderedDict[str, WorkspaceBackend]" = OrderedDict()
+        self.spawned = 0
+        self.evicted = 0
+        self.lost = 0
+        self._sweeper: Optional[asyncio.Task] = None
+
+    def resolve(self, root: str) -> str:
+        """
+        正規化 workspace 路徑並檢查是否在允許清單中
+
+        Raises:
+            WorkspaceNotAllowed: 路徑不在允許的根目錄之下
+        """
+        path = os.path.realpath(root)
+        if path in self.pinned_roots:
+            return path
+        for allowed in self.allowed_roots:
+            if os.path.commonpath([path, allowed]) == allowed:
+                return path
+        raise WorkspaceNotAllowed(f"Workspace not allowed: {root}")
+
+    def _spawn(self, path: str) -> WorkspaceBackend:
+        backend = WorkspaceBackend(path)
+        backend.start(self.connection_factory(path), self.prepare)
+        self.backends[path] = backend
+        self.spawned += 1
+        return backend
+
+    @asynccontextmanager
+    async def acquire(self, root: str):
+        """取得 workspace 的後端（必要時啟動或重新啟動），使用期間不會被關閉"""
+        path = self.resolve(root)
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep())
+
+        backend = self.backends.get(path)
+        dead = None
+        if backend is not None and not backend.alive:
+            # MCP session 已中斷：先換上新的後端，再關閉舊的（避免等待期間重複啟動）
+            dead = backend
+            self.lost += 1
+            backend = None
+        if backend is None:
+            backend = self._spawn(path)
+        self.backends.move_to_end(path)
+
+        backend.active_runs += 1
+        try:
+            if dead is not None:
+                await dead.close()
+            try:
+                await backend.wait_ready()
+            except Exception:
+                if self.backends.get(path) is backend:
+                    del self.backends[path]
+                raise
+            yield backend
+        finally:
+            backend.active_runs -= 1
+            backend.last_used = time.monotonic()
+            await self._evict()
+
+    async def _sweep(self):
+        """定期清理閒置與失效的後端"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            await self._evict()
+
+    async def _evict(self):
+        """
+        關閉 session 已中斷的後端與閒置過久的後端，並在超過池大小時依 LRU 關閉閒置後端
+
+        先同步地選出並移除要關閉的後端，再等待關閉，避免與同時進行的 acquire / 清理互相干擾
+        """
+        now = time.monotonic()
+        victims = []
+        for path, backend in list(self.backends.items()):
+            if not backend.alive:
+                victims.append(path)
+                self.lost += 1
+                continue
+            if backend.active_runs or path in self.pinned_roots:
+                continue
+            over_size = len(self.backends) - len(victims) > self.max_size
+            if over_size or now - backend.last_used > self.idle_seconds:
+                victims.append(path)
+
+        closing = [self.backends.pop(path) for path in victims]
+        self.evicted += sum(1 for backend in closing if backend.alive)
+        await asyncio.gather(*(backend.close() for backend in closing))
+
+    async def close(self):
+        """停止背景清理並關閉所有後端"""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+        backends = list(self.backends.values())
+        self.backends.clear()
+        await asyncio.gather(*(backend.close() for backend in backends))
+
+    def stats(self) -> dict:
+        return {
+            "max_size": self.max_size,
+            "spawned": self.spawned,
+            "evicted": self.evicted,
+            "lost": self.lost,
+            "workspaces": {
+                path: {"active_runs": backend.active_runs, "tools": len(backend.tools), "alive": backend.alive}
+                for path, backend in self.backends.items()
+            },
+        }
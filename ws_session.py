@@ -0,0 +1,153 @@
+"""
+WebSocket Session - 每個互動式 client 一條持久的雙向連線
+
+下行（server → client）:
+- {"type": "ready", "thread_id": ...}
+- {"type": "token" | "tool_start" | "tool_end", ...}   Agent 串流事件
+- {"type": "final", "content": ..., "message_count": ...}
+- {"type": "cancelled"} / {"type": "error", "detail": ...}
+- {"type": "heartbeat"} / {"type": "pong"}
+
+上行（client → server）:
+- {"type": "chat", "message": ..., "thread_id": ..., "workspace": ..., "profile": ...}
+- {"type": "cancel"}
+- {"type": "ping"}
+
+無法解析的上行訊息（不是 JSON 物件）只回傳 error 事件，session 繼續運作
+"""
+
+import asyncio
+import json
+from contextlib import nullcontext
+from typing import AsyncContextManager, Callable, Optional
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+# chat 訊息中可以帶給 agent.astream 的選項
+RUN_OPTIONS = ("workspace", "profile")
+
+
+class WebSocketSession:
+    """單一 WebSocket 連線的對話 session"""
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        agent,
+        heartbeat_interval: float = 15.0,
+        send_queue_size: int = 256,
+        slot_factory: Optional[Callable[[], AsyncContextManager]] = None,
+        run_options: Optional[dict] = None,
+    ):
+        """
+        Args:
+            websocket: 已 accept 的 WebSocket 連線
+            agent: AgenticChatBot 實例，或回傳目前實例的函式（每輪對話取得執行名額後才呼叫，熱重載後使用新的 Agent）
+            heartbeat_interval: 心跳間隔（秒）
+            send_queue_size: 下行佇列大小；佇列滿時暫停讀取 Agent 事件（流量控制）
+            slot_factory: 每輪對話執行前要取得的排程名額（回傳 async context manager）
+            run_options: 由 server 決定、每輪都帶給 agent.astream 的選項（例如 tenant，client 無法覆寫）
+        """
+        self.websocket = websocket
+        self.agent = agent
+        self.slot_factory = slot_factory
+        self.run_options = run_options or {}
+        self.heartbeat_interval = heartbeat_interval
+        self.outbox: asyncio.Queue = asyncio.Queue(maxsize=send_queue_size)
+        self.thread_id = "default"
+        self.run_task: Optional[asyncio.Task] = None
+
+    async def run(self):
+        """執行 session 直到連線關閉"""
+        sender = asyncio.create_task(self._sender())
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            await self.outbox.put({"type": "ready", "thread_id": self.thread_id})
+            await self._receiver()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            for task in (self.run_task, heartbeat, sender):
+                if task and not task.done():
+                    task.cancel()
+
+    async def _sender(self):
+        """把下行佇列中的事件依序送出"""
+        while True:
+            event = await self.outbox.get()
+            await self.websocket.send_json(event)
+
+    async def _heartbeat(self):
+        """定期送出心跳，避免長時間工具執行時連線被中間設備切斷"""
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            await self.outbox.put({"type": "heartbeat"})
+
+    async def _receive(self) -> Optional[dict]:
+        """
+        讀取一則上行訊息（text 或 binary frame 中的 JSON 物件）
+
+        Returns:
+            解析後的訊息；內容不是 JSON 物件時回傳 None
+
+        Raises:
+            WebSocketDisconnect: 連線已關閉
+        """
+        message = await self.websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+        raw = message.get("text")
+        if raw is None:
+            raw = message.get("bytes") or b""
+        try:
+            data = json.loads(raw)
+        except ValueError:  # 包含 JSONDecodeError 與 UnicodeDecodeError
+            return None
+        return data if isinstance(data, dict) else None
+
+    async def _receiver(self):
+        """處理上行訊息"""
+        while True:
+            data = await self._receive()
+            if data is None:
+                await self.outbox.put({"type": "error", "detail": "Invalid message: expected a JSON object"})
+                continue
+            kind = data.get("type")
+
+            if kind == "chat":
+                if self.run_task and not self.run_task.done():
+                    await self.outbox.put({"type": "error", "detail": "A run is already in progress"})
+                    continue
+                self.thread_id = data.get("thread_id") or self.thread_id
+                options = {key: data[key] for key in RUN_OPTIONS if data.get(key) is not None}
+                options.update(self.run_options)
+                self.run_task = asyncio.create_task(self._run_turn(data.get("message", ""), options))
+
+            elif kind == "cancel":
+                if self.run_task and not self.run_task.done():
+                    self.run_task.cancel()
+
+            elif kind == "ping":
+                await self.outbox.put({"type": "pong"})
+
+            else:
+                await self.outbox.put({"type": "error", "detail": f"Unknown message type: {kind}"})
+
+    async def _run_turn(self, message: str, options: dict):
+        """執行一輪對話，並把串流事件送進下行佇列"""
+        thread_id = self.thread_id
+        slot = self.slot_factory() if self.slot_factory else nullcontext()
+        try:
+            async with slot:
+                agent = self.agent() if callable(self.agent) else self.agent
+                async for event in agent.astream(message, thread_id=thread_id, **options):
+                    if event["type"] == "final":
+                        event["message_count"] = agent.threads.turn_count(thread_id)
+                        event["thread_id"] = thread_id
+                    await self.outbox.put(event)
+        except asyncio.CancelledError:
+            # 連線關閉時 sender 可能已停止，不能在這裡等待佇列空間
+            if not self.outbox.full():
+                self.outbox.put_nowait({"type": "cancelled", "thread_id": thread_id})
+        except Exception as e:
+            await self.outbox.put({"type": "error", "detail": f"Agent error: {str(e)}"})